@@ -0,0 +1,919 @@
+#!/usr/bin/python
+
+""" Local stand-ins for the Zendesk Help Center API and the Smartling File API v1.
+
+The servers implement just the calls smartlingzd.py makes, against an in-memory
+synthetic corpus, so the script can be run end to end without touching production
+accounts. Both can be slowed down, made to fail a fraction of the requests and rate
+limited, see Behaviour. Every request is counted per call in a RequestStats object.
+
+The Zendesk stand-in speaks plain HTTP. The Smartling one speaks HTTPS only, like
+the SDK, with a self-signed certificate for localhost, see make_self_signed_cert().
+
+Run on its own to poke at the servers by hand:
+
+    python benchmark/fakeservers.py --articles 100 --locales 3
+"""
+
+
+import os
+import sys
+import base64
+import cgi
+import calendar
+import json
+import math
+import random
+import re
+import socket
+import ssl
+import subprocess
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+
+ZD_SOURCE_LOCALE = 'en-us'
+
+# Zendesk locale -> Smartling locale, the first M are used for a corpus of M locales
+LOCALE_POOL = [
+    ('fr', 'fr-FR'), ('de', 'de-DE'), ('es', 'es-ES'), ('ja', 'ja-JP'), ('nl', 'nl-NL'),
+    ('it', 'it-IT'), ('pt-br', 'pt-BR'), ('ko', 'ko-KR'), ('zh-cn', 'zh-CN'),
+    ('ru', 'ru-RU'), ('sv', 'sv-SE'), ('pl', 'pl-PL'), ('tr', 'tr-TR'), ('da', 'da-DK'),
+    ('fi', 'fi-FI'), ('no', 'nb-NO'), ('cs', 'cs-CZ'), ('he', 'he-IL'), ('ar', 'ar-SA'),
+    ('zh-tw', 'zh-TW'),
+]
+
+ZD_PAGE_SIZE = 30            # default page size of Zendesk list calls
+ZD_MAX_PAGE_SIZE = 100
+ZD_INCREMENTAL_PAGE_SIZE = 1000
+SL_LIST_LIMIT = 500          # default page size of Smartling list calls
+SL_CALLBACK_DELAY = 0.5      # seconds between an upload and its completion callbacks
+GZIP_MIN_SIZE = 256          # smallest response compressed for clients accepting gzip
+
+ARTICLES_PER_SECTION = 20
+SECTIONS_PER_CATEGORY = 5
+DRAFT_RATIO = 0.05
+CORPUS_TIME = 1420070400     # 2015-01-01, when the synthetic items were created
+
+WORDS = ('account billing browser cache click configure customer dashboard data default '
+         'delete device download email enable error export feature field file filter '
+         'help import install integration invoice language link login menu mobile '
+         'network notification option password permission plan profile report request '
+         'reset role save search security settings setup sign subscription support sync '
+         'team ticket update upload user view workflow').split()
+
+
+def format_time(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+def parse_time(value):
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+class Corpus(object):
+    """ Synthetic Help Center: categories, sections and articles in the source locale.
+
+    Articles have HTML bodies with headings, lists, links to other articles and
+    images named after the source locale, which have a localised attachment per
+    locale, so link rewriting has real work to do. Generation is deterministic for a
+    given seed.
+    """
+
+    def __init__(self, articles, locales, seed=1, zendesk_host='example.zendesk.com'):
+        if locales > len(LOCALE_POOL):
+            raise ValueError('At most %s locales are supported' % len(LOCALE_POOL))
+
+        self.random = random.Random(seed)
+        self.zendesk_host = zendesk_host
+        self.locale_mapping = LOCALE_POOL[:locales]
+        self.zd_locales = [zd_locale for zd_locale, sl_locale in self.locale_mapping]
+
+        base_time = CORPUS_TIME
+
+        section_count = max(1, int(math.ceil(articles / float(ARTICLES_PER_SECTION))))
+        category_count = max(1, int(math.ceil(section_count / float(SECTIONS_PER_CATEGORY))))
+
+        self.categories = []
+        for n in range(category_count):
+            self.categories.append(self.make_item('categories', 200000000 + n, n, base_time,
+                                                  name=self.sentence(2, 4),
+                                                  description=self.sentence(8, 20)))
+
+        self.sections = []
+        for n in range(section_count):
+            category = self.categories[n // SECTIONS_PER_CATEGORY]
+            self.sections.append(self.make_item('sections', 210000000 + n, n, base_time,
+                                                category_id=category['id'],
+                                                name=self.sentence(2, 5),
+                                                description=self.sentence(8, 20)))
+
+        article_ids = [220000000 + n for n in range(articles)]
+        self.attachments = {}
+        self.articles = []
+        for n, article_id in enumerate(article_ids):
+            section = self.sections[n // ARTICLES_PER_SECTION]
+            body, images = self.article_body(article_id, article_ids)
+            article = self.make_item('articles', article_id, n, base_time,
+                                     section_id=section['id'],
+                                     title=self.sentence(3, 8),
+                                     body=body,
+                                     draft=self.random.random() < DRAFT_RATIO,
+                                     author_id=300000000,
+                                     comments_disabled=False,
+                                     promoted=False,
+                                     vote_sum=self.random.randint(0, 50),
+                                     vote_count=self.random.randint(0, 80),
+                                     label_names=[self.random.choice(WORDS)])
+            self.articles.append(article)
+            self.attachments[article_id] = self.article_attachments(article_id, images)
+
+        self.items = {
+            'categories': self.categories,
+            'sections': self.sections,
+            'articles': self.articles,
+        }
+        self.by_id = dict(((kind, item['id']), item)
+                          for kind, items in self.items.iteritems() for item in items)
+
+    def make_item(self, kind, item_id, n, base_time, **fields):
+        updated_at = base_time + n * 60
+        item = {
+            'id': item_id,
+            'url': 'https://%s/api/v2/help_center/%s/%s/%s.json' % (
+                self.zendesk_host, ZD_SOURCE_LOCALE, kind, item_id),
+            'html_url': 'https://%s/hc/%s/%s/%s' % (self.zendesk_host, ZD_SOURCE_LOCALE,
+                                                    kind, item_id),
+            'locale': ZD_SOURCE_LOCALE,
+            'source_locale': ZD_SOURCE_LOCALE,
+            'position': n,
+            'outdated': False,
+            'created_at': format_time(base_time),
+            'updated_at': format_time(updated_at),
+        }
+        item.update(fields)
+        return item
+
+    def sentence(self, low, high):
+        words = [self.random.choice(WORDS) for i in range(self.random.randint(low, high))]
+        return ' '.join(words).capitalize()
+
+    def paragraph(self):
+        return '. '.join(self.sentence(6, 16) for i in range(self.random.randint(2, 6))) + '.'
+
+    def article_body(self, article_id, article_ids):
+        """ Return an HTML body and the file names of its images """
+
+        parts = []
+        images = []
+        for n in range(self.random.randint(2, 6)):
+            parts.append('<h2>%s</h2>' % self.sentence(2, 6))
+            parts.append('<p>%s <a href="https://%s/hc/%s/articles/%s">%s</a> %s</p>' % (
+                self.paragraph(), self.zendesk_host, ZD_SOURCE_LOCALE,
+                self.random.choice(article_ids), self.sentence(2, 4), self.paragraph()))
+
+            if self.random.random() < 0.5:
+                image = 'screenshot_%s_%s.png' % (len(images) + 1, ZD_SOURCE_LOCALE)
+                images.append(image)
+                parts.append('<p><img src="https://%s/hc/article_attachments/%s/%s" '
+                             'alt="%s"></p>' % (self.zendesk_host, article_id * 10 + len(images),
+                                                image, self.sentence(2, 5)))
+
+            if self.random.random() < 0.3:
+                parts.append('<ul>%s</ul>' % ''.join('<li>%s</li>' % self.sentence(3, 8)
+                                                     for i in range(self.random.randint(2, 5))))
+
+            if self.random.random() < 0.2:
+                parts.append('<p>See also <a href="https://www.example.com/docs/%s">%s</a>.</p>'
+                             % (self.random.choice(WORDS), self.sentence(2, 4)))
+
+        return '\n'.join(parts), images
+
+    def article_attachments(self, article_id, images):
+        """ The source images and their localised versions """
+
+        attachments = []
+        for image in images:
+            for locale in [ZD_SOURCE_LOCALE] + self.zd_locales:
+                file_name = image.replace('_' + ZD_SOURCE_LOCALE + '.', '_' + locale + '.')
+                attachment_id = article_id * 1000 + len(attachments)
+                attachments.append({
+                    'id': attachment_id,
+                    'article_id': article_id,
+                    'file_name': file_name,
+                    'content_type': 'image/png',
+                    'size': 20000 + len(attachments),
+                    'inline': True,
+                    'content_url': 'https://%s/hc/article_attachments/%s/%s' % (
+                        self.zendesk_host, attachment_id, file_name),
+                })
+        return attachments
+
+    def published_articles(self):
+        return [article for article in self.articles if not article['draft']]
+
+
+class TokenBucket(object):
+    """ Allows rate requests per second on average, in bursts of up to burst """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Return 0 if a request may go ahead, or the number of seconds until it may """
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class Behaviour(object):
+    """ How a stand-in server misbehaves.
+
+    latency. Seconds every response is delayed by, give or take jitter
+    error_rate. Fraction of requests failing with a 503
+    rate_limit. Requests per second allowed before answering 429 with Retry-After,
+        0 for no limit
+    burst. Requests allowed at once on top of rate_limit
+    gzip. Whether responses are gzip compressed for clients accepting it
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=0, burst=None,
+                 seed=1, gzip=True):
+        self.gzip = gzip
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bucket = None
+        if rate_limit:
+            self.bucket = TokenBucket(rate_limit, burst or rate_limit)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self.lock:
+                jitter = self.random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(0, self.latency + jitter))
+
+    def retry_after(self):
+        """ Return seconds to wait if the request is rate limited, otherwise None """
+
+        if self.bucket is None:
+            return None
+        wait = self.bucket.take()
+        if wait:
+            return wait
+        return None
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+class RequestStats(object):
+    """ Request counts per call and per status, and bytes sent and received """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.statuses = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def record(self, call, status, bytes_in, bytes_out):
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': sum(self.calls.values()),
+                'calls': dict(self.calls),
+                'statuses': dict(self.statuses),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler_class, behaviour, state):
+        HTTPServer.__init__(self, address, handler_class)
+        self.behaviour = behaviour
+        self.state = state
+        self.stats = RequestStats()
+        self.url = None
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections are expected, anything else isn't
+        if not isinstance(sys.exc_info()[1], (socket.error, ssl.SSLError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """ Dispatches requests to handler methods by method and path.
+
+    routes is a list of (HTTP method, path regex, handler method name). A handler
+    method gets the path match, the query parameters and the request body, and returns
+    (status, JSON-serializable payload or string, extra headers). Request bodies may be
+    gzip compressed, and so are responses of GZIP_MIN_SIZE bytes or more, like the 
+    real services do, unless the behaviour turns that off.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    routes = []
+
+    # Send each response in one go, so the stand-ins don't add delays of their own
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle_request(self):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        wire_length = len(body)
+        if (self.headers.getheader('Content-Encoding') or '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        for method, path_re, name in self.routes:
+            match = path_re.match(path)
+            if method == self.command and match is not None:
+                break
+        else:
+            name, match = None, None
+
+        behaviour = self.server.behaviour
+        behaviour.delay()
+
+        retry_after = behaviour.retry_after()
+        if name is None:
+            status, payload, headers = 404, self.error_payload('Not found: ' + path), {}
+        elif retry_after is not None:
+            status, payload = 429, self.error_payload('Rate limit exceeded')
+            headers = {'Retry-After': str(int(math.ceil(retry_after)))}
+        elif behaviour.should_fail():
+            status, payload = 503, self.error_payload('Injected failure')
+            headers = {'Retry-After': '1'}
+        else:
+            try:
+                status, payload, headers = getattr(self, name)(match, params, body)
+            except Exception as e:
+                status, payload, headers = 500, self.error_payload(repr(e)), {}
+
+        if not isinstance(payload, basestring):
+            payload = json.dumps(payload)
+        content_type = headers.pop('Content-Type', 'application/json; charset=utf-8')
+        if behaviour.gzip and len(payload) >= GZIP_MIN_SIZE \
+                and 'gzip' in (self.headers.getheader('Accept-Encoding') or ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = compressor.compress(payload) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+        self.server.stats.record(name or 'unknown', status, wire_length + len(self.path),
+                                 len(payload))
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def error_payload(self, message):
+        return {'error': message}
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ZendeskState(object):
+    """ Mutable Help Center content: the corpus plus translations created so far """
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.translations = {}  # (kind, id, locale) -> translation
+        self.lock = threading.Lock()
+
+
+SINGULAR = {'articles': 'article', 'sections': 'section', 'categories': 'category'}
+
+# Fields of an item listed in a locale taken from its translation, as (item field, 
+# translation field)
+LOCALIZED_FIELDS = {
+    'articles': [('title', 'title'), ('body', 'body'), ('draft', 'draft')],
+    'sections': [('name', 'title'), ('description', 'description')],
+    'categories': [('name', 'title'), ('description', 'description')],
+}
+
+KINDS = '(?P<kind>articles|sections|categories)'
+LOCALE = '(?P<locale>[a-z]{2}(?:-[a-z]{2})?)'
+
+
+class FakeZendeskHandler(FakeApiHandler):
+
+    routes = [
+        ('GET', re.compile(r'^/api/v2/help_center/incremental/articles\.json$'),
+         'incremental_articles'),
+        ('GET', re.compile(r'^/api/v2/help_center/%s/%s\.json$' % (LOCALE, KINDS)),
+         'list_items'),
+        ('GET', re.compile(r'^/api/v2/help_center/(?:%s/)?(?P<scope>sections|categories)/'
+                           r'(?P<scope_id>\d+)/articles\.json$' % LOCALE),
+         'list_scoped_articles'),
+        ('GET', re.compile(r'^/api/v2/help_center/(?:%s/)?%s/(?P<id>\d+)\.json$' % (LOCALE, KINDS)),
+         'show_item'),
+        ('GET', re.compile(r'^/api/v2/help_center/articles/(?P<id>\d+)/attachments\.json$'),
+         'article_attachments'),
+        ('GET', re.compile(r'^/api/v2/help_center/%s/(?P<id>\d+)/translations/%s\.json$'
+                           % (KINDS, LOCALE)),
+         'show_translation'),
+        ('PUT', re.compile(r'^/api/v2/help_center/%s/(?P<id>\d+)/translations/%s\.json$'
+                           % (KINDS, LOCALE)),
+         'update_translation'),
+        ('POST', re.compile(r'^/api/v2/help_center/%s/(?P<id>\d+)/translations\.json$' % KINDS),
+         'create_translation'),
+    ]
+
+    def page_url(self, params, page):
+        params = dict(params, page=page)
+        path = self.path.partition('?')[0]
+        return 'http://%s%s?%s' % (self.headers.getheader('Host'), path,
+                                   '&'.join('%s=%s' % item for item in sorted(params.items())))
+
+    def items_in_locale(self, kind, locale):
+        state = self.server.state
+
+        if locale in (None, ZD_SOURCE_LOCALE):
+            return state.corpus.items[kind]
+
+        with state.lock:
+            items = []
+            for item in state.corpus.items[kind]:
+                translation = state.translations.get((kind, item['id'], locale))
+                if translation is not None:
+                    # Listed with the item's own id, like Help Center does
+                    localized = dict(item, locale=locale)
+                    for item_field, translation_field in LOCALIZED_FIELDS[kind]:
+                        if translation_field in translation:
+                            localized[item_field] = translation[translation_field]
+                    items.append(localized)
+        return items
+
+    def list_items(self, match, params, body):
+        kind = match.group('kind')
+        items = self.items_in_locale(kind, match.group('locale'))
+
+        if kind == 'articles' and params.get('label_names'):
+            labels = set(params['label_names'].split(','))
+            items = [item for item in items if labels.intersection(item['label_names'])]
+
+        return self.paged(kind, items, params)
+
+    def list_scoped_articles(self, match, params, body):
+        scope, scope_id = match.group('scope'), int(match.group('scope_id'))
+        if self.find_item(scope, scope_id) is None:
+            return 404, self.error_payload('RecordNotFound'), {}
+
+        if scope == 'sections':
+            section_ids = set([scope_id])
+        else:
+            section_ids = set(section['id'] for section in self.server.state.corpus.sections
+                              if section['category_id'] == scope_id)
+        items = [item for item in self.items_in_locale('articles', match.group('locale'))
+                 if item['section_id'] in section_ids]
+
+        return self.paged('articles', items, params)
+
+    def paged(self, kind, items, params):
+        """ Page of items, with cursor pagination if asked for, else offset pagination """
+
+        if 'page[size]' in params:
+            return 200, self.cursor_page(kind, items, params), {}
+
+        per_page = min(int(params.get('per_page', ZD_PAGE_SIZE)), ZD_MAX_PAGE_SIZE)
+        page = int(params.get('page', 1))
+        page_count = max(1, int(math.ceil(len(items) / float(per_page))))
+        next_page = None
+        if page < page_count:
+            next_page = self.page_url(params, page + 1)
+        previous_page = None
+        if page > 1:
+            previous_page = self.page_url(params, page - 1)
+
+        return 200, {
+            kind: items[(page - 1) * per_page:page * per_page],
+            'page': page,
+            'per_page': per_page,
+            'page_count': page_count,
+            'count': len(items),
+            'next_page': next_page,
+            'previous_page': previous_page,
+        }, {}
+
+    def cursor_page(self, kind, items, params):
+        """ Page of items with cursor pagination, the cursor being the encoded offset """
+
+        size = min(int(params['page[size]']), ZD_MAX_PAGE_SIZE)
+        start = 0
+        if params.get('page[after]'):
+            start = int(base64.urlsafe_b64decode(params['page[after]']))
+        page_items = items[start:start + size]
+        has_more = start + size < len(items)
+
+        after_cursor = None
+        next_link = None
+        if has_more:
+            after_cursor = base64.urlsafe_b64encode(str(start + size))
+            next_link = 'http://%s%s?page[size]=%s&page[after]=%s' % (
+                self.headers.getheader('Host'), self.path.partition('?')[0], size, 
+                after_cursor)
+
+        return {
+            kind: page_items,
+            'meta': {
+                'has_more': has_more,
+                'after_cursor': after_cursor,
+                'before_cursor': base64.urlsafe_b64encode(str(start)) if start else None,
+            },
+            'links': {
+                'next': next_link,
+                'prev': None,
+            },
+        }
+
+    def incremental_articles(self, match, params, body):
+        start_time = int(params.get('start_time', 0))
+        articles = sorted((article for article in self.server.state.corpus.articles
+                           if parse_time(article['updated_at']) >= start_time),
+                          key=lambda article: article['updated_at'])
+        articles = articles[:ZD_INCREMENTAL_PAGE_SIZE]
+
+        end_time = start_time
+        if articles:
+            end_time = parse_time(articles[-1]['updated_at'])
+        next_page = None
+        if len(articles) == ZD_INCREMENTAL_PAGE_SIZE:
+            next_page = 'http://%s%s?start_time=%s' % (self.headers.getheader('Host'),
+                                                        self.path.partition('?')[0], end_time)
+
+        return 200, {
+            'articles': articles,
+            'count': len(articles),
+            'end_time': end_time,
+            'next_page': next_page,
+        }, {}
+
+    def find_item(self, kind, item_id):
+        return self.server.state.corpus.by_id.get((kind, int(item_id)))
+
+    def show_item(self, match, params, body):
+        kind = match.group('kind')
+        item = self.find_item(kind, match.group('id'))
+        if item is None:
+            return 404, self.error_payload('RecordNotFound'), {}
+        return 200, {SINGULAR[kind]: item}, {}
+
+    def article_attachments(self, match, params, body):
+        if self.find_item('articles', match.group('id')) is None:
+            return 404, self.error_payload('RecordNotFound'), {}
+        return 200, {
+            'article_attachments': self.server.state.corpus.attachments[int(match.group('id'))]
+        }, {}
+
+    def show_translation(self, match, params, body):
+        key = (match.group('kind'), int(match.group('id')), match.group('locale'))
+        with self.server.state.lock:
+            translation = self.server.state.translations.get(key)
+        if translation is None:
+            return 404, self.error_payload('RecordNotFound'), {}
+        return 200, {'translation': translation}, {}
+
+    def save_translation(self, kind, item_id, locale, fields, must_exist):
+        if self.find_item(kind, item_id) is None:
+            return 404, self.error_payload('RecordNotFound'), {}
+
+        key = (kind, int(item_id), locale)
+        state = self.server.state
+        with state.lock:
+            exists = key in state.translations
+            if must_exist and not exists:
+                return 404, self.error_payload('RecordNotFound'), {}
+            if not must_exist and exists:
+                return 422, self.error_payload('Translation already exists'), {}
+
+            translation = dict(state.translations.get(key, {}))
+            translation.update(fields)
+            translation.update({
+                'id': int(item_id) + 10 ** 9,
+                'source_id': int(item_id),
+                'source_type': SINGULAR[kind].capitalize(),
+                'locale': locale,
+                'updated_at': format_time(time.time()),
+            })
+            state.translations[key] = translation
+
+        if must_exist:
+            return 200, {'translation': translation}, {}
+        return 201, {'translation': translation}, {}
+
+    def translation_fields(self, body):
+        # The script sends the fields without the 'translation' wrapper, both are accepted
+        payload = json.loads(body)
+        return payload.get('translation', payload)
+
+    def update_translation(self, match, params, body):
+        fields = self.translation_fields(body)
+        return self.save_translation(match.group('kind'), match.group('id'),
+                                     match.group('locale'), fields, True)
+
+    def create_translation(self, match, params, body):
+        fields = self.translation_fields(body)
+        return self.save_translation(match.group('kind'), match.group('id'),
+                                     fields.get('locale'), fields, False)
+
+
+class SmartlingState(object):
+    """ Files uploaded so far, all treated as fully translated in every locale """
+
+    def __init__(self, sl_locales):
+        self.sl_locales = sl_locales
+        self.files = {}  # fileUri -> dictionary of file content and properties
+        self.lock = threading.Lock()
+
+
+def send_callbacks(callback_url, uri, sl_locales):
+    """ Tell callback_url that uri is complete in every locale, like Smartling does """
+
+    for sl_locale in sl_locales:
+        url = callback_url + ('&' if '?' in callback_url else '?') + urllib.urlencode(
+            {'fileUri': uri, 'locale': sl_locale})
+        try:
+            urllib2.urlopen(url, timeout=10).read()
+        except (urllib2.URLError, socket.error) as e:
+            print >> sys.stderr, 'Callback to %s failed: %s' % (url, e)
+
+
+class FakeSmartlingHandler(FakeApiHandler):
+
+    routes = [
+        ('POST', re.compile(r'^/v1/file/upload$'), 'upload'),
+        ('POST', re.compile(r'^/v1/file/list$'), 'list_files'),
+        ('POST', re.compile(r'^/v1/file/get$'), 'get_file'),
+        ('POST', re.compile(r'^/v1/file/last_modified$'), 'last_modified'),
+        ('POST', re.compile(r'^/v1/file/status$'), 'status'),
+    ]
+
+    def error_payload(self, message):
+        return {'response': {'code': 'VALIDATION_ERROR', 'messages': [message], 'data': None}}
+
+    def success(self, data):
+        return 200, {'response': {'code': 'SUCCESS', 'messages': [], 'data': data}}, {}
+
+    def form(self, body):
+        """ Parse a urlencoded or multipart request body into a dictionary """
+
+        # The length of the body, which may have been sent compressed
+        headers = {'content-type': self.headers.getheader('Content-Type'),
+                   'content-length': str(len(body))}
+        form = cgi.FieldStorage(fp=StringIO(body), headers=headers,
+                                environ={'REQUEST_METHOD': 'POST'})
+        return dict((key, form[key].value) for key in form.keys())
+
+    def find_file(self, form):
+        with self.server.state.lock:
+            return self.server.state.files.get(form.get('fileUri'))
+
+    def upload(self, match, params, body):
+        form = self.form(body)
+        content = form['file']
+        paths = [path for path in form.get('smartling.translate_paths', '').split(',') if path]
+        strings = count_strings(json.loads(content), paths)
+
+        state = self.server.state
+        with state.lock:
+            overwritten = form['fileUri'] in state.files
+            state.files[form['fileUri']] = {
+                'content': content,
+                'fileType': form.get('fileType'),
+                'paths': paths,
+                'stringCount': len(strings),
+                'wordCount': sum(len(string.split()) for string in strings),
+                'lastUploaded': format_time(time.time()),
+            }
+
+        if form.get('callbackUrl'):
+            timer = threading.Timer(SL_CALLBACK_DELAY, send_callbacks, 
+                                    (form['callbackUrl'], form['fileUri'], state.sl_locales))
+            timer.daemon = True
+            timer.start()
+
+        return self.success({'overWritten': overwritten, 'stringCount': len(strings),
+                             'wordCount': sum(len(string.split()) for string in strings)})
+
+    def file_entry(self, uri, properties):
+        return {
+            'fileUri': uri,
+            'fileType': properties['fileType'],
+            'lastUploaded': properties['lastUploaded'],
+            'stringCount': properties['stringCount'],
+            'wordCount': properties['wordCount'],
+            'approvedStringCount': properties['stringCount'],
+            'completedStringCount': properties['stringCount'],
+        }
+
+    def list_files(self, match, params, body):
+        form = self.form(body)
+        mask = form.get('uriMask', '')
+        file_types = form.get('fileTypes')
+        offset = int(form.get('offset', 0))
+        limit = int(form.get('limit', SL_LIST_LIMIT))
+
+        with self.server.state.lock:
+            files = sorted((uri, properties)
+                           for uri, properties in self.server.state.files.iteritems()
+                           if mask in uri and file_types in (None, properties['fileType']))
+
+        return self.success({
+            'fileCount': len(files),
+            'fileList': [self.file_entry(uri, properties)
+                         for uri, properties in files[offset:offset + limit]],
+        })
+
+    def get_file(self, match, params, body):
+        form = self.form(body)
+        properties = self.find_file(form)
+        if properties is None:
+            return 400, self.error_payload('File not found: %s' % form.get('fileUri')), {}
+
+        data = translate_json(json.loads(properties['content']), properties['paths'],
+                              form.get('locale', ''))
+        return 200, json.dumps(data, indent=4), {'Content-Type': 'application/json'}
+
+    def last_modified(self, match, params, body):
+        form = self.form(body)
+        properties = self.find_file(form)
+        if properties is None:
+            return 400, self.error_payload('File not found: %s' % form.get('fileUri')), {}
+
+        if 'locale' in form:
+            return self.success({'locale': form['locale'],
+                                 'lastModified': properties['lastUploaded']})
+
+        items = [{'locale': sl_locale, 'lastModified': properties['lastUploaded']}
+                 for sl_locale in self.server.state.sl_locales]
+        return self.success({'count': len(items), 'items': items})
+
+    def status(self, match, params, body):
+        form = self.form(body)
+        properties = self.find_file(form)
+        if properties is None:
+            return 400, self.error_payload('File not found: %s' % form.get('fileUri')), {}
+        return self.success(self.file_entry(form['fileUri'], properties))
+
+
+def path_values(data, path):
+    """ Yield (container, key) for the JSON path, with '*' matching any key """
+
+    head, _, rest = path.partition('/')
+    if not isinstance(data, dict):
+        return
+    keys = data.keys() if head == '*' else [head]
+    for key in keys:
+        if key not in data:
+            continue
+        if rest:
+            for found in path_values(data[key], rest):
+                yield found
+        elif isinstance(data[key], basestring):
+            yield data, key
+
+
+def count_strings(data, paths):
+    return [container[key] for path in paths for container, key in path_values(data, path)]
+
+
+def translate_json(data, paths, locale):
+    """ Mark the strings at paths as translated into locale """
+
+    for path in paths:
+        for container, key in path_values(data, path):
+            container[key] = u'[%s] %s' % (locale, container[key])
+    return data
+
+
+def make_self_signed_cert(directory, host='localhost'):
+    """ Create a certificate for host with the openssl command, return (cert, key) files """
+
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    config_file = os.path.join(directory, 'openssl.cnf')
+    with open(config_file, 'w') as f:
+        f.write('[req]\ndistinguished_name = dn\nx509_extensions = ext\nprompt = no\n'
+                '[dn]\nCN = %s\n[ext]\nsubjectAltName = DNS:%s\n'
+                'basicConstraints = critical,CA:TRUE\n' % (host, host))
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-days', '2', '-keyout', key_file, '-out', cert_file,
+                               '-config', config_file],
+                              stdout=devnull, stderr=devnull)
+    return cert_file, key_file
+
+
+def start_fake_zendesk(corpus, behaviour, port=0):
+    """ Start the Zendesk stand-in in a background thread, return the server """
+
+    server = FakeServer(('127.0.0.1', port), FakeZendeskHandler, behaviour,
+                        ZendeskState(corpus))
+    server.url = 'http://127.0.0.1:%s' % server.server_address[1]
+    return server.start()
+
+
+def start_fake_smartling(sl_locales, behaviour, cert_file, key_file, port=0):
+    """ Start the Smartling stand-in in a background thread, return the server """
+
+    server = FakeServer(('127.0.0.1', port), FakeSmartlingHandler, behaviour,
+                        SmartlingState(sl_locales))
+    server.socket = ssl.wrap_socket(server.socket, keyfile=key_file, certfile=cert_file,
+                                    server_side=True)
+    server.host = 'localhost:%s' % server.server_address[1]
+    server.url = 'https://' + server.host
+    return server.start()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Run the Zendesk and Smartling stand-ins')
+    parser.add_argument('--articles', type=int, default=100)
+    parser.add_argument('--locales', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=0, help='Requests per second')
+    parser.add_argument('--no-gzip', action='store_true', help='Don\'t compress responses')
+    parser.add_argument('--dir', default='.', help='Where to write the certificate')
+    args = parser.parse_args()
+
+    corpus = Corpus(args.articles, args.locales)
+    behaviour = lambda: Behaviour(args.latency / 1000.0, 0, args.error_rate, args.rate_limit,
+                                  gzip=not args.no_gzip)
+
+    cert_file, key_file = make_self_signed_cert(args.dir)
+    zendesk = start_fake_zendesk(corpus, behaviour())
+    smartling = start_fake_smartling([sl for zd, sl in corpus.locale_mapping], behaviour(),
+                                     cert_file, key_file)
+
+    print 'Zendesk:   %s' % zendesk.url
+    print 'Smartling: %s (CA file %s)' % (smartling.url, cert_file)
+    print 'Locales:   %s' % ', '.join('%s = %s' % pair for pair in corpus.locale_mapping)
+
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/python
+
+""" End-to-end benchmark of smartlingzd.py against the local stand-in servers.
+
+Starts the Zendesk and Smartling stand-ins from fakeservers.py with a synthetic
+corpus, writes the script's config files into a scratch directory, and runs the
+translate (-t) and retrieve (-r) flows there as child processes, each for all
+categories, sections and articles. Every flow is measured for:
+
+    wall time             of the child process
+    requests              made to each stand-in, and per second
+    requests per item     items sent for -t, translations published for -r
+    peak RSS              of the child process
+    KB on the wire        sent and received, and what compression saved
+
+Results are appended, together with the git revision of the tree, to
+benchmark/results.jsonl, and compared with the last earlier run with the same
+parameters so regressions between versions stand out.
+
+Usage examples:
+
+    python benchmark/run_benchmark.py --articles 1000 --locales 5 --jobs 8
+
+    python benchmark/run_benchmark.py --articles 200 --latency 50 --rate-limit 100 --passes 2
+
+    The second pass of --passes 2 runs against the state left by the first one, which
+    shows what is skipped as unchanged.
+
+zdesk has to be importable by the Python interpreter running the script, which is
+the one running the benchmark unless --python is given.
+"""
+
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import argparse
+
+from fakeservers import (Corpus, Behaviour, make_self_signed_cert, start_fake_zendesk,
+                         start_fake_smartling)
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+SCRIPT = os.path.join(REPO_DIR, 'smartlingzd.py')
+RESULTS_FILE = os.path.join(BENCHMARK_DIR, 'results.jsonl')
+
+FLOWS = {
+    'translate': ['-t', '-c', 'all', '-s', 'all', '-a', 'all'],
+    'retrieve': ['-r', '-l', 'all', '-c', 'all', '-s', 'all', '-a', 'all'],
+}
+
+
+def git_revision():
+    """ Return the short revision of the tree, marked if it has uncommitted changes """
+
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=REPO_DIR).strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain',
+                                           '--untracked-files=no'], cwd=REPO_DIR)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    if changes.strip():
+        revision += '+dirty'
+    return revision
+
+
+def write_config(work_dir, corpus, zendesk, smartling, cert_file, args):
+
+    lines = [
+        '[general]',
+        'log_file = smartlingzd.log',
+        'write_debug_files = %s' % ('yes' if args.debug_files or args.archive else 'no'),
+        'archive_runs = %s' % (2 if args.archive else 0),
+        '',
+        '[smartling]',
+        'api_key = benchmark-key',
+        'project_id = benchmark-project',
+        'approve_for_translation = yes',
+        'compress_uploads = %s' % ('yes' if args.compress_uploads else 'no'),
+        'host = %s' % smartling.host,
+        'ca_file = %s' % cert_file,
+        '',
+        '[zendesk]',
+        'url = %s' % zendesk.url,
+        'user = benchmark@example.com',
+        'auth_token = benchmark-token',
+        '',
+        '[zd-to-sl-locales]',
+    ]
+    lines += ['%s = %s' % pair for pair in corpus.locale_mapping]
+
+    with io.open(os.path.join(work_dir, 'smartlingzd.cfg'), 'w') as f:
+        f.write(u'\n'.join(lines) + u'\n')
+
+
+def run_flow(flow, work_dir, args):
+    """ Run the script for flow in work_dir, return (exit code, wall time, peak RSS in KB) """
+
+    command = [args.python, SCRIPT] + FLOWS[flow] + ['-j', str(args.jobs)]
+    if args.bundle:
+        command.append('-b')
+
+    with open(os.path.join(work_dir, 'output.txt'), 'a') as output:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=work_dir, stdout=output,
+                                   stderr=subprocess.STDOUT)
+        # wait4 rather than wait, for the resource usage of this child alone
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.time() - start
+
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return process.returncode, wall_time, usage.ru_maxrss
+
+
+def count_items(flow, corpus):
+    """ Number of items the flow transfers: items sent, or translations published """
+
+    items = len(corpus.categories) + len(corpus.sections) + len(corpus.published_articles())
+    if flow == 'retrieve':
+        items *= len(corpus.zd_locales)
+    return items
+
+
+def measure(flow, run, work_dir, corpus, zendesk, smartling, args):
+
+    zendesk.stats.reset()
+    smartling.stats.reset()
+
+    exit_code, wall_time, peak_rss = run_flow(flow, work_dir, args)
+
+    zendesk_stats = zendesk.stats.snapshot()
+    smartling_stats = smartling.stats.snapshot()
+    requests = zendesk_stats['requests'] + smartling_stats['requests']
+    items = count_items(flow, corpus)
+
+    # Time spent per stage and bytes transferred, as measured by the script itself
+    stages = {}
+    wire_bytes = content_bytes = 0
+    metrics_file = os.path.join(work_dir, 'smartlingzd_metrics.json')
+    if os.path.exists(metrics_file):
+        with io.open(metrics_file, 'rb') as f:
+            script_metrics = json.load(f)
+        for stage in script_metrics['stages']:
+            stages[stage['stage']] = round(stage['seconds'], 3)
+        for call in script_metrics['calls']:
+            wire_bytes += call['bytes_sent'] + call['bytes_received']
+            content_bytes += call.get('bytes_sent_uncompressed', call['bytes_sent']) + \
+                call.get('bytes_received_uncompressed', call['bytes_received'])
+        os.remove(metrics_file)
+
+    return {
+        'flow': flow,
+        'pass': run,
+        'exit_code': exit_code,
+        'wall_time': round(wall_time, 3),
+        'items': items,
+        'requests': requests,
+        'requests_per_second': round(requests / wall_time, 1),
+        'requests_per_item': round(requests / float(items), 2),
+        'peak_rss_kb': peak_rss,
+        'zendesk': zendesk_stats,
+        'smartling': smartling_stats,
+        'stages': stages,
+        'wire_kb': round(wire_bytes / 1024.0, 1),
+        'content_kb': round(content_bytes / 1024.0, 1),
+    }
+
+
+def load_results(file_name):
+    results = []
+    if os.path.exists(file_name):
+        with io.open(file_name, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+
+def find_baseline(results, params):
+    """ Return the last stored run with the same parameters, or None """
+
+    for result in reversed(results):
+        if result['params'] == params:
+            return result
+    return None
+
+
+def change(value, baseline_value):
+    if not baseline_value:
+        return ''
+    return '%+.1f%%' % (100.0 * (value - baseline_value) / baseline_value)
+
+
+def report(result, baseline):
+
+    print
+    print 'Revision %s, %s' % (result['revision'],
+                               ', '.join('%s=%s' % item for item in sorted(result['params'].items())))
+    if baseline is not None:
+        print 'Compared with revision %s at %s' % (baseline['revision'], baseline['date'])
+
+    columns = ('wall_time', 'requests_per_second', 'requests_per_item', 'peak_rss_kb')
+    print
+    print '%-14s %5s %10s %10s %8s %10s %8s %10s %8s %12s %8s' % (
+        'flow', 'exit', 'wall s', '', 'req/s', '', 'req/item', '', 'rss KB', '', 'requests')
+
+    baseline_flows = {}
+    if baseline is not None:
+        baseline_flows = dict(((flow['flow'], flow['pass']), flow)
+                              for flow in baseline['flows'])
+
+    for flow in result['flows']:
+        previous = baseline_flows.get((flow['flow'], flow['pass']), {})
+        cells = []
+        for column in columns:
+            cells += [flow[column], change(flow[column], previous.get(column))]
+        print '%-14s %5s %10.2f %10s %8.1f %10s %8.2f %10s %8d %12s %8d' % tuple(
+            ['%s #%s' % (flow['flow'], flow['pass']), flow['exit_code']] + cells +
+            [flow['requests']])
+
+    for flow in result['flows']:
+        if flow['content_kb']:
+            print '%s #%s: %.1f KB on the wire for %.1f KB of content, %.1f%% saved' % (
+                flow['flow'], flow['pass'], flow['wire_kb'], flow['content_kb'],
+                100.0 * (flow['content_kb'] - flow['wire_kb']) / flow['content_kb'])
+
+    for flow in result['flows']:
+        for service in ('zendesk', 'smartling'):
+            failed = sorted((status, count) for status, count in flow[service]['statuses'].items()
+                            if not status.startswith('2'))
+            if failed:
+                print '%s #%s: %s answered %s' % (flow['flow'], flow['pass'], service, ', '.join(
+                    '%s x %s' % (count, status) for status, count in failed))
+    print
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark smartlingzd.py against '
+                                                 'local Zendesk and Smartling stand-ins')
+    parser.add_argument('--articles', type=int, default=500, help='Number of articles')
+    parser.add_argument('--locales', type=int, default=5, help='Number of locales')
+    parser.add_argument('--jobs', type=int, default=4, help='Value of -j for the script')
+    parser.add_argument('--bundle', action='store_true', help='Run the script with -b')
+    parser.add_argument('--flows', default='translate,retrieve',
+                        help='Comma-separated flows to run, in order')
+    parser.add_argument('--passes', type=int, default=1,
+                        help='Number of times to run the flows, keeping state')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Milliseconds added to every response')
+    parser.add_argument('--jitter', type=float, default=5,
+                        help='Milliseconds of random variation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of requests failing with 503')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='Requests per second allowed by each server, 0 for no limit')
+    parser.add_argument('--burst', type=int, default=None,
+                        help='Requests allowed at once over the rate limit')
+    parser.add_argument('--no-gzip', action='store_true',
+                        help='Let the servers answer uncompressed')
+    parser.add_argument('--compress-uploads', action='store_true',
+                        help='Let the script send uploads to Smartling compressed')
+    parser.add_argument('--debug-files', action='store_true',
+                        help='Let the script write its debug copies of items')
+    parser.add_argument('--archive', action='store_true',
+                        help='Let the script keep its debug copies in a run archive')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Python interpreter to run the script with')
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='File the results are appended to')
+    parser.add_argument('--no-save', action='store_true', help='Don\'t store the results')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the scratch directory with the logs and state')
+    args = parser.parse_args()
+
+    flows = args.flows.split(',')
+    for flow in flows:
+        if flow not in FLOWS:
+            sys.exit('Unknown flow %s, valid flows: %s' % (flow, ', '.join(sorted(FLOWS))))
+
+    params = {
+        'articles': args.articles,
+        'locales': args.locales,
+        'jobs': args.jobs,
+        'bundle': args.bundle,
+        'flows': args.flows,
+        'passes': args.passes,
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'error_rate': args.error_rate,
+        'rate_limit': args.rate_limit,
+        'burst': args.burst,
+        'debug_files': args.debug_files,
+    }
+    # Only when used, so earlier results stay comparable
+    if args.no_gzip:
+        params['gzip'] = False
+    if args.compress_uploads:
+        params['compress_uploads'] = True
+    if args.archive:
+        params['archive'] = True
+
+    work_dir = tempfile.mkdtemp(prefix='smartlingzd-benchmark-')
+    servers = []
+    try:
+        print 'Generating %s articles in %s locales...' % (args.articles, args.locales)
+        corpus = Corpus(args.articles, args.locales)
+
+        def behaviour(seed):
+            return Behaviour(args.latency / 1000.0, args.jitter / 1000.0, args.error_rate,
+                             args.rate_limit, args.burst, seed, not args.no_gzip)
+
+        cert_file, key_file = make_self_signed_cert(work_dir)
+        zendesk = start_fake_zendesk(corpus, behaviour(1))
+        smartling = start_fake_smartling([sl for zd, sl in corpus.locale_mapping],
+                                         behaviour(2), cert_file, key_file)
+        servers = [zendesk, smartling]
+        write_config(work_dir, corpus, zendesk, smartling, cert_file, args)
+
+        result = {
+            'revision': git_revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': args.python,
+            'params': params,
+            'flows': [],
+        }
+
+        for run in range(1, args.passes + 1):
+            for flow in flows:
+                print 'Running %s, pass %s...' % (flow, run)
+                measured = measure(flow, run, work_dir, corpus, zendesk, smartling, args)
+                result['flows'].append(measured)
+                if measured['exit_code'] != 0:
+                    print 'Script failed with exit code %s, see %s' % (
+                        measured['exit_code'], os.path.join(work_dir, 'smartlingzd.log'))
+                    args.keep = True
+
+        baseline = find_baseline(load_results(args.results), params)
+        report(result, baseline)
+
+        if not args.no_save:
+            with io.open(args.results, 'ab') as f:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+            print 'Results appended to %s' % args.results
+
+    finally:
+        for server in servers:
+            server.stop()
+        if args.keep:
+            print 'Scratch directory kept: %s' % work_dir
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+""" Publishing translations to the Zendesk stand-in with a stale TranslationIndex.
+
+A translation created after the index was listed makes the create call fail with
+422, like Zendesk does, and has to be updated instead. zdesk up to 2.6 raises
+ZendeskError for the 422, later versions return the response, both are covered.
+
+    python benchmark/test_translation_index.py
+"""
+
+
+import os
+import sys
+import json
+import unittest
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from zdesk import zdesk
+
+import smartlingzd
+from fakeservers import Corpus, Behaviour, start_fake_zendesk
+
+
+class ReturningZendesk(zdesk.Zendesk):
+    """ zdesk as of 2.7, returning rather than raising 422 responses """
+
+    def call(self, *args, **kwargs):
+        try:
+            return zdesk.Zendesk.call(self, *args, **kwargs)
+        except zdesk.ZendeskError as e:
+            if e.error_code != 422:
+                raise
+            content = json.loads(e.msg)
+            if kwargs.get('complete_response'):
+                return {'response': e.response, 'content': content, 'status': 422}
+            return content
+
+
+class StaleTranslationIndexTest(unittest.TestCase):
+
+    zendesk_class = zdesk.Zendesk
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = Corpus(5, 1)
+        cls.server = start_fake_zendesk(cls.corpus, Behaviour())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.server.state.translations.clear()
+        self.zdapi = self.zendesk_class(self.server.url, 'user@example.com', 'token', True)
+        self.zd_locale = self.corpus.zd_locales[0]
+        self.article_id = self.corpus.articles[0]['id']
+
+    def translation(self, title):
+        return {'locale': self.zd_locale, 'title': title, 'body': '<p>%s</p>' % title}
+
+    def published_title(self):
+        key = ('articles', self.article_id, self.zd_locale)
+        return self.server.state.translations[key]['title']
+
+    def test_create_without_translation(self):
+        index = smartlingzd.TranslationIndex(self.zdapi)
+        smartlingzd.upload_article_translation_to_zendesk(
+            self.article_id, self.zd_locale, self.translation('created'), self.zdapi, index)
+
+        self.assertEqual(self.published_title(), 'created')
+        self.assertTrue(index.exists(smartlingzd.TYPE_ARTICLE, self.article_id,
+                                     self.zd_locale))
+
+    def test_update_when_created_after_listing(self):
+        index = smartlingzd.TranslationIndex(self.zdapi)
+        self.assertFalse(index.exists(smartlingzd.TYPE_ARTICLE, self.article_id,
+                                      self.zd_locale))
+
+        # Someone else publishes the translation after the index was listed
+        self.zdapi.help_center_article_translation_create(self.article_id,
+                                                          self.translation('other'))
+
+        smartlingzd.upload_article_translation_to_zendesk(
+            self.article_id, self.zd_locale, self.translation('ours'), self.zdapi, index)
+
+        self.assertEqual(self.published_title(), 'ours')
+        self.assertTrue(index.exists(smartlingzd.TYPE_ARTICLE, self.article_id,
+                                     self.zd_locale))
+
+
+class StaleTranslationIndexReturningTest(StaleTranslationIndexTest):
+
+    zendesk_class = ReturningZendesk
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,42 +21,98 @@ try:
     import json
 except ImportError:
     import simplejson24 as json
-    
-class Data:
+
+# faster decoder used when installed, the standard one otherwise
+try:
+    from ujson import loads
+except ImportError:
+    try:
+        from simplejson import loads
+    except ImportError:
+        loads = json.loads
+
+
+class Data(object):
     """ provides dictionary items to be object attributes """
+    __slots__ = ('dict',)
+
     def __init__(self, dict):
         self.dict = dict
-        
+
     def __getattr__(self, key):
-        return self.dict[key]
-        
+        try:
+            return self.dict[key]
+        except KeyError:
+            raise AttributeError(key)
+
     def __str__(self):
         return `self.dict`
 
-class ApiResponse:
+
+class ApiResponse(object):
     """ response object to store parsed json response as python object, it also behaves like string for backward 
-        compatibility with previous SDK versions where response was a string """
+        compatibility with previous SDK versions where response was a string
+
+        json is parsed on first access to a response attribute, so responses only checked for
+        status code are never parsed. ujson or simplejson is used for it when installed, another
+        decoder can be set with ApiResponse.use_decoder(loads) """
+    __slots__ = ('status_code', 'response_string', '_response_dict', '_data')
+
+    decode = staticmethod(loads)
+
+    @classmethod
+    def use_decoder(cls, loads):
+        """ sets function parsing json string of all responses """
+        cls.decode = staticmethod(loads)
+
     def __init__(self, response_string, status_code):
         self.status_code = status_code
         self.response_string = response_string
-        self.parse_response(response_string)
-        
-    def parse_response(self, response_string):
-        """ parses json and fills object attributes according json attributes """
-        self.response_dict = json.loads(response_string)
-        #print self.response_dict
-        for k, v in self.response_dict['response'].items():
-            if k=='data':
-                self.data = Data(v)
-            else:
-                setattr(self, k, v)
-    
+        self._response_dict = None
+        self._data = None
+
+    @property
+    def response_dict(self):
+        if self._response_dict is None:
+            self._response_dict = self.decode(self.response_string)
+        return self._response_dict
+
+    def parse_response(self, response_string=None):
+        """ parses json now instead of on first access, returns parsed dictionary """
+        if response_string is not None:
+            self.response_string = response_string
+            self._response_dict = self._data = None
+        return self.response_dict
+
+    @property
+    def data(self):
+        if self._data is None:
+            response = self.response_dict['response']
+            if 'data' not in response:
+                raise AttributeError('data')
+            self._data = Data(response['data'])
+        return self._data
+
     def __getattr__(self, key):
-        """ provides string object methods to be available for response to behave like a string """
-        if hasattr(self.response_string, key):
-            return getattr(self.response_string, key)
-            
-        try:
-            return getattr(self, key)
-        except:
-            return getattr(self.response_string, key)
\ No newline at end of file
+        """ provides json response attributes, and string object methods for response to behave like a string """
+        if not key.startswith('__'):
+            response = self.response_dict['response']
+            if key in response:
+                return response[key]
+        return getattr(self.response_string, key)
+
+    def __iter__(self):
+        # str has no __iter__ to delegate to, it is iterated through __getitem__
+        return iter(self.response_string)
+
+
+def _string_method(name):
+    def method(self, *args):
+        return getattr(self.response_string, name)(*args)
+    method.__name__ = name
+    return method
+
+# special methods are looked up on the type, not through __getattr__
+for _name in ('__str__', '__repr__', '__len__', '__contains__', '__getitem__',
+              '__eq__', '__ne__', '__hash__', '__add__', '__mod__'):
+    setattr(ApiResponse, _name, _string_method(_name))
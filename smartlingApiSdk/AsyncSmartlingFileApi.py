@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+''' Copyright 2012 Smartling, Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this work except in compliance with the License.
+ * You may obtain a copy of the License in the LICENSE file, or at:
+ *
+ * http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+'''
+
+#FileApi class implementation with non-blocking commands
+
+import threading
+from multiprocessing.pool import ThreadPool
+from ConnectionPool import HTTPSConnectionPool
+from SmartlingFileApi import SmartlingFileApi
+
+
+class AsyncSmartlingFileApi(SmartlingFileApi):
+    """ SmartlingFileApi which in addition to blocking commands provides `*_async` versions of them.
+        Async command returns immediately with AsyncResult object, its `get` method waits for
+        the same (response, status_code) tuple the blocking command returns:
+
+        api = AsyncSmartlingFileApi(host, apiKey, projectId, maxInFlight=200)
+        pending = [api.get_async(uri, 'fr-FR') for uri in uris]
+        for result in pending:
+            response, status_code = result.get()
+
+        Up to maxInFlight commands are executed at the same time over the shared pool of
+        keep-alive connections, the rest wait in a queue.
+        Blocking commands are still available so object can be used instead of SmartlingFileApi.
+        """
+    defaultMaxInFlight = 100
+
+    def __init__(self, host, apiKey, projectId, proxySettings=None, connectionPool=None, maxInFlight=None):
+        if maxInFlight is None:
+            maxInFlight = self.defaultMaxInFlight
+        if connectionPool is None:
+            connectionPool = HTTPSConnectionPool(maxInFlight)
+        SmartlingFileApi.__init__(self, host, apiKey, projectId, proxySettings, connectionPool)
+        self.maxInFlight = maxInFlight
+        self.workers = None
+        self.workersLock = threading.Lock()
+
+    def submit(self, command, *args, **kw):
+        """ schedules any blocking command, returns AsyncResult """
+        self.workersLock.acquire()
+        try:
+            if self.workers is None:
+                self.workers = ThreadPool(self.maxInFlight)
+        finally:
+            self.workersLock.release()
+        return self.workers.apply_async(command, args, kw)
+
+    def close(self):
+        """ waits for scheduled commands to finish and stops worker threads """
+        self.workersLock.acquire()
+        try:
+            workers, self.workers = self.workers, None
+        finally:
+            self.workersLock.release()
+        if workers is not None:
+            workers.close()
+            workers.join()
+
+    def upload_async(self, uploadData):
+        """ non-blocking `upload` api command, returns AsyncResult """
+        return self.submit(self.upload, uploadData)
+
+    def list_async(self, **kw):
+        """ non-blocking `list` api command, returns AsyncResult """
+        return self.submit(self.list, **kw)
+
+    def get_async(self, fileUri, locale, **kw):
+        """ non-blocking `get` api command, returns AsyncResult """
+        return self.submit(self.get, fileUri, locale, **kw)
+
+    def download_async(self, fileUri, locale, target, **kw):
+        """ non-blocking `download` api command, returns AsyncResult """
+        return self.submit(self.download, fileUri, locale, target, **kw)
+
+    def status_async(self, fileUri, locale, **kw):
+        """ non-blocking `status` api command, returns AsyncResult """
+        return self.submit(self.status, fileUri, locale, **kw)
+
+    def rename_async(self, fileUri, newUri, **kw):
+        """ non-blocking `rename` api command, returns AsyncResult """
+        return self.submit(self.rename, fileUri, newUri, **kw)
+
+    def delete_async(self, fileUri, **kw):
+        """ non-blocking `delete` api command, returns AsyncResult """
+        return self.submit(self.delete, fileUri, **kw)
+
+    def import_async(self, uploadData, locale, **kw):
+        """ non-blocking `import` api command, returns AsyncResult """
+        return self.submit(self.import_call, uploadData, locale, **kw)
+
+    def last_modified_async(self, fileUri, locale=None, **kw):
+        """ non-blocking `last_modified` api command, returns AsyncResult """
+        return self.submit(self.last_modified, fileUri, locale, **kw)
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+''' Copyright 2012 Smartling, Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this work except in compliance with the License.
+ * You may obtain a copy of the License in the LICENSE file, or at:
+ *
+ * http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+'''
+
+#keep-alive connection pool
+
+import httplib
+import socket
+import threading
+import time
+import zlib
+
+
+class HTTPSConnectionPool:
+    """ thread-safe pool of keep-alive https connections, connections are kept per host
+        (proxy host if proxy is used) and reused by all api commands
+
+        maxSize     - max number of idle connections kept open per host
+        idleTimeout - idle connections older than this number of seconds are closed instead of reused
+        sslContext  - optional ssl.SSLContext used by new connections, e.g. to trust own CA certificate
+
+        gzip encoded responses are decoded, request bodies are gzip compressed on demand
+        """
+    defaultMaxSize = 4
+    defaultIdleTimeout = 30
+    chunkSize = 65536
+    compressMinSize = 1024  # smaller bodies are sent as they are
+    compressLevel = 6
+
+    def __init__(self, maxSize=None, idleTimeout=None, sslContext=None):
+        if maxSize is None:
+            maxSize = self.defaultMaxSize
+        if idleTimeout is None:
+            idleTimeout = self.defaultIdleTimeout
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.sslContext = sslContext
+        self.lock = threading.Lock()
+        self.idle = {}  # host -> list of (connection, last used time)
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def newConnection(self, host):
+        if self.sslContext is not None:
+            return httplib.HTTPSConnection(host, context=self.sslContext)
+        return httplib.HTTPSConnection(host)
+
+    def acquire(self, host):
+        """ returns tuple (connection, is_reused) """
+        expired = []
+        conn = None
+        now = time.time()
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(host, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used > self.idleTimeout:
+                    expired.append(candidate)
+                    continue
+                conn = candidate
+                break
+            self.discarded += len(expired)
+            if conn is not None:
+                self.reused += 1
+            else:
+                self.created += 1
+        finally:
+            self.lock.release()
+
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self.newConnection(host), False
+
+    def release(self, host, conn):
+        """ returns connection back to the pool, closes it if pool is full """
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(host, [])
+            if len(idle) < self.maxSize:
+                idle.append((conn, time.time()))
+                return
+            self.discarded += 1
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def discard(self, conn):
+        self.lock.acquire()
+        try:
+            self.discarded += 1
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def send(self, conn, method, uri, body, headers):
+        """ sends request on connection, connecting it first if needed, returns response """
+        if conn.sock is None:
+            conn.connect()
+            # file-like body is written after the headers, without Nagle's algorithm
+            # it doesn't wait for the server to acknowledge the headers first
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.request(method, uri, body, headers)
+        return conn.getresponse()
+
+    def compressBody(self, body, headers):
+        """ returns tuple (gzip compressed body, headers for it) """
+        compressor = zlib.compressobj(self.compressLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if isinstance(body, str):
+            chunks = [compressor.compress(body)]
+        else:
+            chunks = [compressor.compress(chunk)
+                      for chunk in iter(lambda: body.read(self.chunkSize), '')]
+        chunks.append(compressor.flush())
+        body = ''.join(chunks)
+        headers = dict(headers)
+        headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(body))
+        return body, headers
+
+    def readResponse(self, response, target=None):
+        """ reads response body, decoding gzip content encoding
+            returns tuple (body, bytes received), body is written to target in chunks
+            if target is given, and the number of bytes written is returned instead of it """
+        decoder = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if target is None:
+            data = response.read()
+            if decoder is None:
+                return data, len(data)
+            return decoder.decompress(data) + decoder.flush(), len(data)
+        received = size = 0
+        while True:
+            chunk = response.read(self.chunkSize)
+            if not chunk:
+                break
+            received += len(chunk)
+            if decoder is not None:
+                chunk = decoder.decompress(chunk)
+            target.write(chunk)
+            size += len(chunk)
+        if decoder is not None:
+            chunk = decoder.flush()
+            target.write(chunk)
+            size += len(chunk)
+        return size, received
+
+    def countBytes(self, sent, received, sentContent, receivedContent):
+        """ called after every request with sizes of request and response bodies as sent and
+            received, and before compression and after decoding, override to collect them """
+        pass
+
+    def request(self, host, method, uri, body, headers, target=None, compress=False):
+        """ sends request using pooled connection and reads whole response
+            returns tuple (response_data, status_code)
+
+            if file-like target is given, body of response with status 200 is written to it
+            in chunks instead, and response_data is the number of bytes written
+
+            if compress is true, body of at least compressMinSize bytes is gzip compressed
+
+            if reused connection was closed by server meanwhile request is retried once
+            on a new connection, so file-like body has to support seek(0) """
+        sentContent = len(body) if body else 0
+        if compress and sentContent >= self.compressMinSize:
+            body, headers = self.compressBody(body, headers)
+        conn, is_reused = self.acquire(host)
+        try:
+            response = self.send(conn, method, uri, body, headers)
+        except (httplib.HTTPException, socket.error):
+            self.discard(conn)
+            if not is_reused:
+                raise
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            conn, is_reused = self.newConnection(host), False
+            self.lock.acquire()
+            self.created += 1
+            self.lock.release()
+            try:
+                response = self.send(conn, method, uri, body, headers)
+            except:
+                self.discard(conn)
+                raise
+        try:
+            if response.status != 200:
+                target = None
+            data, received = self.readResponse(response, target)
+        except:
+            self.discard(conn)
+            raise
+        if response.will_close:
+            self.discard(conn)
+        else:
+            self.release(host, conn)
+        self.countBytes(len(body) if body else 0, received, sentContent,
+                        data if target is not None else len(data))
+        return data, response.status
+
+    def closeAll(self):
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, {}
+        finally:
+            self.lock.release()
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+    def stats(self):
+        """ returns dictionary with connection reuse counters """
+        self.lock.acquire()
+        try:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'idle': sum(len(v) for v in self.idle.values()),
+            }
+        finally:
+            self.lock.release()
@@ -19,47 +19,56 @@
 
 #FileApi class implementation
 
-import httplib
+import io
+import os
 import urllib
-import sys, urllib2, base64
-from MultipartPostHandler import MultipartPostHandler
+import base64
+from MultipartPostHandler import MultipartEncoder
 from Constants import Uri, Params, ReqMethod
 from ApiResponse import ApiResponse
+from ConnectionPool import HTTPSConnectionPool
 
 
 
 class FileApiBase:
     """ basic class implementing low-level api calls """
-    headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+    headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain",
+               "Accept-Encoding": "gzip"}
     response_as_string = False
+    compress_uploads = False
 
-    def __init__(self, host, apiKey, projectId, proxySettings=None):
+    def __init__(self, host, apiKey, projectId, proxySettings=None, connectionPool=None):
         self.host = host
         self.apiKey = apiKey
         self.projectId = projectId
         self.proxySettings = proxySettings
+        if connectionPool is None:
+            connectionPool = HTTPSConnectionPool()
+        self.connectionPool = connectionPool
 
     def addApiKeys(self, params):
         params[Params.API_KEY] = self.apiKey
         params[Params.PROJECT_ID] = self.projectId
 
-    def uploadMultipart(self, uri, params):
+    def uploadMultipart(self, uri, params, content=None):
         self.addApiKeys(params)
-        params[Params.FILE] = open(params[Params.FILE_PATH], 'rb')
-        del params[Params.FILE_PATH]  # no need in extra field in POST
-        opener = urllib2.build_opener(MultipartPostHandler)
-        urllib2.install_opener(opener)
+        params.pop(Params.FILE, None)  # replaced by contents of the file at FILE_PATH
+        file_path = params.pop(Params.FILE_PATH)  # no need in extra field in POST
+        if content is None:
+            fd = open(file_path, 'rb')
+        else:
+            fd = io.BytesIO(content)
+        body = MultipartEncoder(params.items(), [(Params.FILE, file_path.split('/')[-1], fd)])
         host = self.getProxyHostAndAddHeaders()
-        req = urllib2.Request('https://' + host + uri, params, headers=self.headers)
+        headers = dict(self.headers)
+        headers["Content-type"] = body.contentType
+        headers["Content-Length"] = str(len(body))
         try:
-            response = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
-            response = e
-        if sys.version_info[:2] >= (2,6):
-            status_code = response.getcode() 
-        else:
-            status_code = 0 #value for python v2.5 and less
-        response_data = response.read().strip()
+            response_data, status_code = self.connectionPool.request(host, ReqMethod.POST, uri, body, headers,
+                                                                     compress=self.compress_uploads)
+        finally:
+            body.close()
+        response_data = response_data.strip()
         if self.response_as_string:
             return response_data, status_code
         return ApiResponse(response_data, status_code), status_code
@@ -76,16 +85,11 @@ class FileApiBase:
             proxy_host += ":%s" % self.proxySettings.port
         return proxy_host
         
-    def command_raw(self, method, uri, params):
+    def command_raw(self, method, uri, params, target=None):
         self.addApiKeys(params)
         host = self.getProxyHostAndAddHeaders()
         params_encoded = urllib.urlencode(params)
-        conn = httplib.HTTPSConnection(host)
-        conn.request(method, uri, params_encoded, self.headers)
-        response = conn.getresponse()
-        data = response.read()
-        conn.close()
-        return data, response.status
+        return self.connectionPool.request(host, method, uri, params_encoded, self.headers, target)
 
     def command(self, method, uri, params):
         data, code = self.command_raw(method, uri, params)
@@ -111,7 +115,7 @@ class FileApiBase:
             for index, directive in enumerate(uploadData.directives):
                 params[directive.sl_prefix + directive.name] = directive.value
 
-        return self.uploadMultipart(Uri.UPLOAD, params)
+        return self.uploadMultipart(Uri.UPLOAD, params, uploadData.content)
 
     def commandList(self, **kw):
         return self.command(ReqMethod.POST, Uri.LIST, kw)
@@ -122,7 +126,7 @@ class FileApiBase:
             kw[Params.LOCALE] = locale
         return self.command(ReqMethod.GET, Uri.LAST_MODIFIED, kw)
         
-    def commandGet(self, fileUri, locale, **kw):
+    def getParams(self, fileUri, locale, kw):
         kw[Params.FILE_URI] = fileUri
         if locale is not '':
             kw[Params.LOCALE] = locale
@@ -130,8 +134,26 @@ class FileApiBase:
             raise "Not allowed value `%s` for parameter:%s try one of %s" % (kw[Params.RETRIEVAL_TYPE],
                                                                              Params.RETRIEVAL_TYPE,
                                                                              Params.allowedRetrievalTypes)
+        return kw
 
-        return self.command_raw(ReqMethod.POST, Uri.GET, kw)
+    def commandGet(self, fileUri, locale, **kw):
+        return self.command_raw(ReqMethod.POST, Uri.GET, self.getParams(fileUri, locale, kw))
+
+    def commandDownload(self, fileUri, locale, target, **kw):
+        params = self.getParams(fileUri, locale, kw)
+        if not isinstance(target, basestring):
+            data, code = self.command_raw(ReqMethod.POST, Uri.GET, params, target)
+        else:
+            fd = open(target, 'wb')
+            try:
+                data, code = self.command_raw(ReqMethod.POST, Uri.GET, params, fd)
+            finally:
+                fd.close()
+            if code != 200:
+                os.remove(target)
+        if code == 200 or self.response_as_string:
+            return data, code
+        return ApiResponse(data, code), code
 
     def commandDelete(self, fileUri, **kw):
         kw[Params.FILE_URI] = fileUri
@@ -146,7 +168,7 @@ class FileApiBase:
         kw[Params.LOCALE] = locale
         self.addApiKeys(kw)
 
-        return self.uploadMultipart(Uri.IMPORT, kw)
+        return self.uploadMultipart(Uri.IMPORT, kw, uploadData.content)
 
     def commandStatus(self, fileUri, locale, **kw):
         kw[Params.FILE_URI] = fileUri
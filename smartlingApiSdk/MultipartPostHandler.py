@@ -19,6 +19,7 @@
 
 import mimetools
 import mimetypes
+import os
 import sys
 import urllib
 import urllib2
@@ -29,6 +30,97 @@ class Callable:
         self.__call__ = anycallable
 
 
+def encodeUtf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class MultipartEncoder:
+    """ file-like multipart/form-data body, parts are produced on demand by `read`
+        so file contents are never copied into one big string
+
+        vars  - list of (key, value) form fields
+        files - list of (key, file object) or (key, filename, file object), file objects
+                have to be seekable, they are closed by `close`
+        """
+    chunkSize = 64 * 1024
+
+    def __init__(self, vars, files, boundary=None):
+        if boundary is None:
+            boundary = mimetools.choose_boundary()
+        self.boundary = boundary
+        self.contentType = 'multipart/form-data; boundary=%s' % boundary
+        self.files = []
+        self.parts = []
+        # header parts are utf-8 byte strings, file parts are told apart by having read
+        for(key, value) in vars:
+            self.parts.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                              % (boundary, encodeUtf8(key), encodeUtf8(value)))
+        for file_spec in files:
+            if len(file_spec) == 3:
+                key, filename, fd = file_spec
+            else:
+                key, fd = file_spec
+                filename = fd.name.split('/')[-1]
+            contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            self.parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                              'Content-Type: %s\r\n\r\n' % (boundary, encodeUtf8(key),
+                                                               encodeUtf8(filename), contenttype))
+            self.parts.append(fd)
+            self.parts.append('\r\n')
+            self.files.append(fd)
+        self.parts.append('--%s--\r\n\r\n' % boundary)
+        self.length = int(sum(self.partLength(part) for part in self.parts))
+        self.seek(0)
+
+    def partLength(self, part):
+        if not hasattr(part, 'read'):
+            return len(part)
+        try:
+            return os.fstat(part.fileno()).st_size
+        except (AttributeError, IOError, OSError):
+            part.seek(0, 2)
+            return part.tell()
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        """ only rewinding is supported, needed to resend body on a new connection """
+        if offset != 0 or whence != 0:
+            raise IOError("MultipartEncoder can only be rewound")
+        self.partIndex = 0
+        self.partOffset = 0
+        for fd in self.files:
+            fd.seek(0)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(self.chunkSize), ''))
+        chunks = []
+        while size > 0 and self.partIndex < len(self.parts):
+            part = self.parts[self.partIndex]
+            if not hasattr(part, 'read'):
+                chunk = part[self.partOffset:self.partOffset + size]
+                self.partOffset += len(chunk)
+                if self.partOffset >= len(part):
+                    self.partIndex += 1
+                    self.partOffset = 0
+            else:
+                chunk = part.read(size)
+                if not chunk:
+                    self.partIndex += 1
+                    continue
+            size -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        for fd in self.files:
+            fd.close()
+
+
 class MultipartPostHandler(urllib2.BaseHandler):
     """ handler for multipart HTTP POST, helper object to provide POST functionality """
 
@@ -67,24 +159,10 @@ class MultipartPostHandler(urllib2.BaseHandler):
         return request
 
     def multipart_encode(vars, files, boundary=None, buffer=None):
-        if boundary is None:
-            boundary = mimetools.choose_boundary()
+        encoder = MultipartEncoder(vars, files, boundary)
         if buffer is None:
             buffer = ''
-        for(key, value) in vars:
-            buffer += '--%s\r\n' % boundary
-            buffer += 'Content-Disposition: form-data; name="%s"' % key
-            buffer += '\r\n\r\n' + value + '\r\n'
-        for(key, fd) in files:
-            filename = fd.name.split('/')[-1]
-            contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-            buffer += '--%s\r\n' % boundary
-            buffer += 'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename)
-            buffer += 'Content-Type: %s\r\n' % contenttype
-            fd.seek(0)
-            buffer += '\r\n' + fd.read() + '\r\n'
-        buffer += '--%s--\r\n\r\n' % boundary
-        return boundary, buffer
+        return encoder.boundary, buffer + encoder.read()
     multipart_encode = Callable(multipart_encode)
 
     https_request = http_request
@@ -28,14 +28,24 @@ class SmartlingFileApi(FileApiBase):
         where response is ApiResponse object and status code = HTTP response status code
         
         ApiResponse object is python object as a result of json response parsing
-        ApiResponse attributes depend on response json.
+        ApiResponse attributes depend on response json, which is parsed on first attribute access.
         To view all attributes of response use:
-        for k,v in response.items(): print k, ':' ,v
+        for k,v in response.response_dict['response'].items(): print k, ':' ,v
         
         Response also can be a string to provide backward compatibility with previous versions
         in case you need json response as a string use :
         api = SmartlingFileApi(host, apiKey, projectId)
         api.response_as_string = True
+
+        Responses are requested gzip compressed, uploaded files can be sent compressed too
+        if the server accepts gzip request bodies:
+        api.compress_uploads = True
+
+        All commands share a pool of keep-alive connections, pass own HTTPSConnectionPool
+        to control pool size and idle timeout or to share connections between api objects:
+        pool = HTTPSConnectionPool(maxSize=8, idleTimeout=60)
+        api = SmartlingFileApi(host, apiKey, projectId, connectionPool=pool)
+        print pool.stats()
         
         Some of methods may be called with optional parameters
         like `list` method may have locale optional parameter or offset parameter
@@ -45,13 +55,13 @@ class SmartlingFileApi(FileApiBase):
              api.list(locale='es-ES', offset=50)
         """
 
-    def __init__(self, host, apiKey, projectId, proxySettings=None):
-        FileApiBase.__init__(self, host, apiKey, projectId, proxySettings)
+    def __init__(self, host, apiKey, projectId, proxySettings=None, connectionPool=None):
+        FileApiBase.__init__(self, host, apiKey, projectId, proxySettings, connectionPool)
 
     def upload(self, uploadData):
         """ implements `upload` api command
             returns (response, status_code) tuple
-            for python 2.5 and less commands `upload` and `import_call` returns status_code 0
+            file contents may be given in memory with uploadData.setContent instead of a file on disk
             for details on `upload` command see  https://docs.smartling.com/display/docs/Files+API#FilesAPI-/file/upload%28POST) """
         return self.commandUpload(uploadData)
 
@@ -67,6 +77,14 @@ class SmartlingFileApi(FileApiBase):
             for details on `get` command see https://docs.smartling.com/display/docs/Files+API#FilesAPI-/file/list%28GET%29 """
         return self.commandGet(fileUri, locale, **kw)
 
+    def download(self, fileUri, locale, target, **kw):
+        """ implements `get` api command writing file to target instead of returning it,
+            target is file name or file-like object, file is written in chunks as it is received
+            returns (response, status_code) tuple, where response is number of bytes written
+            if status_code is 200, otherwise error response, which is not written to target
+            takes the same parameters as `get` """
+        return self.commandDownload(fileUri, locale, target, **kw)
+
     def status(self, fileUri, locale, **kw):
         """ implements `status` api command
             returns (response, status_code) tuple
@@ -88,7 +106,7 @@ class SmartlingFileApi(FileApiBase):
     def import_call(self, uploadData, locale, **kw):
         """ implements `import` api command
             returns (response, status_code) tuple
-            for python 2.5 and less commands `upload` and `import_call` returns status_code 0
+            file contents may be given in memory with uploadData.setContent instead of a file on disk
             for details on `import` command see https://docs.smartling.com/display/docs/Files+API#FilesAPI-/file/import%28POST%29 """
         return self.commandImport(uploadData, locale, **kw)
         
@@ -96,7 +114,7 @@ class SmartlingFileApi(FileApiBase):
         """ implements `last_modified` api command
             returns (response, status_code) tuple
             for details on `last_modified` command see https://docs.smartling.com/display/docs/Files+API#FilesAPI-/file/last_modified%28GET%29 """
-        return self.commandLastModified(fileUri, **kw)
+        return self.commandLastModified(fileUri, locale, **kw)
     
 
 class SmartlingFileApiFactory:
@@ -104,13 +122,13 @@ class SmartlingFileApiFactory:
     sandbox_host = 'sandbox-api.smartling.com'
     api_host = 'api.smartling.com'
 
-    def getSmartlingTranslationApi(self, productionMode, apiKey, projectId, proxySettings=None):
+    def getSmartlingTranslationApi(self, productionMode, apiKey, projectId, proxySettings=None, connectionPool=None):
         if (productionMode):
-            return SmartlingFileApi(self.api_host, apiKey, projectId, proxySettings)
-        return SmartlingFileApi(self.sandbox_host, apiKey, projectId, proxySettings)
+            return SmartlingFileApi(self.api_host, apiKey, projectId, proxySettings, connectionPool)
+        return SmartlingFileApi(self.sandbox_host, apiKey, projectId, proxySettings, connectionPool)
 
-    def getSmartlingTranslationApiProd(self, apiKey, projectId, proxySettings=None):
-        return SmartlingFileApi(self.api_host, apiKey, projectId, proxySettings)
+    def getSmartlingTranslationApiProd(self, apiKey, projectId, proxySettings=None, connectionPool=None):
+        return SmartlingFileApi(self.api_host, apiKey, projectId, proxySettings, connectionPool)
 
 class ProxySettings:
     """ settings for http proxy to be used to pass api requests, !!! Only basic authentication is supported for restricted proxy access !!! """
@@ -21,9 +21,11 @@
 
 
 class UploadData:
-    """ Helper class to store `upload` and `import` command attributes """
+    """ Helper class to store `upload` and `import` command attributes
+        file is read from path + name unless its contents are given with setContent """
     approveContent = "false"
     callbackUrl = ""
+    content = None
 
     def __init__(self, path, name, type, uri):
         self.path = path
@@ -42,4 +44,10 @@ class UploadData:
         self.directives.append(directive)
 
     def setUri(self, uri):
-        self.uri = uri
\ No newline at end of file
+        self.uri = uri
+
+    def setContent(self, content):
+        """ in-memory file contents, unicode is sent utf-8 encoded """
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        self.content = content
\ No newline at end of file
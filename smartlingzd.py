@@ -49,18 +49,36 @@ import sys
 import io
 import json
 import re
-import lxml.html
 import argparse
+import base64
+import bisect
+import contextlib
+import gzip
+import hmac
 import logging
+import Queue
+import random
 import shutil
-from urlparse import urlsplit
+import signal
+import ssl
+import threading
+import time
+import calendar
+import hashlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+from urlparse import urlsplit, parse_qsl
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 from ConfigParser import SafeConfigParser, Error
 
 from zdesk import zdesk
 
 lib_path = os.path.abspath('../')
 sys.path.append(lib_path)  # allow to import ../smartlingApiSdk/SmartlingFileApi
-from smartlingApiSdk.SmartlingFileApi import SmartlingFileApiFactory
+from smartlingApiSdk.SmartlingFileApi import SmartlingFileApi, SmartlingFileApiFactory
+from smartlingApiSdk.ConnectionPool import HTTPSConnectionPool
 from smartlingApiSdk.SmartlingDirective import SmartlingDirective
 from smartlingApiSdk.UploadData import UploadData
 
@@ -81,6 +99,11 @@ ZD_SOURCE_LOCALE = 'en-us'
 # Hard-code for now. Perhaps should be in config file.
 SL_INCLUDE_ORIGINAL_STRINGS = True
 
+# Smartling list API returns items in 500-entry pages. At least SL_LIST_JOBS pages are
+# fetched in parallel.
+SL_LIST_PAGE_SIZE = 500
+SL_LIST_JOBS = 4
+
 # The items in Zendesk to be translated
 TYPE_CATEGORY = 'category'
 TYPE_SECTION = 'section'
@@ -104,6 +127,76 @@ LOGGING_LEVELS = {
 SOURCE_DIR = 'sourcefromzd'
 TRANSLATION_DIR = 'translationsfromsl'
 
+# Whether the debugging copies above are written at all. Loaded from config file.
+write_debug_files = True
+
+# Instead of the directories above, the debugging copies can be kept in one compressed
+# archive per run in ARCHIVE_DIR, see RunArchive. Set in main when enabled in the 
+# config file.
+ARCHIVE_DIR = 'archive'
+ARCHIVE_QUEUE_SIZE = 1000
+ARCHIVE_FLUSH_INTERVAL = 5
+run_archive = None
+
+# Directory for state persisted between runs, such as the time of the last incremental
+# transfer of each item type.
+STATE_DIR = 'state'
+SYNC_MARKS_FILE = 'sync_marks.json'
+FINGERPRINTS_FILE = 'fingerprints.json'
+LAST_APPLIED_FILE = 'last_applied.json'
+ATTACHMENTS_FILE = 'attachments.json'
+BUNDLES_FILE = 'bundles.json'
+JOURNAL_FILE = 'journal-%s.jsonl'  # per direction, translate or retrieve
+
+# In bundle mode, items are packed into Smartling files of up to this many bytes. 
+# Loaded from config file.
+bundle_max_bytes = 500000
+
+# Whether article attachment lists are kept in STATE_DIR between runs. Loaded from 
+# config file.
+persist_attachment_cache = False
+
+# URL Smartling calls when an uploaded file is fully published in a locale, handled
+# by the daemon (-d). Loaded from config file.
+sl_callback_url = None
+
+# How often, in seconds, the daemon saves its state and metrics
+DAEMON_CHECKPOINT_INTERVAL = 60
+
+# Zendesk incremental export returns up to this many items per page
+ZD_INCREMENTAL_PAGE_SIZE = 1000
+
+# Articles included by ID in translate.cfg are fetched one by one, unless there are more
+# than this many, when listing all articles is likely quicker
+ZD_MAX_ARTICLE_SHOWS = 500
+
+# Items per page requested from Zendesk list calls with cursor pagination, the most
+# Zendesk allows
+ZD_LIST_PAGE_SIZE = 100
+
+# Zendesk list call path and the key of the items in its pages, per item type 
+ZD_LIST_CALLS = {
+    TYPE_ARTICLE: ('/api/v2/help_center/%s/articles.json', 'articles'),
+    TYPE_SECTION: ('/api/v2/help_center/%s/sections.json', 'sections'),
+    TYPE_CATEGORY: ('/api/v2/help_center/%s/categories.json', 'categories'),
+}
+
+# Statuses of API calls which are retried: rate limited, or temporarily unavailable
+RETRY_STATUSES = (429, 503)
+
+# Longest wait in seconds before retrying a call, when the API doesn't say how long 
+RETRY_MAX_BACKOFF = 60
+
+# Weights of the latest call in the short and long-term average latencies of a service,
+# and how far above the long-term average the short-term one may go before the 
+# concurrency limit is lowered
+LATENCY_SHORT_WEIGHT = 0.2
+LATENCY_LONG_WEIGHT = 0.02
+LATENCY_TOLERANCE = 2.0
+
+# Upper bounds, in seconds, of the buckets of the API call latency histograms
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
 
 class SmartlingError(Exception):
     def __init__(self, msg, code, response):
@@ -115,219 +208,897 @@ class SmartlingError(Exception):
         return repr('%s: %s %s' % (self.error_code, self.msg, self.response))
 
 
-def fix_image_link(element, url, locale, article_attachments):
-    """ Modifies image URL to point to the localised version.
+class RateLimitScheduler(object):
+    """ Decides when calls to one service may go ahead.
+
+    A call needs a free slot under the concurrency limit and, if a rate is given, 
+    a token from a bucket refilled at rate tokens per second, holding up to burst. 
+    When the service answers that it is rate limited, all calls are held back for 
+    the Retry-After time, or an exponential backoff without one.
+
+    The concurrency limit is tuned AIMD style, between 1 and max_concurrency: it is 
+    halved when a call is rate limited, cut by a quarter when latency rises well above
+    its long-term average, and otherwise raised by one after each window of as many 
+    calls as the limit. A limit is lowered at most once for the calls in flight.
+    """
+
+    def __init__(self, service, max_concurrency, rate=None, burst=None):
+        self.service = service
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.window = 0
+        self.condition = threading.Condition()
+
+        self.rate = rate
+        self.burst = burst or rate or 0
+        self.tokens = self.burst
+        self.refilled = time.time()
+        self.paused_until = 0
+
+        self.latency = None            # short and long-term average call latency
+        self.average_latency = None
+
+        self.rate_limited = 0
+        self.lowest_limit = self.limit
+
+    def take_token(self, now):
+        """ Return 0 if a token was taken, or the seconds until there is one """
+
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """ Wait until a call may go ahead """
+
+        with self.condition:
+            while True:
+                now = time.time()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.in_flight >= int(self.limit):
+                        wait = None  # until a call finishes
+                    else:
+                        wait = self.take_token(now)
+                        if not wait:
+                            self.in_flight += 1
+                            return
+                self.condition.wait(wait)
+
+    def decrease(self, factor):
+        self.limit = max(1.0, self.limit * factor)
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+        # Outcomes of the calls already in flight don't count towards the next change
+        self.window = -self.in_flight
+
+    def release(self, seconds, retry_after=None):
+        """ Record the outcome of a call: its latency, and if the service rate limited
+        it, how many seconds to hold back calls for. """
+
+        with self.condition:
+            self.in_flight -= 1
+
+            if retry_after is not None:
+                self.rate_limited += 1
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+                if self.window >= 0:
+                    self.decrease(0.5)
+
+            else:
+                if self.latency is None:
+                    self.latency = self.average_latency = seconds
+                self.latency += (seconds - self.latency) * LATENCY_SHORT_WEIGHT
+                self.average_latency += (seconds - self.average_latency) * LATENCY_LONG_WEIGHT
+
+                self.window += 1
+                if self.window >= self.limit:
+                    if self.latency > self.average_latency * LATENCY_TOLERANCE:
+                        self.decrease(0.75)
+                    else:
+                        self.window = 0
+                        self.limit = min(self.max_concurrency, self.limit + 1)
 
-    Given an image URL contains a substring indicating that it should be
-    localised, then replace that substring its localised counterpart.
+            self.condition.notify_all()
 
-    The change is made directly in the passed-in HTML element rather than
-    returning a copy.
 
-    Because Zendesk assigns a new ID to each uploaded image, it's necessary
-    to find the correct ID to include in the URL. This is done by searching
-    through the article attachments for one that matches the name of the 
-    localised image, and then using the URL of that attachment. 
-    If the localised version is not found the link is left unchanged.
+class ThrottledApi(object):
+    """ Proxy to the Zendesk or Smartling API scheduling every call.
+
+    Each method call on the wrapped API goes ahead when the RateLimitScheduler of the
+    service allows it. Calls the service rate limits are retried, up to max_retries 
+    times. get_retry_after(result, error) tells them apart: it returns None for calls 
+    that weren't rate limited, otherwise the Retry-After seconds, or 0 if not known.
     """
 
-    image_file_name = urlsplit(url).path.split('/')[-1]
+    def __init__(self, api, scheduler, get_retry_after, max_retries=5):
+        self._api = api
+        self._scheduler = scheduler
+        self._get_retry_after = get_retry_after
+        self._max_retries = max_retries
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            scheduler = self._scheduler
+            for attempt in range(self._max_retries + 1):
+
+                with metrics.stage('throttled_' + scheduler.service):
+                    scheduler.acquire()
 
-    # Derive the localised image name. For example, change 'a_en-us.jpg' to 'a_fr.jpg'    
-    # TODO externalise the '_en-us' bit
-    new_image_file_name = re.sub(r'_en-us\.(...)',           
-                                 '_' + locale + r'.\1',  
-                                 image_file_name)
+                start = time.time()
+                result, exc_info = None, None
+                try:
+                    result = attr(*args, **kwargs)
+                except Exception:
+                    exc_info = sys.exc_info()
 
-    # Search for the localised image, and use it's URL.
-    found = False
-    for attachment in article_attachments:
-        if attachment['file_name'] == new_image_file_name:
-            element.set('src', attachment['content_url'])
-            found = True
+                retry_after = self._get_retry_after(result, exc_info and exc_info[1])
+                if retry_after == 0:
+                    retry_after = random.uniform(0.5, 1) * min(RETRY_MAX_BACKOFF, 2 ** attempt)
+                scheduler.release(time.time() - start, retry_after)
 
-    if not found:
-        logging.warn('No %s version of image found for %s', locale, image_file_name)
+                if retry_after is None or attempt == self._max_retries:
+                    break
 
+                logging.warn('%s rate limited %s, retrying in %.1fs', 
+                             scheduler.service, name, retry_after)
 
-def fix_anchor_link(element, url, locale):
-    """ Modify anchor URL to point to translated version of page.
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return result
 
-    Given an anchor URL replace a path component which contains the source
-    locale with the localised equivalent. For example, substitues occurrence 
-    of '/en-us/' with '/fr/'
+        return call
 
-    The change is made directly in the passed in HTML element rather than 
-    returning a copy.
+
+def get_retry_after_header(response):
+    """ Return the Retry-After of a zdesk error response, 0 if there is none. The 
+    response is a requests response, or a dictionary for zdesk versions using httplib2. 
     """
 
-    # TODO only do it for help-center links
-    element.set('href', re.sub('/' + ZD_SOURCE_LOCALE + '/', 
-                               '/' + locale + '/',            
-                               url))
+    headers = getattr(response, 'headers', response)
+    try:
+        return max(0.0, float(headers.get('Retry-After') or headers.get('retry-after')))
+    except (AttributeError, TypeError, ValueError):
+        return 0
 
 
-def fix_article_links(article_id, body, locale, zdapi):
-    """ Replace links in article body with localised versions.
+def get_zendesk_retry_after(result, error):
+    if isinstance(error, zdesk.ZendeskError) and error.error_code in RETRY_STATUSES:
+        return get_retry_after_header(error.response)
+    return None
 
-    Returns:
-        Modified body string
+
+def get_smartling_retry_after(result, error):
+    # The SDK doesn't expose response headers, so the backoff is always used
+    if error is None and isinstance(result, tuple) and len(result) == 2 \
+            and result[1] in RETRY_STATUSES:
+        return 0
+    return None
+
+
+class WorkUnitLogFilter(logging.Filter):
+    """ Holds back log records of a work unit running in a worker thread.
+
+    The held records are replayed by the main thread once the unit is done, so the 
+    log of each unit stays together and units are logged in order.
     """
 
-    logging.debug('Fixing links for article %s', article_id)
+    _local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    def run(self, func, unit):
+        """ Run func(*unit), returning the held log records and exception info. """
+        self._local.records = []
+        try:
+            func(*unit)
+            return self._local.records, None
+        except Exception:
+            return self._local.records, sys.exc_info()
+        finally:
+            self._local.records = None
+
+
+work_unit_log_filter = WorkUnitLogFilter()
 
-    fixed_body = body
 
-    # Article attachment list is needed for localising the image links.
+def run_work_units(func, units, jobs):
+    """ Call func(*unit) for each unit, in a pool of up to jobs threads.
+
+    Log records are emitted per unit, in the order of units. The first exception 
+    raised by a unit is re-raised once the records of that unit have been logged.
+    """
+
+    if jobs <= 1:
+        for unit in units:
+            func(*unit)
+        return
+
+    pool = ThreadPool(jobs)
     try:
-        attachments = zdapi.help_center_article_attachments(article_id)['article_attachments']  
+        for records, exc_info in pool.imap(lambda unit: work_unit_log_filter.run(func, unit), 
+                                           units):
+            for record in records:
+                logging.getLogger().handle(record)
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class Metrics(object):
+    """ Instrumentation of a run: API calls per service and endpoint, and pipeline stages.
+
+    For every endpoint the number of calls, failed calls, bytes sent and received and
+    a histogram of call latencies over LATENCY_BUCKETS are kept. Bytes are counted both
+    as they went over the wire and uncompressed, to show what compression saves. For every stage, the 
+    number of times it ran and the time spent in it. Stages may be nested, e.g. 
+    fix_links runs within construct, and with several jobs the time of a stage is
+    summed over all threads.
+    """
 
-    except zdesk.ZendeskError as e: 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self.start_time = time.time()
+        self.calls = {}
+        self.stages = {}
+
+    def begin_call(self):
+        self._local.bytes = [0, 0, 0, 0]
+
+    def add_bytes(self, sent, received, sent_uncompressed=None, received_uncompressed=None):
+        """ Count bytes towards the call in progress in this thread, if any. The 
+        uncompressed sizes default to the sizes on the wire. """
+
+        counted = getattr(self._local, 'bytes', None)
+        if counted is not None:
+            counted[0] += sent
+            counted[1] += received
+            counted[2] += sent if sent_uncompressed is None else sent_uncompressed
+            counted[3] += received if received_uncompressed is None else received_uncompressed
+
+    def end_call(self, service, endpoint, seconds, error):
+        sent, received, sent_uncompressed, received_uncompressed = self._local.bytes
+        self._local.bytes = None
+
+        with self.lock:
+            call = self.calls.get((service, endpoint))
+            if call is None:
+                call = self.calls[(service, endpoint)] = {
+                    'count': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                    'bytes_sent_uncompressed': 0, 'bytes_received_uncompressed': 0,
+                    'seconds': 0.0, 'max_seconds': 0.0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+            call['count'] += 1
+            call['errors'] += int(error)
+            call['bytes_sent'] += sent
+            call['bytes_received'] += received
+            call['bytes_sent_uncompressed'] += sent_uncompressed
+            call['bytes_received_uncompressed'] += received_uncompressed
+            call['seconds'] += seconds
+            call['max_seconds'] = max(call['max_seconds'], seconds)
+            call['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time the body of a with statement as stage name """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0})
+                stage['count'] += 1
+                stage['seconds'] += seconds
+
+    @staticmethod
+    def percentile_bound(buckets, fraction):
+        """ Return the upper bound of the bucket holding the given fraction of calls """
+
+        threshold = fraction * sum(buckets)
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), buckets):
+            total += count
+            if total >= threshold:
+                return bound
+        return None
+
+    def summary(self):
+        """ Return the lines of a table summarising the run """
+
+        with self.lock:
+            calls = sorted(self.calls.items())
+            stages = sorted(self.stages.items(), key=lambda item: -item[1]['seconds'])
+
+        lines = ['Run summary, %.1fs' % (time.time() - self.start_time),
+                 '%-10s %-45s %7s %6s %9s %9s %9s %8s %8s %8s' % (
+                     'service', 'endpoint', 'calls', 'errors', 'KB sent', 'KB recv', 
+                     'total s', 'mean ms', 'p95 ms', 'max ms')]
+        for (service, endpoint), call in calls:
+            p95 = self.percentile_bound(call['buckets'], 0.95)
+            lines.append('%-10s %-45s %7d %6d %9.1f %9.1f %9.2f %8.1f %8s %8.1f' % (
+                service, endpoint, call['count'], call['errors'], 
+                call['bytes_sent'] / 1024.0, call['bytes_received'] / 1024.0,
+                call['seconds'], 1000 * call['seconds'] / call['count'],
+                '<=%d' % (1000 * p95) if p95 is not None else '>%d' % (1000 * LATENCY_BUCKETS[-1]),
+                1000 * call['max_seconds']))
+
+        # What compression saved per service, over both directions
+        services = {}
+        for (service, endpoint), call in calls:
+            totals = services.setdefault(service, [0, 0])
+            totals[0] += call['bytes_sent'] + call['bytes_received']
+            totals[1] += call['bytes_sent_uncompressed'] + call['bytes_received_uncompressed']
+        for service, (wire, uncompressed) in sorted(services.items()):
+            if uncompressed:
+                lines.append('%-10s %.1f KB on the wire for %.1f KB of content, %.1f%% saved '
+                             'by compression' % (service, wire / 1024.0, uncompressed / 1024.0,
+                                                 100.0 * (uncompressed - wire) / uncompressed))
+
+        lines.append('%-20s %7s %9s %8s' % ('stage', 'count', 'total s', 'mean ms'))
+        for name, stage in stages:
+            lines.append('%-20s %7d %9.2f %8.1f' % (name, stage['count'], stage['seconds'], 
+                                                    1000 * stage['seconds'] / stage['count']))
+        return lines
+
+    def to_dict(self, succeeded):
+        """ Return the metrics as a JSON-serializable dictionary """
+
+        with self.lock:
+            calls = []
+            for (service, endpoint), call in sorted(self.calls.items()):
+                call = dict(call, service=service, endpoint=endpoint)
+                call['buckets'] = [[bound, count] for bound, count 
+                                   in zip(LATENCY_BUCKETS + ('+Inf',), call['buckets'])]
+                calls.append(call)
+            stages = [dict(stage, stage=name) for name, stage in sorted(self.stages.items())]
+
+        return {
+            'start_time': self.start_time,
+            'duration': time.time() - self.start_time,
+            'succeeded': succeeded,
+            'calls': calls,
+            'stages': stages,
+        }
+
+    def to_prometheus(self, succeeded):
+        """ Return the metrics in the Prometheus text exposition format """
+
+        data = self.to_dict(succeeded)
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP smartlingzd_%s %s' % (name, help_text))
+            lines.append('# TYPE smartlingzd_%s %s' % (name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, str(val).replace('\\', '\\\\')
+                                                                .replace('"', '\\"'))
+                                      for key, val in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append('smartlingzd_%s%s%s %s' % (name, suffix, label_text, value))
+
+        def call_labels(call):
+            return [('service', call['service']), ('endpoint', call['endpoint'])]
+
+        calls = data['calls']
+        metric('api_calls_total', 'counter', 'API calls by service and endpoint',
+               [('', call_labels(call), call['count']) for call in calls])
+        metric('api_errors_total', 'counter', 'Failed API calls by service and endpoint',
+               [('', call_labels(call), call['errors']) for call in calls])
+        metric('api_sent_bytes_total', 'counter', 'Bytes sent by service and endpoint',
+               [('', call_labels(call), call['bytes_sent']) for call in calls])
+        metric('api_received_bytes_total', 'counter', 
+               'Bytes received by service and endpoint',
+               [('', call_labels(call), call['bytes_received']) for call in calls])
+        metric('api_sent_uncompressed_bytes_total', 'counter', 
+               'Bytes sent by service and endpoint, before compression',
+               [('', call_labels(call), call['bytes_sent_uncompressed']) for call in calls])
+        metric('api_received_uncompressed_bytes_total', 'counter', 
+               'Bytes received by service and endpoint, after decompression',
+               [('', call_labels(call), call['bytes_received_uncompressed']) for call in calls])
+
+        samples = []
+        for call in calls:
+            cumulative = 0
+            for bound, count in call['buckets']:
+                cumulative += count
+                samples.append(('_bucket', call_labels(call) + [('le', bound)], cumulative))
+            samples.append(('_sum', call_labels(call), call['seconds']))
+            samples.append(('_count', call_labels(call), call['count']))
+        metric('api_call_duration_seconds', 'histogram', 'API call latency', samples)
+
+        metric('stage_seconds_total', 'counter', 'Time spent per pipeline stage',
+               [('', [('stage', stage['stage'])], stage['seconds']) 
+                for stage in data['stages']])
+        metric('stage_runs_total', 'counter', 'Times each pipeline stage ran',
+               [('', [('stage', stage['stage'])], stage['count']) 
+                for stage in data['stages']])
+
+        metric('run_duration_seconds', 'gauge', 'Duration of the last run', 
+               [('', [], data['duration'])])
+        metric('run_succeeded', 'gauge', 'Whether the last run succeeded', 
+               [('', [], int(succeeded))])
+        metric('run_start_time_seconds', 'gauge', 'Start time of the last run', 
+               [('', [], data['start_time'])])
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class InstrumentedApi(object):
+    """ Proxy to the Zendesk or Smartling API recording every call in metrics.
+
+    Calls are recorded by method name, except generic zdesk call() requests which
+    are recorded by path with IDs replaced by {id}. A call fails if it raises, or
+    for Smartling, if it returns a status other than 200.
+    """
 
-        if e.error_code == 404:
-            # uncommon situation - original article no longer exists so do nothing
-            logging.info('Source article %s gone, skip link fixing...', article_id)
+    ID_RE = re.compile(r'/\d+(?=[/.])')
+
+    def __init__(self, api, service):
+        self._api = api
+        self._service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            endpoint = name
+            if name == 'call' and args:
+                endpoint = self.ID_RE.sub('/{id}', args[0])
+
+            error = True
+            metrics.begin_call()
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+                error = isinstance(result, tuple) and len(result) == 2 \
+                    and isinstance(result[1], int) and result[1] != 200
+                return result
+            finally:
+                metrics.end_call(self._service, endpoint, time.time() - start, error)
+
+        return call
+
+
+class MeteredConnectionPool(HTTPSConnectionPool):
+    """ Pool of Smartling connections counting request and response sizes in metrics """
+
+    def countBytes(self, sent, received, sentContent, receivedContent):
+        metrics.add_bytes(sent, received, sentContent, receivedContent)
+
+
+def count_zendesk_bytes(response, *args, **kwargs):
+    """ requests response hook counting Zendesk request and response sizes in metrics """
+
+    # requests asks for gzip and decodes it, the raw stream tells what was received
+    content = response.content
+    try:
+        received = response.raw.tell() or len(content)
+    except AttributeError:
+        received = len(content)
+    metrics.add_bytes(len(response.request.body or ''), received, None, len(content))
+
+
+def write_metrics(content, file_name):
+    """ Write metrics to file_name, replacing the previous version atomically. """
+
+    with io.open(file_name + '.tmp', 'wb') as f:
+        f.write(content)
+    os.rename(file_name + '.tmp', file_name)
+
+
+class AttachmentCache(object):
+    """ Attachments of source articles, fetched from Zendesk at most once per article.
+
+    For each article, maps attachment file names to their content URLs. If persist is
+    set, the maps are also kept in STATE_DIR and reused in later runs as long as the
+    article's updated_at, given with set_updated_at(), hasn't changed.
+    """
+
+    def __init__(self, zdapi, persist=False):
+        self.zdapi = zdapi
+        self.persist = persist
+        self.persisted = {}
+        if persist:
+            self.persisted = load_state(ATTACHMENTS_FILE)
+        self.cache = {}
+        self.updated_at = {}
+        self.lock = threading.Lock()
+
+    def set_updated_at(self, article_id, updated_at):
+        with self.lock:
+            self.updated_at[str(article_id)] = updated_at
+
+    def forget(self, article_id):
+        """ Drop the attachments of an article fetched so far, to fetch them again """
+
+        with self.lock:
+            self.cache.pop(str(article_id), None)
+
+    def get(self, article_id):
+        """ Return a dictionary mapping file names to content URLs, or None if the 
+        article no longer exists. """
+
+        key = str(article_id)
+
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+            entry = self.persisted.get(key)
+            updated_at = self.updated_at.get(key)
+            if entry is not None and updated_at is not None \
+                    and entry['updated_at'] == updated_at:
+                self.cache[key] = entry['attachments']
+                return self.cache[key]
+
+        try:
+            attachments = self.zdapi.help_center_article_attachments(
+                article_id)['article_attachments']
+
+        except zdesk.ZendeskError as e: 
+
+            if e.error_code == 404:
+                urls = None
+            else:
+                raise
 
         else:
-            raise
+            urls = dict((attachment['file_name'], attachment['content_url'])
+                        for attachment in attachments)
 
-    else:
-        # lxml will add a surrounding div if one isn't present, so check to see if it
-        # should be removed at the end
+        with self.lock:
+            self.cache[key] = urls
+            if self.persist and urls is not None and updated_at is not None:
+                self.persisted[key] = {'updated_at': updated_at, 'attachments': urls}
+
+        return urls
+
+    def save(self):
+        if self.persist:
+            with self.lock:
+                save_state(self.persisted, ATTACHMENTS_FILE)
+
+
+class LinkRewriter(object):
+    """ Rewrites the links in a translated article body to point to localised versions.
+
+    Works on the HTML text directly instead of parsing it: only the href of anchors 
+    and the src of images are looked at, and only those that refer to the source 
+    locale are rewritten. Everything else in the body is left byte for byte as it was.
+    The rewrite rules are compiled once per locale, see get_link_rewriter().
+    """
+
+    # href of <a> elements and src of <img> elements, with the value quoted or not
+    LINK_RE = re.compile(r"""(<(?:a\b[^>]*?\shref|img\b[^>]*?\ssrc)\s*=\s*)"""
+                         r"""("[^"]*"|'[^']*'|[^\s"'>]+)""", 
+                         re.IGNORECASE)
+
+    def __init__(self, locale):
+        self.locale = locale
+        self.anchor_marker = '/' + ZD_SOURCE_LOCALE + '/'
+        self.image_marker = '_' + ZD_SOURCE_LOCALE + '.'
+        self.anchor_re = re.compile(re.escape(self.anchor_marker))
+        self.image_re = re.compile('_' + re.escape(ZD_SOURCE_LOCALE) + r'\.(...)')
+
+    def has_candidates(self, body):
+        """ Quick check whether body could contain any link that needs rewriting """
+
+        return self.anchor_marker in body or self.image_marker in body
+
+    def fix_image_link(self, url, attachment_urls):
+        """ Return image URL pointing to the localised version, or None.
+
+        Given an image URL contains a substring indicating that it should be
+        localised, then replace that substring its localised counterpart.
+
+        Because Zendesk assigns a new ID to each uploaded image, it's necessary
+        to find the correct ID to include in the URL. This is done by looking up
+        the name of the localised image in attachment_urls, which maps the file 
+        names of the article attachments to their URLs, and then using that URL.
+        If the localised version is not found None is returned.
+        """
+
+        image_file_name = urlsplit(url).path.split('/')[-1]
 
-        surrounding_div_in_orig = False
-        if body.strip().lower().startswith('<div'):
-            surrounding_div_in_orig = True
+        # Derive the localised image name. For example, change 'a_en-us.jpg' to 'a_fr.jpg'    
+        new_image_file_name = self.image_re.sub('_' + self.locale + r'.\1', image_file_name)
 
-        # Parse the HTML and process each link
-        parsed_body = lxml.html.fromstring(body)
-        for element, attribute, link, pos in parsed_body.iterlinks():
+        # Look up the localised image, and use it's URL.
+        new_url = attachment_urls.get(new_image_file_name)
+        if new_url is None:
+            logging.warn('No %s version of image found for %s', self.locale, image_file_name)
 
-            if element.tag == 'img':
+        return new_url
 
-                fix_image_link(element, link, locale, attachments)
+    def fix_anchor_link(self, url):
+        """ Return anchor URL pointing to translated version of page.
 
-            elif element.tag == 'a':
+        Given an anchor URL replace a path component which contains the source
+        locale with the localised equivalent. For example, substitues occurrence 
+        of '/en-us/' with '/fr/'
+        """
 
-                fix_anchor_link(element, link, locale)
+        # TODO only do it for help-center links
+        return self.anchor_re.sub('/' + self.locale + '/', url)
 
+    def rewrite(self, body, get_attachment_urls):
+        """ Return body with its links localised.
+
+        get_attachment_urls is only called if there is an image to localise. It returns
+        the dictionary passed to fix_image_link(), or None to leave images unchanged.
+        """
+
+        if not self.has_candidates(body):
+            return body
+
+        attachment_urls = []  # fetched on first use
+
+        def replace(match):
+            prefix, quoted_url = match.group(1), match.group(2)
+
+            if quoted_url[0] in '"\'':
+                quote, url = quoted_url[0], quoted_url[1:-1]
             else:
-                logging.debug('Ignoring link element %s', element.tag)
+                quote, url = '"', quoted_url
 
-        fixed_body = lxml.html.tostring(parsed_body)
+            if prefix[1:4].lower() == 'img':
 
-        # Remove the surround div that lxml added
-        if not surrounding_div_in_orig:
-            # TODO is there an lxml way to do this
-            if body.startswith('<div>') and body.endswith('</div>'):
-                fixed_body = fixed_body[5:-6]
+                if self.image_marker not in url:
+                    return match.group(0)
 
+                if not attachment_urls:
+                    attachment_urls.append(get_attachment_urls())
+                if attachment_urls[0] is None:
+                    return match.group(0)
 
-    return fixed_body
+                new_url = self.fix_image_link(url, attachment_urls[0])
+                if new_url is None:
+                    return match.group(0)
 
+                # Attachment URLs come unescaped from the API
+                new_url = new_url.replace('&', '&amp;').replace(quote, '&#%d;' % ord(quote))
 
-def upload_article_translation_to_zendesk(article_id, zd_locale, translation, zdapi):
-    """ Upload an article translation to Zendesk. """
+            else:
 
-    logging.debug('Uploading article translation %s to Zendesk', article_id)
+                if self.anchor_marker not in url:
+                    return match.group(0)
 
-    try:
-        # Assume it exists and just needs to be updated
-        zdapi.help_center_article_translation_show(article_id, zd_locale)
-        zdapi.help_center_article_translation_update(article_id, zd_locale, translation)
+                new_url = self.fix_anchor_link(url)
 
-        logging.debug('Updated article translation %s translation, locale %s', 
-                      str(article_id), zd_locale)
+            return prefix + quote + new_url + quote
 
-    except zdesk.ZendeskError as e: 
+        return self.LINK_RE.sub(replace, body)
 
-        if e.error_code == 404:
-            # Translation doesnt exist, create it...
-            try:
-                logging.debug('Article translation not found. Creating...')
-                zdapi.help_center_article_translation_create(article_id, translation)
-                logging.debug('Added article translation %s, locale %s', 
-                              article_id, zd_locale)
 
-            except zdesk.ZendeskError as ee: 
-                if ee.error_code == 404: 
-                    # uncommon situation - source article no longer exisits
-                    logging.debug('Source article %s gone, skip upload of translation...', 
-                                  article_id)
+link_rewriters = {}
 
-                else:
-                    raise
 
-        else:
-            raise
+def get_link_rewriter(locale):
+    """ Return the LinkRewriter for locale, creating it on first use. """
 
+    rewriter = link_rewriters.get(locale)
+    if rewriter is None:
+        rewriter = link_rewriters.setdefault(locale, LinkRewriter(locale))
+    return rewriter
 
-def upload_section_translation_to_zendesk(section_id, zd_locale, translation, zdapi):
-    """ Uploads a section translation to Zendesk."""
 
-    logging.debug('Uploading section translation %s to Zendesk', section_id)
+def fix_article_links(article_id, body, locale, zdapi, attachment_cache=None):
+    """ Replace links in article body with localised versions.
 
-    try:
-        # Assume it exists and just needs to be updated
-        zdapi.help_center_section_translation_update(section_id, zd_locale, translation)
-        logging.debug('Updated section %s translation, locale %s', section_id, zd_locale)
+    Anchor links containing the source locale are pointed to the translated page, and
+    images named after the source locale to the localised image attached to the 
+    article. Bodies without any such links are returned untouched without fetching 
+    the article attachments.
 
-    except zdesk.ZendeskError as e: 
+    Arguments:
+        attachment_cache. Optional AttachmentCache shared between calls, so the
+            attachments of an article are fetched once for all locales.
 
-        if e.error_code == 404:
-            # doesnt exist, create it...
-            try:
-                zdapi.help_center_section_translation_create(section_id, translation)
-                logging.debug('Added section %s translation, locale %s', 
-                              section_id, zd_locale)
+    Returns:
+        Modified body string
+    """
 
-            except zdesk.ZendeskError as ee: 
-                if ee.error_code == 404: # seems to give 404 if source item gone
-                    # uncommon situation - source section no longer exisits
-                    logging.debug('Source section %s gone, skip upload of translation...', 
-                                  section_id)
+    logging.debug('Fixing links for article %s', article_id)
 
-                else:
-                    raise
+    if attachment_cache is None:
+        attachment_cache = AttachmentCache(zdapi)
 
-        else:
-            raise
+    def get_attachment_urls():
+        # Article attachment list is needed for localising the image links.
+        attachments = attachment_cache.get(article_id)
+        if attachments is None:
+            # uncommon situation - original article no longer exists so leave images
+            logging.info('Source article %s gone, skip image link fixing...', article_id)
+        return attachments
 
+    with metrics.stage('fix_links'):
+        return get_link_rewriter(locale).rewrite(body, get_attachment_urls)
 
-def upload_category_translation_to_zendesk(category_id, locale, translation, zdapi):
-    """ Upload an category translation to Zendesk. """
 
-    logging.debug('Uploading category translation %s to Zendesk', category_id)
+class TranslationIndex(object):
+    """ Which items already have a translation in a locale in Zendesk.
+
+    Built per (item type, locale) on first use, from the paged listing of the items 
+    in that locale, so publishing a translation takes a single create or update call
+    instead of probing for the translation first.
+    """
+
+    def __init__(self, zdapi):
+        self.zdapi = zdapi
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def load(self, item_type, zd_locale):
+        logging.debug('Listing %s translations in Zendesk, locale %s', item_type, zd_locale)
+
+        # Only count items actually in the locale, not ones falling back to the source
+        return set(item['id'] for item in iter_zendesk_items(item_type, zd_locale, self.zdapi)
+                   if item.get('locale', zd_locale) == zd_locale)
+
+    def exists(self, item_type, item_id, zd_locale):
+        with self.lock:
+            ids = self.index.get((item_type, zd_locale))
+
+        if ids is None:
+            # Listed without the lock, so other workers aren't held up. Workers listing
+            # the same locale at once use whichever listing was installed first.
+            ids = self.load(item_type, zd_locale)
+            with self.lock:
+                ids = self.index.setdefault((item_type, zd_locale), ids)
+
+        return int(item_id) in ids
+
+    def add(self, item_type, item_id, zd_locale):
+        with self.lock:
+            if (item_type, zd_locale) in self.index:
+                self.index[(item_type, zd_locale)].add(int(item_id))
+
+
+def upload_translation_to_zendesk(item_type, item_id, zd_locale, update, create, 
+                                  translation_index=None):
+    """ Update an item translation in Zendesk, or create it if it doesn't exist.
+
+    Arguments:
+        update, create. Functions making the Zendesk API call to update or create
+            the translation, create returning the complete zdesk response
+        translation_index. Optional TranslationIndex. If given, it decides whether to
+            update or create. Otherwise an update is tried first. The index may be
+            stale, so either call falls back to the other.
+    """
+
+    logging.debug('Uploading %s translation %s to Zendesk', item_type, item_id)
+
+    # Assume it exists and just needs to be updated
+    exists = True
+    if translation_index is not None:
+        exists = translation_index.exists(item_type, item_id, zd_locale)
+
+    if exists:
+        try:
+            update()
+            logging.debug('Updated %s %s translation, locale %s', 
+                          item_type, item_id, zd_locale)
+            return
+
+        except zdesk.ZendeskError as e: 
+
+            if e.error_code != 404:
+                raise
 
+    # Translation doesnt exist, create it...
     try:
-        # Assume it exists and just needs to be updated
-        zdapi.help_center_category_translation_update(category_id, locale, translation)
-        logging.debug('Updated category %s, locale %s', str(category_id), locale)
+        logging.debug('Translation of %s %s not found. Creating...', item_type, item_id)
+        response = create()
+        status = response['status']
 
     except zdesk.ZendeskError as e: 
+        if e.error_code == 404: # seems to give 404 if source item gone
+            # uncommon situation - source item no longer exisits
+            logging.debug('Source %s %s gone, skip upload of translation...', 
+                          item_type, item_id)
+            return
 
-        if e.error_code == 404:
-            # doesnt exist, create it...
-            try:
-                zdapi.help_center_category_translation_create(category_id, translation)
-                logging.debug('Added category %s translation, locale %s', 
-                              category_id, locale)
+        if e.error_code not in (400, 422) or exists:
+            raise
 
-            except zdesk.ZendeskError as ee: 
+        status = e.error_code
 
-                if ee.error_code == 404: # seems to give 404 if source item gone
-                    # uncommon situation - source category no longer exisits
-                    logging.debug('Source category %s gone, skip upload of translation...', 
-                                  category_id)
+    # Newer zdesk versions return 422 responses instead of raising
+    if status in (400, 422):
+        if exists:
+            raise zdesk.ZendeskError(response['content'], status, response['response'])
 
-                else:
-                    raise
+        # The translation was added after the index was built
+        logging.debug('Translation of %s %s already exists. Updating...', item_type, item_id)
+        update()
+        logging.debug('Updated %s %s translation, locale %s', item_type, item_id, zd_locale)
 
-        else:
-            raise
+    else:
+        logging.debug('Added %s %s translation, locale %s', item_type, item_id, zd_locale)
+
+    if translation_index is not None:
+        translation_index.add(item_type, item_id, zd_locale)
+
+
+def upload_article_translation_to_zendesk(article_id, zd_locale, translation, zdapi,
+                                          translation_index=None):
+    """ Upload an article translation to Zendesk. """
+
+    def update():
+        if translation_index is None:
+            # Without an index, check it exists first
+            zdapi.help_center_article_translation_show(article_id, zd_locale)
+        zdapi.help_center_article_translation_update(article_id, zd_locale, translation)
+
+    def create():
+        return zdapi.help_center_article_translation_create(article_id, translation,
+                                                            complete_response=True)
+
+    upload_translation_to_zendesk(TYPE_ARTICLE, article_id, zd_locale, update, create,
+                                  translation_index)
 
 
-def construct_article_translation(item_id, translation_data, zd_locale, zdapi):
+def upload_section_translation_to_zendesk(section_id, zd_locale, translation, zdapi,
+                                          translation_index=None):
+    """ Uploads a section translation to Zendesk."""
+
+    def update():
+        zdapi.help_center_section_translation_update(section_id, zd_locale, translation)
+
+    def create():
+        return zdapi.help_center_section_translation_create(section_id, translation,
+                                                            complete_response=True)
+
+    upload_translation_to_zendesk(TYPE_SECTION, section_id, zd_locale, update, create,
+                                  translation_index)
+
+
+def upload_category_translation_to_zendesk(category_id, locale, translation, zdapi,
+                                           translation_index=None):
+    """ Upload an category translation to Zendesk. """
+
+    def update():
+        zdapi.help_center_category_translation_update(category_id, locale, translation)
+
+    def create():
+        return zdapi.help_center_category_translation_create(category_id, translation,
+                                                             complete_response=True)
+
+    upload_translation_to_zendesk(TYPE_CATEGORY, category_id, locale, update, create,
+                                  translation_index)
+
+
+def construct_article_translation(item_id, translation_data, zd_locale, zdapi,
+                                  attachment_cache=None):
     """ Construct an object representing a Zendesk article translation.
 
     Since the source article JSON representation is uploaded to Smartling for 
@@ -343,6 +1114,7 @@ def construct_article_translation(item_id, translation_data, zd_locale, zdapi):
         translation_data. The translation of the source article returned by Smartling
         zd_locale. The Zendesk locale of the translation
         zdapi. Reference to the Zendesk API
+        attachment_cache. Optional AttachmentCache for fixing image links
 
     Returns:
         Dictionary object with the fields needed by Zendesk to create/update an 
@@ -357,7 +1129,7 @@ def construct_article_translation(item_id, translation_data, zd_locale, zdapi):
     translation['title'] = translation_data['title']
     translation['body'] = fix_article_links(item_id, 
                                             translation_data['body'], 
-                                            zd_locale, zdapi)
+                                            zd_locale, zdapi, attachment_cache)
     translation['draft'] = translation_data['draft']
 
     return translation
@@ -407,28 +1179,19 @@ def construct_category_translation(translation_data, zd_locale):
     return translation
 
 
-def write_to_file_json(item, full_file_name):
-    """ Write a Dictionary to a file in JSON format """
+def serialize_item_json(item):
+    """ Serialize a Dictionary to UTF-8 encoded JSON, as written to files and uploaded """
 
-    with io.open(full_file_name, 'w', encoding='utf-8') as f:
-        f.write(unicode(json.dumps(item, sort_keys=True, indent=4, 
-                                   ensure_ascii=False)))
+    content = json.dumps(item, sort_keys=True, indent=4, ensure_ascii=False)
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return content
 
 
-def get_item_translation_file_name(item_type, item_id, locale):
-    return item_type + '_' + str(item_id) + '_' + locale + '.json'
+def get_translation_file_name(uri, locale):
+    """ Name of the debugging copy of the locale translation of a Smartling file """
 
-
-def write_item_translation_to_file(translation, item_type, locale):
-
-    # The translation looks like the source item and not the translation item that
-    # will eventually be uploaded to Zendesk. Therefore it doesn't have a 'source_id' key
-    # yet. Since we need to tie it to the source item anyway, we just read the 'id' key 
-    # since that will still contain the source value.
-    item_id = translation['id'] 
-    file_name = os.path.join(TRANSLATION_DIR, 
-                             get_item_translation_file_name(item_type, item_id, locale))
-    write_to_file_json(translation, file_name)
+    return os.path.splitext(uri)[0] + '_' + locale + '.json'
 
 
 def download_translation_from_smartling_json(uri, sl_locale, retrieval_type, slapi):
@@ -443,44 +1206,191 @@ def download_translation_from_smartling_json(uri, sl_locale, retrieval_type, sla
             pending or pseudo)
         slapi. Reference to the Smartling API
 
+    With write_debug_files the file is streamed unmodified into TRANSLATION_DIR, 
+    and parsed from there, or it is added unmodified to the run archive.
+
     Returns:
         Dictionary representing the parsed JSON downloaded from Smartling
     """
 
     logging.debug('Downloading from Smartling: %s', uri)
 
-    response, http_response_code = slapi.get(fileUri=uri, 
-                                             locale=sl_locale, 
-                                             includeOriginalStrings=SL_INCLUDE_ORIGINAL_STRINGS,
-                                             retrievalType=retrieval_type)
-
-    if http_response_code == 200:
-
-        return json.loads(response)
+    stream = write_debug_files and run_archive is None
+    with metrics.stage('download'):
+        if stream:
+            file_name = os.path.join(TRANSLATION_DIR, get_translation_file_name(uri, sl_locale))
+            response, http_response_code = slapi.download(fileUri=uri, 
+                                                          locale=sl_locale, 
+                                                          target=file_name,
+                                                          includeOriginalStrings=SL_INCLUDE_ORIGINAL_STRINGS,
+                                                          retrievalType=retrieval_type)
+        else:
+            response, http_response_code = slapi.get(fileUri=uri, 
+                                                     locale=sl_locale, 
+                                                     includeOriginalStrings=SL_INCLUDE_ORIGINAL_STRINGS,
+                                                     retrievalType=retrieval_type)
 
-    else:
+    if http_response_code != 200:
         # Might need to check for other response codes, but for now, give up
 
         raise SmartlingError('Error in Smartling API get call', 
                              http_response_code, response)
 
+    if stream:
+        with io.open(file_name, 'rb') as f:
+            return json.load(f)
+
+    if run_archive is not None:
+        run_archive.add(TRANSLATION_DIR, get_translation_file_name(uri, sl_locale), response)
+    return json.loads(response)
+
+
+
+class LastModifiedIndex(object):
+    """ Smartling modification times of the translations last published to Zendesk.
+
+    The times are kept per (fileUri, locale, retrieval type) in STATE_DIR, and for 
+    bundles per member item too. The current times of all locales of a file are fetched
+    from Smartling with a single last_modified call, the first time any locale of that
+    file is checked. Workers checking the same file meanwhile wait for that call.
+    """
+
+    def __init__(self, slapi, force=False):
+        self.slapi = slapi
+        self.force = force
+        self.applied = load_state(LAST_APPLIED_FILE)
+        self.current = {}
+        self.fetching = {}  # uri -> threading.Event set once its times are fetched
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    @staticmethod
+    def key(uri, sl_locale, retrieval_type, member=None):
+        if member is not None:
+            uri = '%s#%s' % (uri, member)
+        return '|'.join((uri, sl_locale, retrieval_type))
+
+    def get_current(self, uri, sl_locale):
+        """ Return the last modification time of a translation in Smartling, or None """
+
+        while True:
+            with self.lock:
+                if uri in self.current:
+                    return self.current[uri].get(sl_locale.lower())
+                event = self.fetching.get(uri)
+                if event is None:
+                    event = self.fetching[uri] = threading.Event()
+                    break
+
+            # Another worker is fetching the times of uri. Should it fail, the next 
+            # time round this one fetches them.
+            event.wait()
+
+        try:
+            times = self.fetch(uri)
+            with self.lock:
+                self.current[uri] = times
+        finally:
+            with self.lock:
+                del self.fetching[uri]
+            event.set()
+
+        return times.get(sl_locale.lower())
+
+    def fetch(self, uri):
+        """ Return a dictionary mapping lowercase locales to modification times of uri """
+
+        response, http_response_code = self.slapi.last_modified(uri)
+
+        times = {}
+        if http_response_code == 200:
+            items = response.data.dict.get('items', [response.data.dict])
+            for item in items:
+                if 'locale' in item:
+                    times[item['locale'].lower()] = item['lastModified']
+        else:
+            # The download will report any real problem, so just don't skip it
+            logging.debug('No last modified time for %s: %s', uri, http_response_code)
+
+        return times
+
+    def invalidate(self, uri):
+        """ Forget the times of uri fetched from Smartling, to fetch them again """
+
+        with self.lock:
+            self.current.pop(uri, None)
+
+    def is_unchanged(self, uri, sl_locale, retrieval_type, member=None):
+        """ Check whether the translation changed in Smartling since it was published.
+        For a bundle, member is the ID of the item published from it. """
+
+        if self.force:
+            return False
+
+        applied = self.applied.get(self.key(uri, sl_locale, retrieval_type, member))
+        if applied is None:
+            return False
+
+        if applied != self.get_current(uri, sl_locale):
+            return False
+
+        with self.lock:
+            self.skipped += 1
+        return True
+
+    def record(self, uri, sl_locale, retrieval_type, current, member=None):
+        """ Remember current, the modification time as returned by get_current() before
+        the translation was downloaded, as published. Fetched after, it could include 
+        changes made since the download, which would then never be retrieved. """
+
+        if current is not None:
+            with self.lock:
+                self.applied[self.key(uri, sl_locale, retrieval_type, member)] = current
+
+    def save(self):
+        with self.lock:
+            save_state(self.applied, LAST_APPLIED_FILE)
 
 
 def transfer_translation_from_smartling(item_type, item_id, 
                                         sl_locale, retrieval_type, 
-                                        slapi, zdapi):
+                                        slapi, zdapi, last_modified=None, 
+                                        translation_index=None, attachment_cache=None,
+                                        journal=None):
     """ Transfer the translation or an item from Smartling to Zendesk.
 
     Article, section or category translation is downloaded from Smartling, 
     written to a file for logging purposes, then uploaded to Zendesk.
+
+    If last_modified, a LastModifiedIndex, is given, nothing is done when the 
+    translation hasn't changed in Smartling since it was last published. 
+    translation_index, a TranslationIndex, saves probing Zendesk for the translation.
+    attachment_cache, an AttachmentCache, saves fetching article attachments per locale.
+    journal, a RunJournal, records the transfer, or skips it if it was done before 
+    the run was interrupted.
     """
 
     # The uri is the name of the source file that was uploaded to Smartling
     uri = get_source_item_file_name(item_type, item_id)
 
+    journal_key = RunJournal.key(uri, sl_locale, retrieval_type)
+    if journal is not None and journal.is_done(journal_key):
+        logging.info('Skipping translation done before the interruption: %s, locale %s', 
+                     uri, sl_locale)
+        return
+
+    if last_modified is not None and last_modified.is_unchanged(uri, sl_locale, 
+                                                                retrieval_type):
+        logging.info('Skipping unchanged translation: %s, locale %s', uri, sl_locale)
+        return
+
     logging.info('Transferring translation from Smartling: %s, locale %s', 
                  uri, sl_locale)
 
+    # Recorded once published, as it was before the download
+    if last_modified is not None:
+        modified = last_modified.get_current(uri, sl_locale)
+
     # Download from Smartling
     translation_data = download_translation_from_smartling_json(uri, 
                                                            sl_locale, 
@@ -492,111 +1402,254 @@ def transfer_translation_from_smartling(item_type, item_id,
                      uri, sl_locale, retrieval_type)
         return
 
-    # write it to a file in case useful for debugging
-    write_item_translation_to_file(translation_data, item_type, sl_locale)
+    publish_translation_to_zendesk(item_type, item_id, translation_data, sl_locale, 
+                                   zdapi, translation_index, attachment_cache)
+
+    if last_modified is not None:
+        last_modified.record(uri, sl_locale, retrieval_type, modified)
+
+    if journal is not None:
+        journal.record(journal_key)
+
+
+def publish_translation_to_zendesk(item_type, item_id, translation_data, sl_locale, 
+                                   zdapi, translation_index=None, attachment_cache=None):
+    """ Construct the Zendesk translation of an item from its Smartling translation
+    and upload it to Zendesk. """
 
-    # Upload to Zendesk
     zd_locale = get_zendesk_locale(sl_locale)
     if item_type == TYPE_ARTICLE:
 
-        translation = construct_article_translation(item_id, translation_data, 
-                                                    zd_locale, zdapi)
-        upload_article_translation_to_zendesk(item_id, zd_locale, translation, zdapi)
+        with metrics.stage('construct'):
+            translation = construct_article_translation(item_id, translation_data, 
+                                                        zd_locale, zdapi, attachment_cache)
+        with metrics.stage('upload'):
+            upload_article_translation_to_zendesk(item_id, zd_locale, translation, zdapi,
+                                                  translation_index)
 
     elif item_type == TYPE_SECTION:
 
-        translation = construct_section_translation(translation_data, zd_locale)
-        upload_section_translation_to_zendesk(item_id, zd_locale, translation, zdapi)
+        with metrics.stage('construct'):
+            translation = construct_section_translation(translation_data, zd_locale)
+        with metrics.stage('upload'):
+            upload_section_translation_to_zendesk(item_id, zd_locale, translation, zdapi,
+                                                  translation_index)
 
     elif item_type == TYPE_CATEGORY:
 
-        translation = construct_category_translation(translation_data, zd_locale)
-        upload_category_translation_to_zendesk(item_id, zd_locale, translation, zdapi)
+        with metrics.stage('construct'):
+            translation = construct_category_translation(translation_data, zd_locale)
+        with metrics.stage('upload'):
+            upload_category_translation_to_zendesk(item_id, zd_locale, translation, zdapi,
+                                                   translation_index)
 
     else:
         raise ValueError('Invalid item_type %r' % item_type)
 
 
+def transfer_bundle_translation_from_smartling(item_type, bundle_uri, item_ids,
+                                               sl_locale, retrieval_type, 
+                                               slapi, zdapi, last_modified=None, 
+                                               translation_index=None, 
+                                               attachment_cache=None, journal=None):
+    """ Transfer the translations of items packed in a bundle from Smartling to Zendesk.
 
-def transfer_translations_from_smartling(item_type, item_ids, zd_locales, 
-                                         retrieval_type, slapi, zdapi):
-    """ Transfer a list of item_type translations from Smartling to Zendesk."""
-
-    logging.info('Transferring %s translations from Smartling', item_type)
+    The bundle is downloaded once, then the translation of each of item_ids is taken
+    from it and handled like in transfer_translation_from_smartling(). Items in the 
+    bundle that aren't in item_ids are ignored. The journal and last_modified keep
+    track of each item, as item_ids may be just some of the bundle's members.
+    """
 
+    pending = []
     for item_id in item_ids:
-        for zd_locale in zd_locales:
-            sl_locale = get_smartling_locale(zd_locale)
-            transfer_translation_from_smartling(item_type, item_id, 
-                                                sl_locale, retrieval_type, 
-                                                slapi, zdapi)
+        if journal is not None and journal.is_done(
+                RunJournal.key(bundle_uri, item_id, sl_locale, retrieval_type)):
+            logging.info('Skipping translation done before the interruption: %s %s, '
+                         'locale %s', bundle_uri, item_id, sl_locale)
+        elif last_modified is not None and last_modified.is_unchanged(
+                bundle_uri, sl_locale, retrieval_type, item_id):
+            logging.info('Skipping unchanged translation: %s %s, locale %s', 
+                         bundle_uri, item_id, sl_locale)
+        else:
+            pending.append(item_id)
 
+    if not pending:
+        return
 
-def get_completed_ids(item_type, sl_locale, slapi):
-    """ Return a list of IDs for which we have completed translations in Smartling. """
+    logging.info('Transferring translation from Smartling: %s, locale %s, %s items', 
+                 bundle_uri, sl_locale, len(pending))
 
-    response, http_response_code = slapi.list(locale=sl_locale,
-                                              uriMask=item_type,
-                                              conditions='haveAllTranslated',
-                                              fileTypes='json')
+    if last_modified is not None:
+        modified = last_modified.get_current(bundle_uri, sl_locale)
 
-    response_code = response.code
-    response_messages = response.messages
+    bundle_data = download_translation_from_smartling_json(bundle_uri, 
+                                                           sl_locale, 
+                                                           retrieval_type, 
+                                                           slapi)
 
-    ids = []
+    for item_id in pending:
+        translation_data = bundle_data.get(str(item_id))
+        if translation_data is None:
+            logging.warn('No %s %s in %s, locale %s', item_type, item_id, 
+                         bundle_uri, sl_locale)
+            continue
 
-    if http_response_code == 200:
+        publish_translation_to_zendesk(item_type, item_id, translation_data, sl_locale, 
+                                       zdapi, translation_index, attachment_cache)
 
-        response_data = response.data
+        if last_modified is not None:
+            last_modified.record(bundle_uri, sl_locale, retrieval_type, modified, item_id)
 
-        file_count = response_data.fileCount
+        if journal is not None:
+            journal.record(RunJournal.key(bundle_uri, item_id, sl_locale, retrieval_type))
 
-        # TODO don't re-run if only one page
 
-        # Smartling list API returns items in 500-entry pages
-        num_loops_required = (file_count / 500) + 1  
+def group_ids_by_bundle(item_ids, bundles):
+    """ Split item_ids into those packed in bundles and the rest.
 
-        for n in range(num_loops_required):
+    Arguments:
+        bundles. Dictionary mapping bundle file names to lists of item IDs 
 
-            response, http_response_code = slapi.list(locale=sl_locale, 
-                                                      uriMask=item_type,
-                                                      conditions='haveAllTranslated',
-                                                      fileTypes='json',
-                                                      offset = n * 500)
+    Returns:
+        Tuple of a dictionary mapping bundle file names to lists of item IDs, and a 
+        list of the IDs not in any bundle.
+    """
 
-            response_code = response.code
-            response_messages = response.messages
+    bundle_of_id = {}
+    for bundle_uri, bundle_ids in bundles.iteritems():
+        for item_id in bundle_ids:
+            bundle_of_id[item_id] = bundle_uri
 
-            if http_response_code == 200:
+    grouped = OrderedDict()
+    unbundled = []
+    for item_id in item_ids:
+        bundle_uri = bundle_of_id.get(int(item_id))
+        if bundle_uri is None:
+            unbundled.append(item_id)
+        else:
+            grouped.setdefault(bundle_uri, []).append(int(item_id))
 
-                response_data = response.data
+    return grouped, unbundled
 
-                for file in response_data.fileList:
 
-                    uri = file['fileUri']
-                    id = uri.split('_')[1].split('.')[0]
-                    ids.append(int(id))
+def transfer_translations_from_smartling(item_type, item_ids, zd_locales, 
+                                         retrieval_type, slapi, zdapi, jobs=1, 
+                                         last_modified=None, translation_index=None,
+                                         attachment_cache=None, bundles=None, 
+                                         journal=None):
+    """ Transfer a list of item_type translations from Smartling to Zendesk.
+
+    Each (item, locale) pair is transferred independently, up to jobs at a time.
+    If bundles, the item_type bundle manifest, is given, items that were uploaded
+    in a bundle are retrieved from it, one (bundle, locale) pair at a time.
+    """
 
-            else:
+    logging.info('Transferring %s translations from Smartling', item_type)
 
-                raise SmartlingError('Error in Smartling API upload call', 
-                             http_response_code, response)
+    grouped = {}
+    if bundles is not None:
+        grouped, item_ids = group_ids_by_bundle(item_ids, bundles)
 
-    else:
+    units = []
+    for bundle_uri, bundle_ids in grouped.iteritems():
+        for zd_locale in zd_locales:
+            sl_locale = get_smartling_locale(zd_locale)
+            units.append((item_type, bundle_uri, bundle_ids, sl_locale, retrieval_type, 
+                          slapi, zdapi, last_modified, translation_index, attachment_cache,
+                          journal))
 
-        raise SmartlingError('Error in Smartling API upload call', 
+    run_work_units(transfer_bundle_translation_from_smartling, units, jobs)
+
+    units = []
+    for item_id in item_ids:
+        for zd_locale in zd_locales:
+            sl_locale = get_smartling_locale(zd_locale)
+            units.append((item_type, item_id, sl_locale, retrieval_type, slapi, zdapi, 
+                          last_modified, translation_index, attachment_cache, journal))
+
+    run_work_units(transfer_translation_from_smartling, units, jobs)
+
+
+def list_completed_files(item_type, sl_locale, offset, slapi):
+    """ Return one page of the Smartling list of fully translated item_type files. """
+
+    response, http_response_code = slapi.list(locale=sl_locale,
+                                              uriMask=item_type,
+                                              conditions='haveAllTranslated',
+                                              fileTypes='json',
+                                              offset=offset)
+
+    if http_response_code != 200:
+        raise SmartlingError('Error in Smartling API list call', 
                              http_response_code, response)
 
-    return ids
+    return response.data
 
 
-def transfer_all_translations_from_smartling(item_type, zd_locales, 
-                                             include_articles, exclude_articles,
-                                             retrieval_type, slapi, zdapi):
+def build_completion_index(item_types, zd_locales, slapi, jobs=1):
+    """ Return which items have completed translations in Smartling, in which locales.
+
+    Lists the fully translated files of all item types and locales in one pass. The
+    first page of each (item type, locale) listing gives the file count, then the 
+    remaining pages are fetched. Pages are fetched up to max(jobs, SL_LIST_JOBS) 
+    at a time.
+
+    Returns:
+        Dictionary mapping (item_type, item_id) to the set of Zendesk locales. Completed
+        bundles are included as (item_type, bundle file name).
+    """
+
+    def list_page(page):
+        item_type, zd_locale, offset = page
+        return list_completed_files(item_type, get_smartling_locale(zd_locale), offset, slapi)
+
+    pool = ThreadPool(max(jobs, SL_LIST_JOBS))
+    try:
+        first_pages = [(item_type, zd_locale, 0) 
+                       for item_type in item_types for zd_locale in zd_locales]
+        pages = pool.map(list_page, first_pages)
+
+        more_pages = []
+        for (item_type, zd_locale, offset), page in zip(first_pages, pages):
+            for offset in range(SL_LIST_PAGE_SIZE, page.fileCount, SL_LIST_PAGE_SIZE):
+                more_pages.append((item_type, zd_locale, offset))
+
+        pages += pool.map(list_page, more_pages)
+        pool.close()
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    index = {}
+    for (item_type, zd_locale, offset), page in zip(first_pages + more_pages, pages):
+        for file in page.fileList:
+            uri = file['fileUri']
+            match = SOURCE_FILE_NAME_RE.match(uri)
+            if match is not None and match.group(1) == item_type:
+                index.setdefault((item_type, int(match.group(2))), set()).add(zd_locale)
+                continue
+            match = BUNDLE_FILE_NAME_RE.match(uri)
+            if match is not None and match.group(1) == item_type:
+                index.setdefault((item_type, uri), set()).add(zd_locale)
+            # otherwise uriMask matched as a substring, and it isn't one of our files
+
+    return index
+
+
+def transfer_all_translations_from_smartling(item_type, zd_locales, selection,
+                                             retrieval_type, slapi, zdapi, jobs=1, 
+                                             last_modified=None, translation_index=None,
+                                             attachment_cache=None, completion_index=None,
+                                             bundles=None, journal=None):
     """ Transfers all item_type translations from Smartling to Zendesk.
 
     Gets the full list of source items from Zendesk, then downloads the corresponding
-    translations in the specified locales from Smartling and uploads to Zendesk.
+    translations in the specified locales from Smartling and uploads to Zendesk, up to
+    jobs (item, locale) pairs at a time. Which translations are complete is looked up
+    in completion_index, as returned by build_completion_index(), which is built 
+    for item_type if not given. If bundles, the item_type bundle manifest, is given, 
+    completed bundles are retrieved, and the completed items not in any bundle.
 
     Note that there is a small race condition between the list and download during which
     a new source file could be uploaded for a particular ID resulting in a partially
@@ -607,71 +1660,131 @@ def transfer_all_translations_from_smartling(item_type, zd_locales,
     # what we actually tranfer from Smartling
 
     filtered_source_ids = set()
-    for item in get_all_source_items_from_zendesk(item_type, 
-                                                  include_articles, 
-                                                  exclude_articles,
-                                                  zdapi):
+    for item in get_all_source_items_from_zendesk(item_type, selection, zdapi):
+
+        filtered_source_ids.add(item['id'])
+        if item_type == TYPE_ARTICLE and attachment_cache is not None:
+            attachment_cache.set_updated_at(item['id'], item['updated_at'])
+
+
+    # For each locale, get the list of items that have been fully translated in Smartling.
+    # Then for each of those, if it appears on the list of items for which we need translations, 
+    # transfer it over.
+
+    if completion_index is None:
+        with metrics.stage('completion_index'):
+            completion_index = build_completion_index([item_type], zd_locales, slapi, jobs)
+
+    completed_ids = sorted(item_id for (completed_type, item_id) in completion_index
+                           if completed_type == item_type and isinstance(item_id, int))
+
+    if bundles is not None:
+
+        units = []
+        for zd_locale in zd_locales:
+            sl_locale = get_smartling_locale(zd_locale)
+
+            for bundle_uri in sorted(bundles):
+
+                if zd_locale in completion_index.get((item_type, bundle_uri), ()):
 
-        filtered_source_ids.add(item['id'])
+                    bundle_ids = [item_id for item_id in bundles[bundle_uri] 
+                                  if item_id in filtered_source_ids]
+                    units.append((item_type, bundle_uri, bundle_ids, sl_locale, 
+                                  retrieval_type, slapi, zdapi, last_modified, 
+                                  translation_index, attachment_cache, journal))
 
+        run_work_units(transfer_bundle_translation_from_smartling, units, jobs)
 
-    # For each locale, get the list of items that have been fully translated in Smartling.
-    # Then for each of those, if it appears on the list of items for which we need translations, 
-    # transfer it over.
+        # Items uploaded as their own file, before bundle mode or with -a or the
+        # daemon, are retrieved from that file
+        grouped, completed_ids = group_ids_by_bundle(completed_ids, bundles)
 
+    units = []
     for zd_locale in zd_locales:
         sl_locale = get_smartling_locale(zd_locale)
 
-        for completed_id in get_completed_ids(item_type, sl_locale, slapi):
+        for completed_id in completed_ids:
 
-            if completed_id in filtered_source_ids:
+            if completed_id in filtered_source_ids and \
+                    zd_locale in completion_index[(item_type, completed_id)]:
 
-                transfer_translation_from_smartling(item_type, completed_id, 
-                                                    sl_locale, retrieval_type, 
-                                                    slapi, zdapi)
+                units.append((item_type, completed_id, sl_locale, retrieval_type, 
+                              slapi, zdapi, last_modified, translation_index, 
+                              attachment_cache, journal))
+
+    run_work_units(transfer_translation_from_smartling, units, jobs)
 
 
 def get_source_item_file_name(item_type, item_id):
     return item_type + '_' + str(item_id) + '.json'
 
 
-def write_item_to_file(item, item_type, directory):
-    """ Writes a dictionary to a file in JSON format.
+# Matches the names given by get_source_item_file_name()
+SOURCE_FILE_NAME_RE = re.compile(r'^(%s|%s|%s)_(\d+)\.json$' % (TYPE_CATEGORY, TYPE_SECTION, 
+                                                              TYPE_ARTICLE))
+
+# Matches the subject of Zendesk Help Center webhook events, e.g. zen:article:123
+ZD_EVENT_SUBJECT_RE = re.compile(r'^zen:(%s|%s|%s):(\d+)$' % (TYPE_ARTICLE, TYPE_SECTION, 
+                                                             TYPE_CATEGORY))
+
+
+def get_bundle_file_name(item_type, number):
+    return 'bundle_' + item_type + '_' + str(number) + '.json'
+
+
+# Matches the names given by get_bundle_file_name()
+BUNDLE_FILE_NAME_RE = re.compile(r'^bundle_(%s|%s|%s)_(\d+)\.json$' % (TYPE_CATEGORY, 
+                                                                     TYPE_SECTION, 
+                                                                     TYPE_ARTICLE))
+
+
+def write_item_to_file(content, item_type, item_id, directory):
+    """ Writes an already serialized item to a file.
 
     Arguments:
-        item. Dictionary to be written to file.
+        content. JSON representation of the item, as returned by serialize_item_json().
         item_type. Either article, category or section.
+        item_id. ID of the item.
         directory. The directory where the file should be written.
     """
 
-    item_id = item['id']
     file_name = os.path.join(directory, get_source_item_file_name(item_type, item_id))
-    write_to_file_json(item, file_name)
+    with io.open(file_name, 'wb') as f:
+        f.write(content)
 
 
-def upload_source_file_to_smartling(path, file_name, file_type, 
-                                    fields_to_translate, approve, slapi):
-    """ Upload a source file of type file_type to Smartling. """
+def upload_source_to_smartling(file_name, content, file_type, 
+                               fields_to_translate, approve, slapi, path_prefix=''):
+    """ Upload in-memory source content of type file_type to Smartling. 
 
-    path = path + '/' # sdk requires TODO check this
+    path_prefix is put in front of the JSON paths in the Smartling directives, for 
+    content where the item fields aren't at the top level.
+    """
 
-    upload_data = UploadData(path, file_name, file_type, file_name)
+    upload_data = UploadData('', file_name, file_type, file_name)
 
     upload_data.setUri(file_name) 
+    upload_data.setContent(content)
 
     if approve:
         upload_data.setApproveContent('true')
     else:
         upload_data.setApproveContent('false')
 
+    if sl_callback_url:
+        upload_data.setCallbackUrl(sl_callback_url)
     
     upload_data.addDirective(SmartlingDirective('translate_paths', 
-                                                ','.join(fields_to_translate)))
-    upload_data.addDirective(SmartlingDirective('string_format_paths', 'html:body'))
-    upload_data.addDirective(SmartlingDirective('source_key_paths', 'title'))
+                                                ','.join(path_prefix + field 
+                                                         for field in fields_to_translate)))
+    upload_data.addDirective(SmartlingDirective('string_format_paths', 
+                                                'html:' + path_prefix + 'body'))
+    upload_data.addDirective(SmartlingDirective('source_key_paths', path_prefix + 'title'))
     upload_data.addDirective(SmartlingDirective('smartling.namespace', 'zendesk'))
 
-    response, http_response_code = slapi.upload(upload_data)
+    with metrics.stage('upload_source'):
+        response, http_response_code = slapi.upload(upload_data)
 
     if http_response_code == 200:
 
@@ -702,35 +1815,209 @@ def get_fields_to_translate(item_type):
         raise ValueError('Invalid item_type %r' % item_type )
 
 
-def upload_item_to_smartling(item, item_type, approve, slapi):
+class FingerprintStore(object):
+    """ Hashes of the translatable fields of the items last uploaded to Smartling.
+
+    Keyed by the Smartling file name of the item. Only the fields returned by 
+    get_fields_to_translate() are hashed, so changes to e.g. vote counts or updated_at 
+    don't cause a new upload.
+    """
+
+    def __init__(self, force=False):
+        self.fingerprints = load_state(FINGERPRINTS_FILE)
+        self.force = force
+        self.uploaded = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(item, fields):
+        return hashlib.sha1(json.dumps([item.get(field) for field in fields])).hexdigest()
+
+    def is_unchanged(self, file_name, fingerprint):
+        """ Check an item against its last upload, counting it as uploaded or skipped """
+
+        with self.lock:
+            if not self.force and self.fingerprints.get(file_name) == fingerprint:
+                self.skipped += 1
+                return True
+
+            self.uploaded += 1
+            return False
+
+    def record(self, file_name, fingerprint):
+        with self.lock:
+            self.fingerprints[file_name] = fingerprint
+
+    def save(self):
+        with self.lock:
+            save_state(self.fingerprints, FINGERPRINTS_FILE)
+
+
+def upload_item_to_smartling(item, item_type, approve, slapi, fingerprints=None, 
+                             journal=None):
     """ Uploads an article, section or category object to Smartling.
 
-    Writes to item to a JSON file, then uploads the file to Smartling.
+    Serializes the item to JSON once and uploads it to Smartling straight from 
+    memory. A copy is written to SOURCE_DIR only if debug files are enabled.
 
     Arguments:
         item. Dictionary representing the item
         item_type. article, section or category
+        fingerprints. Optional FingerprintStore. If given, the upload is skipped when
+            the translatable fields are unchanged since the last upload.
+        journal. Optional RunJournal the upload is recorded in, and skipped if it was
+            done before the run was interrupted.
     """
 
     item_id = item['id']
-
-    write_item_to_file(item, item_type, SOURCE_DIR)
     file_name = get_source_item_file_name(item_type, item_id)
-
     fields = get_fields_to_translate(item_type)
+
+    if journal is not None and journal.is_done(file_name):
+        logging.info('Skipping upload done before the interruption: ' + file_name)
+        return
+
+    if fingerprints is not None:
+        fingerprint = FingerprintStore.fingerprint(item, fields)
+        if fingerprints.is_unchanged(file_name, fingerprint):
+            logging.info('Skipping unchanged upload to Smartling: ' + file_name)
+            return
+
+    with metrics.stage('serialize'):
+        content = serialize_item_json(item)
+        if run_archive is not None:
+            run_archive.add(SOURCE_DIR, file_name, content)
+        elif write_debug_files:
+            write_item_to_file(content, item_type, item_id, SOURCE_DIR)
+
     file_format = 'json'
 
     logging.info('Uploading to Smartling: ' + file_name)
-    upload_source_file_to_smartling(SOURCE_DIR, file_name, file_format, 
-                                    fields, approve, slapi)
+    upload_source_to_smartling(file_name, content, file_format, 
+                               fields, approve, slapi)
+
+    if fingerprints is not None:
+        fingerprints.record(file_name, fingerprint)
+
+    if journal is not None:
+        journal.record(file_name)
+
+
+def pack_bundles(item_sizes, previous_bundles, max_bytes):
+    """ Assign items to bundles of up to max_bytes.
+
+    Items stay in the bundle they were in before as long as it has room, so adding 
+    or removing an item only changes the bundles it is or was in. Other items go 
+    into the first bundle with room, or into a new bundle.
+
+    Arguments:
+        item_sizes. Dictionary mapping item IDs to their serialized size
+        previous_bundles. Dictionary mapping bundle numbers to lists of item IDs
+
+    Returns:
+        Dictionary mapping bundle numbers to lists of item IDs
+    """
+
+    bundles = {}
+    used = {}
+    unassigned = set(item_sizes)
+
+    for number, item_ids in sorted(previous_bundles.items()):
+        bundles[number] = []
+        used[number] = 0
+        for item_id in item_ids:
+            if item_id in unassigned and used[number] + item_sizes[item_id] <= max_bytes:
+                bundles[number].append(item_id)
+                used[number] += item_sizes[item_id]
+                unassigned.remove(item_id)
+
+    for item_id in sorted(unassigned):
+        size = item_sizes[item_id]
+        for number in sorted(bundles):
+            if used[number] + size <= max_bytes:
+                break
+        else:
+            number = max(bundles.keys() + [-1]) + 1
+            bundles[number] = []
+            used[number] = 0
+        bundles[number].append(item_id)
+        used[number] += size
+
+    return dict((number, sorted(item_ids)) for number, item_ids in bundles.iteritems() 
+                if item_ids)
+
+
+def upload_bundles_to_smartling(item_type, items, approve, slapi, fingerprints=None,
+                                journal=None):
+    """ Upload items of one type to Smartling packed into bundle files.
+
+    A bundle is a JSON object with the serialized items keyed by their IDs. Which
+    items are in which bundle is kept in STATE_DIR, and used when retrieving the 
+    translations. A bundle is uploaded again only if its members, or their fields to
+    translate, changed.
+    """
+
+    manifest = load_state(BUNDLES_FILE)
+    previous_bundles = {}
+    for bundle_uri, item_ids in manifest.get(item_type, {}).iteritems():
+        previous_bundles[int(BUNDLE_FILE_NAME_RE.match(bundle_uri).group(2))] = item_ids
+
+    items_by_id = dict((item['id'], item) for item in items)
+    with metrics.stage('serialize'):
+        contents = dict((item_id, serialize_item_json(item)) 
+                        for item_id, item in items_by_id.iteritems())
+    item_sizes = dict((item_id, len(content)) for item_id, content in contents.iteritems())
+
+    bundles = {}
+    fields = get_fields_to_translate(item_type)
+    for number, item_ids in sorted(pack_bundles(item_sizes, previous_bundles, 
+                                                bundle_max_bytes).items()):
+
+        bundle_uri = get_bundle_file_name(item_type, number)
+        bundles[bundle_uri] = item_ids
+
+        if journal is not None and journal.is_done(bundle_uri):
+            logging.info('Skipping upload done before the interruption: ' + bundle_uri)
+            continue
+
+        content = '{\n' + ',\n'.join('"%s": %s' % (item_id, contents[item_id]) 
+                                      for item_id in item_ids) + '\n}'
+
+        if fingerprints is not None:
+            fingerprint = hashlib.sha1(json.dumps(
+                [[item_id, FingerprintStore.fingerprint(items_by_id[item_id], fields)]
+                 for item_id in item_ids])).hexdigest()
+            if fingerprints.is_unchanged(bundle_uri, fingerprint):
+                logging.info('Skipping unchanged upload to Smartling: ' + bundle_uri)
+                continue
+
+        if run_archive is not None:
+            run_archive.add(SOURCE_DIR, bundle_uri, content)
+        elif write_debug_files:
+            with io.open(os.path.join(SOURCE_DIR, bundle_uri), 'wb') as f:
+                f.write(content)
+
+        logging.info('Uploading to Smartling: %s, %s items', bundle_uri, len(item_ids))
+        upload_source_to_smartling(bundle_uri, content, 'json', fields, approve, slapi, '*/')
+
+        if fingerprints is not None:
+            fingerprints.record(bundle_uri, fingerprint)
+
+        if journal is not None:
+            journal.record(bundle_uri)
 
+    manifest[item_type] = bundles
+    save_state(manifest, BUNDLES_FILE)
 
 
-def transfer_source_item_to_smartling(item_type, item_id, approve, slapi, zdapi):
+def transfer_source_item_to_smartling(item_type, item_id, approve, slapi, zdapi, 
+                                      fingerprints=None, journal=None, selection=None):
     """ Transfer an item from Zendesk to Smartling for translation.
 
     First, download the article, section or category from Zendesk, then upload
-    to Smartling.
+    to Smartling. If selection, an ArticleSelection, is given, articles it doesn't 
+    select aren't uploaded.
     """
 
     logging.info('Transferring %s %s from Zendesk to Smartling', item_type, item_id)
@@ -738,20 +2025,24 @@ def transfer_source_item_to_smartling(item_type, item_id, approve, slapi, zdapi)
     item = None
 
     try:
-        if item_type == TYPE_ARTICLE:
+        with metrics.stage('fetch_source'):
+            if item_type == TYPE_ARTICLE:
 
-            item = zdapi.help_center_article_show(id=item_id)['article']
+                item = zdapi.help_center_article_show(id=item_id, 
+                                                      locale=ZD_SOURCE_LOCALE)['article']
 
-        elif item_type == TYPE_SECTION:    
+            elif item_type == TYPE_SECTION:    
 
-            item = zdapi.help_center_section_show(id=item_id)['section']
+                item = zdapi.help_center_section_show(id=item_id, 
+                                                      locale=ZD_SOURCE_LOCALE)['section']
 
-        elif item_type == TYPE_CATEGORY:
+            elif item_type == TYPE_CATEGORY:
 
-            item = zdapi.help_center_category_show(id=item_id)['category']
+                item = zdapi.help_center_category_show(id=item_id, 
+                                                       locale=ZD_SOURCE_LOCALE)['category']
 
-        else:
-            raise ValueError('Invalid item_type %r' % item_type )
+            else:
+                raise ValueError('Invalid item_type %r' % item_type )
 
     except zdesk.ZendeskError as e:
 
@@ -761,94 +2052,539 @@ def transfer_source_item_to_smartling(item_type, item_id, approve, slapi, zdapi)
             raise
 
     else:
-        upload_item_to_smartling(item, item_type, approve, slapi)
+        if selection is not None and item_type == TYPE_ARTICLE and \
+                not list(selection.filter([item], zdapi)):
+            return
+        upload_item_to_smartling(item, item_type, approve, slapi, fingerprints, journal)
 
 
-def transfer_source_items_to_smartling(item_type, item_ids, approve, slapi, zdapi):
+def transfer_source_items_to_smartling(item_type, item_ids, approve, slapi, zdapi, 
+                                       fingerprints=None, journal=None):
     """ Transfer a list of source items of one type from Zendesk to Smartling. """
 
     logging.info('Transferring %s items to Smartling for translation. IDs: %s', 
                     item_type, str(item_ids))
 
     for item_id in item_ids:
-        transfer_source_item_to_smartling(item_type, item_id, approve, slapi, zdapi)        
+        transfer_source_item_to_smartling(item_type, item_id, approve, slapi, zdapi, 
+                                          fingerprints, journal)
+
+
+class ArticleSelection(object):
+    """ Which articles are transferred with 'all', as configured in translate.cfg.
+
+    Rules name article IDs, section IDs, category IDs and label names, each kept in a
+    set. An article is selected unless an exclude rule matches it and, if there are 
+    include rules, only if an include rule matches it as well. A category rule matches
+    the articles of all sections in the category. Draft articles are only selected if 
+    their ID is included.
+
+    With include rules, only articles they can match are fetched from Zendesk: those 
+    of included sections and categories from the scoped listings, those with included
+    labels from a listing filtered by label, and included IDs one by one, unless there
+    are more than ZD_MAX_ARTICLE_SHOWS of them. Exclude rules can't be pushed down
+    that way, they are applied to whatever is fetched.
+    """
+
+    def __init__(self, include_articles=(), exclude_articles=(), 
+                 include_sections=(), exclude_sections=(), 
+                 include_categories=(), exclude_categories=(),
+                 include_labels=(), exclude_labels=()):
+        self.include_articles = set(include_articles)
+        self.exclude_articles = set(exclude_articles)
+        self.include_sections = set(include_sections)
+        self.exclude_sections = set(exclude_sections)
+        self.include_categories = set(include_categories)
+        self.exclude_categories = set(exclude_categories)
+        self.include_labels = set(include_labels)
+        self.exclude_labels = set(exclude_labels)
+
+        # Sections of included and excluded categories, added by compile()
+        self.included_sections = set(self.include_sections)
+        self.excluded_sections = set(self.exclude_sections)
+        self.compiled = False
+
+    def has_includes(self):
+        return bool(self.include_articles or self.include_sections or 
+                    self.include_categories or self.include_labels)
+
+    def compile(self, zdapi):
+        """ Resolve category rules to the sections in the categories """
+
+        if self.compiled:
+            return
+        self.compiled = True
+
+        if self.include_categories or self.exclude_categories:
+            for section in iter_zendesk_items(TYPE_SECTION, ZD_SOURCE_LOCALE, zdapi):
+                if section['category_id'] in self.include_categories:
+                    self.included_sections.add(section['id'])
+                if section['category_id'] in self.exclude_categories:
+                    self.excluded_sections.add(section['id'])
+
+    def is_selected(self, article):
+        id = article['id']
+        labels = article.get('label_names') or ()
+
+        if id in self.exclude_articles or \
+                article.get('section_id') in self.excluded_sections or \
+                self.exclude_labels.intersection(labels):
+            return False
+
+        if article['draft'] is True and id not in self.include_articles:
+            return False
+
+        if not self.has_includes():
+            return True
+
+        return id in self.include_articles or \
+            article.get('section_id') in self.included_sections or \
+            bool(self.include_labels.intersection(labels))
+
+    def filter(self, articles, zdapi):
+        """ Yield the selected articles of articles, which can be any iterable """
+
+        self.compile(zdapi)
+
+        for item in articles:
+            if self.is_selected(item):
+                yield item
+            elif item['draft'] is True and item['id'] not in self.exclude_articles:
+                logging.info('Skipping draft article %s', item['id'])
+            else:
+                logging.info('Skipping article %s due to transfer config', item['id'])
+
+    def iter_candidates(self, zdapi):
+        """ Yield the source articles the rules can select, each once """
+
+        if not self.has_includes() or len(self.include_articles) > ZD_MAX_ARTICLE_SHOWS:
+            for item in iter_zendesk_items(TYPE_ARTICLE, ZD_SOURCE_LOCALE, zdapi):
+                yield item
+            return
+
+        listings = [iter_zendesk_items(TYPE_ARTICLE, ZD_SOURCE_LOCALE, zdapi, 
+                                       scope=(TYPE_CATEGORY, category_id))
+                    for category_id in sorted(self.include_categories)]
+        listings += [iter_zendesk_items(TYPE_ARTICLE, ZD_SOURCE_LOCALE, zdapi, 
+                                        scope=(TYPE_SECTION, section_id))
+                     for section_id in sorted(self.include_sections)]
+        if self.include_labels:
+            listings.append(iter_zendesk_items(TYPE_ARTICLE, ZD_SOURCE_LOCALE, zdapi, 
+                                               {'label_names': 
+                                                ','.join(sorted(self.include_labels))}))
+
+        seen = set()
+        for listing in listings:
+            try:
+                for item in listing:
+                    if item['id'] not in seen:
+                        seen.add(item['id'])
+                        yield item
+            except zdesk.ZendeskError as e:
+                if e.error_code != 404:
+                    raise
+                logging.warn('Section or category in transfer config not found')
+
+        for article_id in sorted(self.include_articles - seen - self.exclude_articles):
+            try:
+                with metrics.stage('list_source'):
+                    item = zdapi.help_center_article_show(id=article_id, 
+                                                          locale=ZD_SOURCE_LOCALE)['article']
+            except zdesk.ZendeskError as e:
+                if e.error_code != 404:
+                    raise
+                logging.warn('Article in transfer config not found. ID: %s', article_id)
+            else:
+                yield item
+
+    def iter_articles(self, zdapi):
+        """ Yield the selected source articles """
+
+        return self.filter(self.iter_candidates(zdapi), zdapi)
+
 
+def iter_zendesk_items(item_type, zd_locale, zdapi, filters=None, scope=None):
+    """ Yield the items of item_type listed in zd_locale in Zendesk, page by page.
 
-def get_all_source_items_from_zendesk(item_type, include_articles, exclude_articles, zdapi):
-    """ Return all source items in Zendesk, possibly filtered.
+    Pages are requested with cursor pagination, following the after cursor as long as 
+    there are more. Should Zendesk answer with offset pagination instead, next_page is 
+    followed. Each page is only requested once the items of the previous one have been 
+    consumed, so just one page is held in memory.
 
-    Return all items of the specified type from Zendesk. In the case of articles, they returned
-    list is filtered according to what is in include_articles and exclude_articles.
-    Draft articles are not included, unless articles are specified in the include_articles 
-    argument, in which case the draft attribute is ignored.
+    Arguments:
+        filters. Optional dictionary of query parameters narrowing down the listing
+        scope. Optional (item type, ID) of the section or category to list the 
+            articles of
+    """
+
+    if item_type not in ZD_LIST_CALLS:
+        raise ValueError('Invalid item_type %r' % item_type)
+
+    path, key = ZD_LIST_CALLS[item_type]
+    if scope is not None:
+        scope_type, scope_id = scope
+        path = '/api/v2/help_center/%s/' + ZD_LIST_CALLS[scope_type][1] + '/' + \
+            str(scope_id) + '/' + key + '.json'
+    path = path % zd_locale
+    filters = filters or {}
+    query = dict(filters, **{'page[size]': ZD_LIST_PAGE_SIZE})
+
+    while True:
+        with metrics.stage('list_source'):
+            page = zdapi.call(path, query=query)
+
+        for item in page[key]:
+            yield item
+
+        if 'meta' in page:
+            if not page['meta'].get('has_more'):
+                break
+            query = dict(filters, **{'page[size]': ZD_LIST_PAGE_SIZE, 
+                                     'page[after]': page['meta']['after_cursor']})
+
+        elif page.get('next_page'):
+            next_page = urlsplit(page['next_page'])
+            path, query = next_page.path, dict(parse_qsl(next_page.query))
+
+        else:
+            break
+
+
+def get_all_source_items_from_zendesk(item_type, selection, zdapi):
+    """ Yield all source items in Zendesk, possibly filtered.
+
+    Yield all items of the specified type from Zendesk as each page of them arrives, so 
+    they can be handled before the rest are listed. In the case of articles, only those
+    selected by selection, an ArticleSelection, are fetched and yielded.
     """
 
     logging.info('Getting all %s items from Zendesk', item_type)
 
-    items = []
+    if item_type == TYPE_ARTICLE:
+        items = selection.iter_articles(zdapi)
+    else:
+        items = iter_zendesk_items(item_type, ZD_SOURCE_LOCALE, zdapi)
+
+    count = 0
+    for item in items:
+        count += 1
+        yield item
+
+    logging.info('Got %s items', count)
+
+
+def parse_zendesk_time(value):
+    """ Convert a Zendesk timestamp such as '2015-04-26T23:43:32Z' to Unix time. """
+
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def get_changed_source_articles_from_zendesk(since, zdapi):
+    """ Return source articles created or updated at or after Unix time since.
+
+    Uses the Zendesk incremental article export, which pages by time rather than by 
+    page number. 
+
+    Returns:
+        Tuple of the list of articles and the Unix time to pass as since next time.
+    """
+
+    articles = OrderedDict()
+    start_time = since
+
+    while True:
+        page = zdapi.call('/api/v2/help_center/incremental/articles.json',
+                          query={'start_time': start_time})
+
+        # An article updated again while paging turns up twice, keep the latest
+        for article in page['articles']:
+            articles.pop(article['id'], None)
+            articles[article['id']] = article
+
+        end_time = page.get('end_time')
+        if end_time is None or end_time <= start_time:
+            break
+
+        start_time = end_time
+
+        if len(page['articles']) < ZD_INCREMENTAL_PAGE_SIZE:
+            break
+
+    return articles.values(), start_time
+
+
+def get_changed_source_items_from_zendesk(item_type, since, selection, zdapi):
+    """ Return source items of item_type changed since the last incremental transfer.
+
+    Articles are fetched with the incremental export and filtered as in 
+    get_all_source_items_from_zendesk(). Sections and categories have no incremental 
+    endpoint, but there are few of them, so the full list is filtered on updated_at.
+
+    Returns:
+        Tuple of the list of items and the Unix time to pass as since next time.
+    """
+
+    logging.info('Getting %s items changed since %s from Zendesk', item_type, 
+                 time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(since)))
 
     if item_type == TYPE_ARTICLE:
 
-        full_list = zdapi.help_center_articles(ZD_SOURCE_LOCALE, get_all_pages=True)['articles']
+        with metrics.stage('list_source'):
+            articles, next_since = get_changed_source_articles_from_zendesk(since, zdapi)
+        articles = [article for article in articles 
+                    if article.get('source_locale', ZD_SOURCE_LOCALE) == ZD_SOURCE_LOCALE]
+        items = list(selection.filter(articles, zdapi))
 
-        # Don't include 'draft' articles unless a specific list of articles to include has 
-        # been given.
-        if len(include_articles) == 0:
-            include_draft = False
-        else:
-            include_draft = True
+    else:
 
-        for item in full_list:
-            id = item['id']
+        next_since = int(time.time())
+        items = [item for item in get_all_source_items_from_zendesk(item_type, selection, 
+                                                                    zdapi)
+                 if parse_zendesk_time(item['updated_at']) >= since]
 
-            if include_draft is False and item['draft'] is True:
-                logging.info('Skipping draft article %s', id)
-                continue
+    logging.info('Got %s changed items', len(items))
+    return items, next_since
 
-            if len(include_articles) > 0:
-                if (id in include_articles) and (id not in exclude_articles):
-                    items.append(item)
-                else:
-                    logging.info('Skipping article %s due to transfer config', id)
 
+def load_state(file_name):
+    """ Load a dictionary persisted by save_state(), or an empty one if there is none. """
+
+    full_file_name = os.path.join(STATE_DIR, file_name)
+    if not os.path.exists(full_file_name):
+        return {}
+
+    with io.open(full_file_name, 'rb') as f:
+        return json.load(f)
+
+
+def save_state(state, file_name):
+    """ Persist a dictionary in STATE_DIR, replacing the previous version atomically. """
+
+    if not os.path.exists(STATE_DIR):
+        os.makedirs(STATE_DIR)
+
+    full_file_name = os.path.join(STATE_DIR, file_name)
+    with io.open(full_file_name + '.tmp', 'wb') as f:
+        f.write(json.dumps(state, sort_keys=True))
+    os.rename(full_file_name + '.tmp', full_file_name)
+
+
+class RunJournal(object):
+    """ Durable record of the work units completed by a run, for --resume.
+
+    Every completed unit is appended to the JOURNAL_FILE of the direction (translate 
+    or retrieve) in STATE_DIR as a JSON line, after a header line describing the run, 
+    and synced to disk before the next unit counts on it. The journal is removed once 
+    the run succeeds. A run with resume set picks up the journal left by an interrupted
+    run of the same direction and skips the units it records; otherwise a new journal
+    is started. The journal of the other direction is left alone, so a run of one 
+    direction in between doesn't stop the other from being resumed.
+    """
+
+    def __init__(self, direction, argv, resume=False):
+        self.file_name = os.path.join(STATE_DIR, JOURNAL_FILE % direction)
+        self.done = set()
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.skipped = 0
+
+        header = None
+        if resume and os.path.exists(self.file_name):
+            header = self.load()
+            if header is None or header.get('direction') != direction:
+                logging.warn('No interrupted %s run to resume, starting over', direction)
+                header = None
+                self.done = set()
             else:
-                if id not in exclude_articles:
-                    items.append(item)
+                logging.info('Resuming %s run started %s (%s), %s units already done', 
+                             direction, header['started'], ' '.join(header['argv']), 
+                             len(self.done))
+        elif resume:
+            logging.warn('No interrupted %s run to resume, starting over', direction)
+
+        if not os.path.exists(STATE_DIR):
+            os.makedirs(STATE_DIR)
+
+        if header is None:
+            self.file = io.open(self.file_name, 'wb')
+            self.write({'direction': direction, 'argv': argv,
+                        'started': time.strftime('%Y-%m-%d %H:%M:%S')})
+        else:
+            self.file = io.open(self.file_name, 'ab')
+
+    def load(self):
+        """ Read the journal, returning its header, or None if it has none """
+
+        header = None
+        with io.open(self.file_name, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A unit being recorded when the run was killed
+                    continue
+                if header is None:
+                    header = entry
                 else:
-                    logging.info('Skipping article %s due to transfer config', id)
-       
+                    self.done.add(entry)
+        return header
 
-    elif item_type == TYPE_SECTION:
-    
-        items = zdapi.help_center_sections(ZD_SOURCE_LOCALE, get_all_pages=True)['sections']
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
 
-    elif item_type == TYPE_CATEGORY:
+    @staticmethod
+    def key(*parts):
+        return '|'.join(str(part) for part in parts)
 
-        items = zdapi.help_center_categories(ZD_SOURCE_LOCALE, get_all_pages=True)['categories']
+    def is_done(self, key):
+        """ Check whether a unit was completed before the run was interrupted """
 
-    else:
-        raise ValueError('Invalid item_type %r' % item_type)
+        if key not in self.done:
+            return False
+        with self.lock:
+            self.skipped += 1
+        return True
 
-    logging.info('Got %s items', len(items))
-    return items
+    def record(self, key):
+        with self.lock:
+            self.write(key)
+            self.recorded += 1
 
+    def close(self, succeeded):
+        """ Close the journal, removing it if the run succeeded """
 
-def transfer_all_source_items_to_smartling(item_type, include_articles, exclude_articles, 
-                                           approve, slapi, zdapi):
-    """ Transfer all source items of a particular type from Zendesk to Smartling. """
+        self.file.close()
+        if succeeded:
+            os.remove(self.file_name)
+
+
+class RunArchive(object):
+    """ Debugging copies of the items of a run, in one gzip compressed JSONL file.
+
+    The archive is created in ARCHIVE_DIR, named after the start time, direction and 
+    process. After a header line describing the run, each line holds the directory a
+    copy is written to without the archive, its file name, the time and the content as
+    it was uploaded or downloaded. Lines are written by a background thread, workers 
+    only queue them, waiting if ARCHIVE_QUEUE_SIZE are queued already. The file is 
+    flushed once no copy has been queued for ARCHIVE_FLUSH_INTERVAL seconds, so it can
+    be read while the run goes on. Only the last keep_runs archives of the direction 
+    are kept. Read them with smartlingzd_archive.py.
+    """
+
+    def __init__(self, direction, argv, keep_runs):
+        if not os.path.exists(ARCHIVE_DIR):
+            os.makedirs(ARCHIVE_DIR)
+        self.prune(direction, keep_runs - 1)
+
+        self.file_name = os.path.join(ARCHIVE_DIR, '%s-%s-%s.jsonl.gz' % (
+            time.strftime('%Y%m%d-%H%M%S'), direction, os.getpid()))
+        self.file = gzip.open(self.file_name, 'wb')
+        self.file.write(json.dumps({'direction': direction, 'argv': argv,
+                                    'started': time.strftime('%Y-%m-%d %H:%M:%S')}) + '\n')
+        self.queue = Queue.Queue(ARCHIVE_QUEUE_SIZE)
+        self.archived = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def prune(direction, keep_runs):
+        """ Remove all but the last keep_runs archives of direction """
+
+        suffix = re.compile(r'^\d{8}-\d{6}-%s-\d+\.jsonl\.gz$' % re.escape(direction))
+        names = sorted(name for name in os.listdir(ARCHIVE_DIR) if suffix.match(name))
+        for name in names[:max(0, len(names) - keep_runs)]:
+            logging.debug('Removing old archive %s', name)
+            os.remove(os.path.join(ARCHIVE_DIR, name))
+
+    def add(self, directory, name, content):
+        """ Queue a copy of content, a serialized item or a downloaded translation """
+
+        self.queue.put((directory, name, time.time(), content))
+
+    def run(self):
+        flushed = True
+        while True:
+            try:
+                entry = self.queue.get(timeout=ARCHIVE_FLUSH_INTERVAL)
+            except Queue.Empty:
+                if not flushed:
+                    self.file.flush()
+                    flushed = True
+                continue
+            if entry is None:
+                break
+
+            directory, name, written, content = entry
+            try:
+                self.file.write(json.dumps({'dir': directory, 'name': name, 
+                                            'time': written, 'content': content}) + '\n')
+                self.archived += 1
+                flushed = False
+            except (IOError, OSError, ValueError):
+                # Losing a debugging copy doesn't fail the run
+                logging.exception('Could not archive %s/%s', directory, name)
+                self.failed += 1
+
+    def close(self):
+        """ Write what is still queued and close the archive """
+
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+def transfer_all_source_items_to_smartling(item_type, selection, 
+                                           approve, slapi, zdapi, incremental=False,
+                                           fingerprints=None, bundle=False, journal=None):
+    """ Transfer all source items of a particular type from Zendesk to Smartling. 
+
+    If incremental is set, only items changed since the last successful incremental 
+    transfer of item_type are transferred. The time of that transfer is kept in 
+    STATE_DIR and only updated once all items have been uploaded.
+
+    If bundle is set, the items are packed into bundle files rather than uploaded one
+    file per item, see upload_bundles_to_smartling().
+    """
 
     logging.info('Transferring all %s items to Smartling for translation', item_type)
 
+    sync_marks = {}
+    since = None
+    if incremental:
+        sync_marks = load_state(SYNC_MARKS_FILE)
+        since = sync_marks.get(item_type)
+        if since is None:
+            logging.info('No previous incremental transfer of %s items', item_type)
+
+    if since is None:
+        next_since = int(time.time())
+        items = get_all_source_items_from_zendesk(item_type, selection, zdapi)
+    else:
+        items, next_since = get_changed_source_items_from_zendesk(item_type, since,
+                                                                  selection, zdapi)
+
+    if bundle:
+        upload_bundles_to_smartling(item_type, items, approve, slapi, fingerprints, 
+                                    journal)
 
-    for item in get_all_source_items_from_zendesk(item_type, 
-                                                  include_articles, 
-                                                  exclude_articles, 
-                                                  zdapi):
-        upload_item_to_smartling(item, item_type, approve, slapi)
+    else:
+        for item in items:
+            upload_item_to_smartling(item, item_type, approve, slapi, fingerprints, 
+                                     journal)
+
+    if incremental:
+        sync_marks[item_type] = next_since
+        save_state(sync_marks, SYNC_MARKS_FILE)
 
 
-def clean_dir(d):  
+def clean_dir(d, keep_files=False):  
     if os.path.exists(d):
+        if keep_files:
+            return
         shutil.rmtree(d, ignore_errors=True)    
 
     os.makedirs(d)
@@ -881,6 +2617,310 @@ def is_valid_locale_list(locales):
     return True
 
 
+class CallbackRequestHandler(BaseHTTPRequestHandler):
+    """ Passes the parameters of each request to the route of its path """
+
+    def receive(self):
+        path, _, query = self.path.partition('?')
+        params = dict(parse_qsl(query))
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        if self.headers.gettype() == 'application/x-www-form-urlencoded':
+            params.update(parse_qsl(body))
+
+        route = self.server.routes.get(path)
+        token = self.server.token
+        if route is None:
+            status = 404
+        elif token and not hmac.compare_digest(str(params.get('token', '')), token):
+            logging.warn('Refused callback to %s without the token from %s', path, 
+                         self.client_address[0])
+            status = 403
+        else:
+            try:
+                status = route(params, body, self.headers)
+            except ValueError as e:
+                logging.warn('Invalid callback to %s: %s', path, e)
+                status = 400
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST = receive
+
+    def log_message(self, format, *args):
+        logging.debug('Callback from %s: %s', self.client_address[0], format % args)
+
+
+class CallbackReceiver(ThreadingMixIn, HTTPServer):
+    """ Embedded HTTP server receiving the callbacks of the daemon (-d).
+
+    routes maps URL paths to functions called with the dictionary of query and form
+    parameters, the body and the headers of each request, which return the HTTP status
+    to answer with. They should return quickly, leaving the actual work to other 
+    threads, and raise ValueError for invalid requests. If token is set, requests 
+    without it as their token parameter are refused.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, routes, token=None):
+        HTTPServer.__init__(self, address, CallbackRequestHandler)
+        self.routes = routes
+        self.token = token
+
+
+class CallbackRetriever(object):
+    """ Retrieves translations as Smartling reports them complete.
+
+    Each callback names a file and a Smartling locale. The translation of the item, or
+    of the items of the bundle, is retrieved and published as with -r, up to jobs at a
+    time. A callback for a (file, locale) already waiting is dropped. Callbacks for 
+    files or locales this script doesn't handle are ignored.
+    """
+
+    def __init__(self, zd_locales, slapi, zdapi, jobs, last_modified, translation_index,
+                 attachment_cache):
+        self.sl_locales = dict((get_smartling_locale(zd_locale).lower(), 
+                                get_smartling_locale(zd_locale)) for zd_locale in zd_locales)
+        self.slapi = slapi
+        self.zdapi = zdapi
+        self.last_modified = last_modified
+        self.translation_index = translation_index
+        self.attachment_cache = attachment_cache
+        self.pool = ThreadPool(jobs)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.ignored = 0
+        self.failed = 0
+
+    def on_callback(self, params, body, headers):
+        uri = params.get('fileUri')
+        locale = params.get('locale')
+        if not uri or not locale:
+            raise ValueError('fileUri and locale are required')
+
+        sl_locale = self.sl_locales.get(locale.lower())
+        if sl_locale is None or not (SOURCE_FILE_NAME_RE.match(uri) or 
+                                     BUNDLE_FILE_NAME_RE.match(uri)):
+            logging.info('Ignoring callback for %s, locale %s', uri, locale)
+            with self.lock:
+                self.ignored += 1
+            return 200
+
+        with self.lock:
+            self.received += 1
+            if (uri, sl_locale) in self.pending:
+                return 200
+            self.pending.add((uri, sl_locale))
+
+        logging.debug('Callback for %s, locale %s', uri, sl_locale)
+        self.pool.apply_async(self.retrieve, (uri, sl_locale))
+        return 200
+
+    def retrieve(self, uri, sl_locale):
+        # A callback arriving from now on is for a newer version, so retrieve it again
+        with self.lock:
+            self.pending.discard((uri, sl_locale))
+
+        # The times fetched before are out of date, now that the file completed again
+        self.last_modified.invalidate(uri)
+
+        try:
+            match = SOURCE_FILE_NAME_RE.match(uri)
+            if match is not None:
+                item_type, item_id = match.group(1), int(match.group(2))
+                if item_type == TYPE_ARTICLE:
+                    self.attachment_cache.forget(item_id)
+                transfer_translation_from_smartling(item_type, item_id, sl_locale, 
+                                                    'published', self.slapi, self.zdapi,
+                                                    self.last_modified, 
+                                                    self.translation_index, 
+                                                    self.attachment_cache)
+                return
+
+            item_type = BUNDLE_FILE_NAME_RE.match(uri).group(1)
+            item_ids = load_state(BUNDLES_FILE).get(item_type, {}).get(uri)
+            if item_ids is None:
+                logging.warn('Bundle %s is not in %s, ignoring it', uri, BUNDLES_FILE)
+                return
+            if item_type == TYPE_ARTICLE:
+                for item_id in item_ids:
+                    self.attachment_cache.forget(item_id)
+            transfer_bundle_translation_from_smartling(item_type, uri, item_ids, sl_locale,
+                                                       'published', self.slapi, self.zdapi,
+                                                       self.last_modified,
+                                                       self.translation_index,
+                                                       self.attachment_cache)
+
+        except Exception:
+            # Log and carry on with the next callback, a daemon shouldn't die of one
+            logging.exception('Retrieving %s, locale %s failed', uri, sl_locale)
+            with self.lock:
+                self.failed += 1
+
+    def close(self):
+        """ Wait for the retrievals in progress and waiting to finish """
+
+        self.pool.close()
+        self.pool.join()
+
+
+def parse_zendesk_event(body):
+    """ Return the (item type, item ID) a Zendesk webhook request is about, or None.
+
+    Understands Help Center events, whose subject is e.g. zen:article:123, and custom 
+    payloads such as {"type": "article", "id": 123} sent by Zendesk triggers.
+    """
+
+    try:
+        event = json.loads(body)
+    except ValueError:
+        raise ValueError('Request body is not JSON')
+    if not isinstance(event, dict):
+        raise ValueError('Request body is not a JSON object')
+
+    # The item type ends up in file names, which are byte strings throughout
+    match = ZD_EVENT_SUBJECT_RE.match(event.get('subject') or '')
+    if match is not None:
+        return str(match.group(1)), int(match.group(2))
+
+    if event.get('type') in (TYPE_ARTICLE, TYPE_SECTION, TYPE_CATEGORY):
+        try:
+            return str(event['type']), int(event['id'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('No valid id for %s' % event['type'])
+
+    return None
+
+
+class SourceChangeDebouncer(object):
+    """ Sends the items Zendesk webhooks report changed to Smartling, once edits settle.
+
+    Each webhook request names an item. transfer(item_type, item_id) is called for it
+    once no request for the item has arrived for delay seconds, but no later than
+    max_delay seconds after the first request not yet acted on, so a burst of edits 
+    results in a single transfer. Transfers are made one at a time, in a thread of 
+    their own. If secret is set, requests need a valid Zendesk webhook signature.
+    """
+
+    def __init__(self, transfer, delay, max_delay, secret=None):
+        self.transfer = transfer
+        self.delay = delay
+        self.max_delay = max_delay
+        self.secret = secret
+        self.due = {}  # (item type, item ID) -> (time due, latest time due)
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.received = 0
+        self.transferred = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_signed(self, body, headers):
+        """ Check the signature Zendesk computes over the timestamp and body """
+
+        signature = headers.getheader('X-Zendesk-Webhook-Signature') or ''
+        timestamp = headers.getheader('X-Zendesk-Webhook-Signature-Timestamp') or ''
+        expected = base64.b64encode(hmac.new(self.secret, timestamp + body, 
+                                             hashlib.sha256).digest())
+        return hmac.compare_digest(signature, expected)
+
+    def on_webhook(self, params, body, headers):
+        if self.secret and not self.is_signed(body, headers):
+            logging.warn('Refused Zendesk webhook request with an invalid signature')
+            return 403
+
+        item = parse_zendesk_event(body)
+        if item is None:
+            logging.debug('Ignoring Zendesk webhook request: %s', body[:200])
+            return 200
+
+        now = time.time()
+        with self.condition:
+            self.received += 1
+            latest = self.due.get(item, (None, now + self.max_delay))[1]
+            self.due[item] = (min(now + self.delay, latest), latest)
+            self.condition.notify()
+
+        logging.debug('Zendesk reported %s %s changed', *item)
+        return 200
+
+    def next_due(self):
+        """ Wait for and return the next item due, or None once stopped and done """
+
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.due:
+                    item, (due, latest) = min(self.due.items(), key=lambda entry: entry[1])
+                    if due <= now or self.stopped:
+                        del self.due[item]
+                        return item
+                    self.condition.wait(due - now)
+                elif self.stopped:
+                    return None
+                else:
+                    self.condition.wait()
+
+    def run(self):
+        while True:
+            item = self.next_due()
+            if item is None:
+                return
+            try:
+                self.transfer(*item)
+            except Exception:
+                # Log and carry on with the next item, a daemon shouldn't die of one
+                logging.exception('Transferring %s %s to Smartling failed', *item)
+                self.failed += 1
+            else:
+                self.transferred += 1
+
+    def close(self):
+        """ Transfer the items still waiting straight away, and stop """
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+
+def stop_daemon(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def run_daemon(address, routes, token, checkpoint):
+    """ Receive callbacks until interrupted, with SIGINT or SIGTERM.
+
+    checkpoint() is called every DAEMON_CHECKPOINT_INTERVAL seconds, to save state.
+    """
+
+    receiver = CallbackReceiver(address, routes, token)
+    thread = threading.Thread(target=receiver.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info('Receiving callbacks on %s:%s, paths %s', receiver.server_address[0],
+                 receiver.server_address[1], ', '.join(sorted(routes)))
+
+    signal.signal(signal.SIGTERM, stop_daemon)
+    try:
+        while True:
+            time.sleep(DAEMON_CHECKPOINT_INTERVAL)
+            checkpoint()
+    except KeyboardInterrupt:
+        logging.info('Stopping daemon')
+    finally:
+        receiver.shutdown()
+        receiver.server_close()
+
+
 def main():
 
     # Load configuration parameters.
@@ -888,8 +2928,27 @@ def main():
     config = SafeConfigParser()
     config.read(CONFIG_FILE)
     
+    global write_debug_files, persist_attachment_cache, bundle_max_bytes, sl_callback_url
+    global run_archive
+
     try:
         log_file = config.get('general', 'log_file')
+        if config.has_option('general', 'write_debug_files'):
+            write_debug_files = config.getboolean('general', 'write_debug_files')
+        # Optionally keep the debugging copies in a run archive, keeping this many 
+        # archives per direction
+        archive_runs = 0
+        if config.has_option('general', 'archive_runs'):
+            archive_runs = config.getint('general', 'archive_runs')
+
+        # Where the metrics of the run are written, as JSON and optionally for the 
+        # Prometheus node exporter textfile collector
+        metrics_file = 'smartlingzd_metrics.json'
+        if config.has_option('general', 'metrics_file'):
+            metrics_file = config.get('general', 'metrics_file')
+        prometheus_file = None
+        if config.has_option('general', 'prometheus_file'):
+            prometheus_file = config.get('general', 'prometheus_file')
         sl_api_key = config.get('smartling', 'api_key')        
         sl_project_id = config.get('smartling', 'project_id')
         if config.has_option('smartling', 'approve_for_translation'):
@@ -897,10 +2956,104 @@ def main():
         else:
             approve_for_translation = True
 
+        # Optional Smartling API host, and CA certificates to verify it with, for 
+        # testing against a stand-in server
+        sl_host = None
+        if config.has_option('smartling', 'host'):
+            sl_host = config.get('smartling', 'host')
+        sl_ca_file = None
+        if config.has_option('smartling', 'ca_file'):
+            sl_ca_file = config.get('smartling', 'ca_file')
+
+        # Optional tuning of the pool of keep-alive connections to Smartling
+        sl_pool_size = None
+        if config.has_option('smartling', 'connection_pool_size'):
+            sl_pool_size = config.getint('smartling', 'connection_pool_size')
+        sl_idle_timeout = None
+        if config.has_option('smartling', 'connection_idle_timeout'):
+            sl_idle_timeout = config.getint('smartling', 'connection_idle_timeout')
+
+        # Optionally gzip uploaded files, responses are always asked for compressed
+        sl_compress_uploads = False
+        if config.has_option('smartling', 'compress_uploads'):
+            sl_compress_uploads = config.getboolean('smartling', 'compress_uploads')
+
+        # Optional concurrency settings for retrieval. Per-service limits default to
+        # the number of jobs.
+        default_jobs = 1
+        if config.has_option('general', 'jobs'):
+            default_jobs = config.getint('general', 'jobs')
+        sl_max_concurrency = None
+        if config.has_option('smartling', 'max_concurrency'):
+            sl_max_concurrency = config.getint('smartling', 'max_concurrency')
+        zd_max_concurrency = None
+        if config.has_option('zendesk', 'max_concurrency'):
+            zd_max_concurrency = config.getint('zendesk', 'max_concurrency')
+
+        # Optional request rates (per second) and bursts allowed per service, and how
+        # often rate limited calls are retried
+        sl_rate_limit = None
+        if config.has_option('smartling', 'rate_limit'):
+            sl_rate_limit = config.getfloat('smartling', 'rate_limit')
+        sl_burst = None
+        if config.has_option('smartling', 'burst'):
+            sl_burst = config.getint('smartling', 'burst')
+        zd_rate_limit = None
+        if config.has_option('zendesk', 'rate_limit'):
+            zd_rate_limit = config.getfloat('zendesk', 'rate_limit')
+        zd_burst = None
+        if config.has_option('zendesk', 'burst'):
+            zd_burst = config.getint('zendesk', 'burst')
+        max_retries = 5
+        if config.has_option('general', 'max_retries'):
+            max_retries = config.getint('general', 'max_retries')
+
+        if config.has_option('smartling', 'bundle_max_bytes'):
+            bundle_max_bytes = config.getint('smartling', 'bundle_max_bytes')
+
+        if config.has_option('zendesk', 'persist_attachment_cache'):
+            persist_attachment_cache = config.getboolean('zendesk', 
+                                                         'persist_attachment_cache')
 
         zd_url = config.get('zendesk', 'url')
         zd_user = config.get('zendesk', 'user')
         zd_auth_token = config.get('zendesk', 'auth_token')
+
+        # Optional daemon receiving callbacks on a host:port, only accepting those with 
+        # the token, which is added to the callback URL registered with Smartling
+        daemon_address = None
+        if config.has_option('daemon', 'listen'):
+            host, _, port = config.get('daemon', 'listen').rpartition(':')
+            try:
+                daemon_address = (host, int(port))
+            except ValueError:
+                sys.exit('Invalid listen address in ' + CONFIG_FILE + ', use host:port')
+        daemon_token = None
+        if config.has_option('daemon', 'token'):
+            daemon_token = config.get('daemon', 'token')
+        daemon_debounce = 30
+        if config.has_option('daemon', 'debounce'):
+            daemon_debounce = config.getfloat('daemon', 'debounce')
+        daemon_max_debounce = 300
+        if config.has_option('daemon', 'max_debounce'):
+            daemon_max_debounce = config.getfloat('daemon', 'max_debounce')
+
+        # Optional path the daemon receives Zendesk webhook requests on, and the signing
+        # secret of the webhook
+        zd_webhook_path = None
+        if config.has_option('zendesk', 'webhook_path'):
+            zd_webhook_path = config.get('zendesk', 'webhook_path')
+        zd_webhook_secret = None
+        if config.has_option('zendesk', 'webhook_secret'):
+            zd_webhook_secret = config.get('zendesk', 'webhook_secret')
+
+        sl_callback_path = None
+        if config.has_option('smartling', 'callback_url'):
+            sl_callback_url = config.get('smartling', 'callback_url')
+            sl_callback_path = urlsplit(sl_callback_url).path or '/'
+            if daemon_token:
+                sl_callback_url += ('&' if '?' in sl_callback_url else '?') + \
+                    urlencode({'token': daemon_token})
         
         for key, val in config.items('zd-to-sl-locales'):
             locale_mapping[key] = val
@@ -911,28 +3064,40 @@ def main():
     # Load transfer config file
 
     transfer_config = SafeConfigParser(allow_no_value=True)
+    transfer_config.optionxform = str  # label names are case sensitive
     transfer_config.read(TRANSFER_CONFIG_FILE)
 
-    transfer_config_valid_sections = ['include-articles', 'exclude-articles']
+    transfer_config_valid_sections = ['include-articles', 'exclude-articles',
+                                      'include-sections', 'exclude-sections',
+                                      'include-categories', 'exclude-categories',
+                                      'include-labels', 'exclude-labels']
     for section in transfer_config.sections():
         if section not in transfer_config_valid_sections:
             sys.exit('Invalid section in ' + TRANSFER_CONFIG_FILE + ': ' + section)
 
-    include_articles = []
-    if transfer_config.has_section('include-articles'):
-        for option in transfer_config.options('include-articles'):
+    # Rules per section, IDs except for labels
+    transfer_rules = {}
+    for section in transfer_config_valid_sections:
+        transfer_rules[section] = set()
+        if not transfer_config.has_section(section):
+            continue
+        for option in transfer_config.options(section):
+            if section.endswith('-labels'):
+                transfer_rules[section].add(option)
+                continue
             try:
-                include_articles.append(int(option))
+                transfer_rules[section].add(int(option))
             except ValueError as e:
                 sys.exit('Invalid entry in ' + TRANSFER_CONFIG_FILE + ': ' + option)
 
-    exclude_articles = []
-    if transfer_config.has_section('exclude-articles'):
-        for option in transfer_config.options('exclude-articles'):
-            try:
-                exclude_articles.append(int(option))
-            except ValueError as e:
-                sys.exit('Invalid entry in ' + TRANSFER_CONFIG_FILE + ': ' + option)
+    selection = ArticleSelection(transfer_rules['include-articles'], 
+                                 transfer_rules['exclude-articles'],
+                                 transfer_rules['include-sections'], 
+                                 transfer_rules['exclude-sections'],
+                                 transfer_rules['include-categories'], 
+                                 transfer_rules['exclude-categories'],
+                                 transfer_rules['include-labels'], 
+                                 transfer_rules['exclude-labels'])
 
 
 
@@ -972,6 +3137,36 @@ def main():
                         dest='categories', 
                         help='Comma-separated list of category IDs to send or retrieve, or all')
 
+    parser.add_argument('-i', '--incremental', 
+                        action='store_true', 
+                        dest='incremental', 
+                        default=False,
+                        help='With all, only send items changed since the last incremental run')
+
+    parser.add_argument('-b', '--bundle', 
+                        action='store_true', 
+                        dest='bundle', 
+                        default=False,
+                        help='With all, pack items into bundle files in Smartling')
+
+    parser.add_argument('-d', '--daemon', 
+                        action='store_true', 
+                        dest='daemon', 
+                        default=False,
+                        help='Keep running, retrieving translations as Smartling reports them complete')
+
+    parser.add_argument('-f', '--force', 
+                        action='store_true', 
+                        dest='force', 
+                        default=False,
+                        help='Transfer items and translations even if unchanged since the last transfer')
+
+    parser.add_argument('--resume', 
+                        action='store_true', 
+                        dest='resume', 
+                        default=False,
+                        help='Skip what an interrupted run of the same direction already transferred')
+
     parser.add_argument('-y', '--retrievaltype', 
                         action='store',
                         dest='retrievaltype',
@@ -979,6 +3174,14 @@ def main():
                         default='published',
                         help='Type of translation to retrieve - published, pseudo or pending')
 
+    parser.add_argument('-j', '--jobs', 
+                        action='store',
+                        dest='jobs',
+                        type=int,
+                        required=False, 
+                        default=default_jobs, 
+                        help='Number of translations to retrieve in parallel')
+
     parser.add_argument('-g', '--loglevel', 
                         action='store',
                         dest='loglevel',
@@ -988,22 +3191,35 @@ def main():
 
     args = parser.parse_args()
 
-    if args.translate == False and args.retrieve == False:
-        print 'Please specify either translate (-t) or retrieve (-r)'
+    if [args.translate, args.retrieve, args.daemon].count(True) != 1:
+        print 'Please specify either translate (-t), retrieve (-r) or daemon (-d)'
         return
 
-    if args.translate == True and args.retrieve == True:
-        print 'Please specify either translate (-t) or retrieve (-r)'
+    if args.daemon and (daemon_address is None or 
+                        (sl_callback_path is None and zd_webhook_path is None)):
+        print 'Please configure listen in [daemon], and callback_url in [smartling] ' \
+            'or webhook_path in [zendesk] for -d'
         return
 
     if args.translate and args.locales:
         print 'Locales currently only supported for retrieval'
         return
 
+    if args.bundle and args.incremental:
+        print 'Bundles always contain all items, so incremental (-i) is not supported'
+        return
+
+    if args.retrieve and args.incremental:
+        print 'Incremental transfer currently only supported for translate (-t)'
+        return
+
     if args.retrieve and not args.locales:
         print 'Please specify locales, or all'
         return
 
+    # The daemon handles callbacks of all locales unless told otherwise
+    locales = locale_mapping.keys()
+
     if args.locales:
         if is_valid_locale_list(args.locales):
             if args.locales == 'all':
@@ -1019,6 +3235,10 @@ def main():
         print 'Please specify a valid retrieval type (published, pseudo or pending), or leave blank'
         return
 
+    if args.jobs < 1:
+        print 'Please specify a number of jobs of at least 1'
+        return
+
     if args.loglevel and args.loglevel not in LOGGING_LEVELS.keys():
         print 'Please specify a valid logging level (debug, info, warning, error, critical), or leave blank'
         return
@@ -1035,10 +3255,44 @@ def main():
                             format=log_format, 
                             level=logging.INFO)
 
+    logging.getLogger().addFilter(work_unit_log_filter)
+
+    if sl_max_concurrency is None:
+        sl_max_concurrency = args.jobs
+    if zd_max_concurrency is None:
+        zd_max_concurrency = args.jobs
+    if sl_pool_size is None:
+        sl_pool_size = sl_max_concurrency
 
     zdapi = zdesk.Zendesk(zd_url, zd_user, zd_auth_token, True)
-    slapi = SmartlingFileApiFactory().getSmartlingTranslationApiProd(sl_api_key, 
-                                                                     sl_project_id)
+    if hasattr(getattr(zdapi, 'client', None), 'hooks'):
+        # zdesk versions using requests let the sizes of the calls be counted
+        zdapi.client.hooks['response'].append(count_zendesk_bytes)
+    zdapi = InstrumentedApi(zdapi, 'zendesk')
+
+    sl_ssl_context = None
+    if sl_ca_file:
+        sl_ssl_context = ssl.create_default_context(cafile=sl_ca_file)
+    sl_pool = MeteredConnectionPool(sl_pool_size, sl_idle_timeout, sl_ssl_context)
+    if sl_host:
+        slapi = SmartlingFileApi(sl_host, sl_api_key, sl_project_id, connectionPool=sl_pool)
+    else:
+        slapi = SmartlingFileApiFactory().getSmartlingTranslationApiProd(sl_api_key, 
+                                                                         sl_project_id,
+                                                                         connectionPool=sl_pool)
+    slapi.compress_uploads = sl_compress_uploads
+    slapi = InstrumentedApi(slapi, 'smartling')
+
+    zd_scheduler = RateLimitScheduler('zendesk', zd_max_concurrency, zd_rate_limit, zd_burst)
+    zdapi = ThrottledApi(zdapi, zd_scheduler, get_zendesk_retry_after, max_retries)
+    sl_scheduler = RateLimitScheduler('smartling', sl_max_concurrency, sl_rate_limit, sl_burst)
+    slapi = ThrottledApi(slapi, sl_scheduler, get_smartling_retry_after, max_retries)
+
+    fingerprints = None
+    last_modified = None
+    attachment_cache = None
+    journal = None
+    succeeded = False
 
     try:
 
@@ -1047,7 +3301,14 @@ def main():
             logging.info('----------------------------------------------')
             logging.info('Beginning transfer of source content to Smartling...')
 
-            clean_dir(SOURCE_DIR)
+            # A resumed run keeps the debugging copies written before the interruption
+            if write_debug_files and archive_runs:
+                run_archive = RunArchive('translate', sys.argv[1:], archive_runs)
+            elif write_debug_files:
+                clean_dir(SOURCE_DIR, args.resume)
+
+            fingerprints = FingerprintStore(args.force)
+            journal = RunJournal('translate', sys.argv[1:], args.resume)
 
             # TODO separate 'all articles' calls from categories and sections 
             # or make include/exclude optional
@@ -1056,48 +3317,60 @@ def main():
 
                 if args.categories == 'all':
                     transfer_all_source_items_to_smartling(TYPE_CATEGORY,
-                                                           include_articles,
-                                                           exclude_articles,
+                                                           selection,
                                                            approve_for_translation,
-                                                           slapi, zdapi)
+                                                           slapi, zdapi,
+                                                           args.incremental,
+                                                           fingerprints,
+                                                           args.bundle,
+                                                           journal)
 
                 else:
                     item_ids = args.categories.split(',')
                     transfer_source_items_to_smartling(TYPE_CATEGORY, item_ids, 
                                                        approve_for_translation,
-                                                       slapi, zdapi)
+                                                       slapi, zdapi, fingerprints, 
+                                                       journal)
 
             if args.sections:   
 
                 if args.sections == 'all':
                     transfer_all_source_items_to_smartling(TYPE_SECTION, 
-                                                           include_articles,
-                                                           exclude_articles,
+                                                           selection,
                                                            approve_for_translation,
-                                                           slapi, zdapi)
+                                                           slapi, zdapi,
+                                                           args.incremental,
+                                                           fingerprints,
+                                                           args.bundle,
+                                                           journal)
 
                 else:
                     item_ids = args.sections.split(',')
                     transfer_source_items_to_smartling(TYPE_SECTION, 
                                                        item_ids, 
                                                        approve_for_translation,
-                                                       slapi, zdapi)
+                                                       slapi, zdapi, fingerprints, 
+                                                       journal)
 
             if args.articles:   
 
                 if args.articles == 'all':
                     transfer_all_source_items_to_smartling(TYPE_ARTICLE, 
-                                                           include_articles,
-                                                           exclude_articles,
+                                                           selection,
                                                            approve_for_translation,
-                                                           slapi, zdapi)
+                                                           slapi, zdapi,
+                                                           args.incremental,
+                                                           fingerprints,
+                                                           args.bundle,
+                                                           journal)
 
                 else:
                     item_ids = args.articles.split(',')
                     transfer_source_items_to_smartling(TYPE_ARTICLE, 
                                                        item_ids, 
                                                        approve_for_translation,
-                                                       slapi, zdapi)
+                                                       slapi, zdapi, fingerprints, 
+                                                       journal)
 
 
         elif args.retrieve:
@@ -1105,23 +3378,54 @@ def main():
             logging.info('-------------------------------------------------')
             logging.info('Beginning tranfer of translations from Smartling...')
 
-            clean_dir(TRANSLATION_DIR)
+            if write_debug_files and archive_runs:
+                run_archive = RunArchive('retrieve', sys.argv[1:], archive_runs)
+            elif write_debug_files:
+                clean_dir(TRANSLATION_DIR, args.resume)
+
+            journal = RunJournal('retrieve', sys.argv[1:], args.resume)
+
+            last_modified = LastModifiedIndex(slapi, args.force)
+            translation_index = TranslationIndex(zdapi)
+            attachment_cache = AttachmentCache(zdapi, persist_attachment_cache)
+
+            # List what's complete in Smartling once for every item type retrieved in full
+            all_item_types = [item_type for item_type, arg in ((TYPE_CATEGORY, args.categories),
+                                                               (TYPE_SECTION, args.sections),
+                                                               (TYPE_ARTICLE, args.articles))
+                              if arg == 'all']
+            completion_index = None
+            if all_item_types:
+                with metrics.stage('completion_index'):
+                    completion_index = build_completion_index(all_item_types, locales, 
+                                                              slapi, args.jobs)
+
+            # Without the bundle option, items are retrieved from their own files
+            bundle_manifest = {}
+            if args.bundle:
+                bundle_manifest = load_state(BUNDLES_FILE)
 
             if args.categories:   
 
                 if args.categories == 'all':
                     transfer_all_translations_from_smartling(
                         TYPE_CATEGORY, locales, 
-                        include_articles,
-                        exclude_articles,
-                        'published', slapi, zdapi
+                        selection,
+                        'published', slapi, zdapi, args.jobs,
+                        last_modified, translation_index, attachment_cache,
+                        completion_index,
+                        bundle_manifest.get(TYPE_CATEGORY),
+                        journal
                         )
 
                 else:
                     item_ids = args.categories.split(',')
                     transfer_translations_from_smartling(
                         TYPE_CATEGORY, item_ids, locales, 
-                        args.retrievaltype , slapi, zdapi
+                        args.retrievaltype , slapi, zdapi, args.jobs,
+                        last_modified, translation_index, attachment_cache,
+                        bundle_manifest.get(TYPE_CATEGORY),
+                        journal
                         )
 
             if args.sections:   
@@ -1129,16 +3433,22 @@ def main():
                 if args.sections == 'all':
                     transfer_all_translations_from_smartling(
                         TYPE_SECTION, locales, 
-                        include_articles,
-                        exclude_articles,
-                        'published', slapi, zdapi
+                        selection,
+                        'published', slapi, zdapi, args.jobs,
+                        last_modified, translation_index, attachment_cache,
+                        completion_index,
+                        bundle_manifest.get(TYPE_SECTION),
+                        journal
                         )
 
                 else:
                     item_ids = args.sections.split(',')
                     transfer_translations_from_smartling(
                         TYPE_SECTION, item_ids, locales, 
-                        args.retrievaltype , slapi, zdapi
+                        args.retrievaltype , slapi, zdapi, args.jobs,
+                        last_modified, translation_index, attachment_cache,
+                        bundle_manifest.get(TYPE_SECTION),
+                        journal
                         )
 
             if args.articles:   
@@ -1147,24 +3457,98 @@ def main():
                     transfer_all_translations_from_smartling(
                         TYPE_ARTICLE, 
                         locales, 
-                        include_articles,
-                        exclude_articles,
-                        'published', slapi, zdapi
+                        selection,
+                        'published', slapi, zdapi, args.jobs,
+                        last_modified, translation_index, attachment_cache,
+                        completion_index,
+                        bundle_manifest.get(TYPE_ARTICLE),
+                        journal
                         )
 
                 else:
                     item_ids = args.articles.split(',')
                     transfer_translations_from_smartling(
                         TYPE_ARTICLE, item_ids, locales, 
-                        args.retrievaltype , slapi, zdapi
+                        args.retrievaltype , slapi, zdapi, args.jobs,
+                        last_modified, translation_index, attachment_cache,
+                        bundle_manifest.get(TYPE_ARTICLE),
+                        journal
                         )
 
+        elif args.daemon:
+
+            logging.info('-------------------------------------------------')
+            logging.info('Starting daemon...')
+
+            routes = {}
+            retriever = None
+            debouncer = None
+
+            if write_debug_files and archive_runs:
+                run_archive = RunArchive('daemon', sys.argv[1:], archive_runs)
+
+            # Translations completed in Smartling are retrieved on callback
+            if sl_callback_path is not None:
+                if write_debug_files and run_archive is None:
+                    clean_dir(TRANSLATION_DIR, True)
+
+                last_modified = LastModifiedIndex(slapi, args.force)
+                translation_index = TranslationIndex(zdapi)
+                attachment_cache = AttachmentCache(zdapi, persist_attachment_cache)
+                retriever = CallbackRetriever(locales, slapi, zdapi, args.jobs, 
+                                              last_modified, translation_index, 
+                                              attachment_cache)
+                routes[sl_callback_path] = retriever.on_callback
+
+            # Items changed in Zendesk are sent to Smartling on webhook requests
+            if zd_webhook_path is not None:
+                if write_debug_files and run_archive is None:
+                    clean_dir(SOURCE_DIR, True)
+
+                fingerprints = FingerprintStore(args.force)
+
+                def transfer_changed_item(item_type, item_id):
+                    transfer_source_item_to_smartling(item_type, item_id, 
+                                                      approve_for_translation, 
+                                                      slapi, zdapi, fingerprints, 
+                                                      selection=selection)
+
+                debouncer = SourceChangeDebouncer(transfer_changed_item, daemon_debounce, 
+                                                  daemon_max_debounce, zd_webhook_secret)
+                routes[zd_webhook_path] = debouncer.on_webhook
+
+            def checkpoint():
+                for state in (last_modified, attachment_cache, fingerprints):
+                    if state is not None:
+                        state.save()
+                if metrics_file:
+                    write_metrics(json.dumps(metrics.to_dict(True), indent=4, 
+                                             sort_keys=True), 
+                                  metrics_file)
+                if prometheus_file:
+                    write_metrics(metrics.to_prometheus(True), prometheus_file)
+
+            try:
+                run_daemon(daemon_address, routes, daemon_token, checkpoint)
+            finally:
+                if retriever is not None:
+                    retriever.close()
+                    logging.info('Smartling callbacks: %s received, %s ignored, %s failed', 
+                                 retriever.received, retriever.ignored, retriever.failed)
+                if debouncer is not None:
+                    debouncer.close()
+                    logging.info('Zendesk webhook requests: %s received, %s items '
+                                 'transferred, %s failed', debouncer.received, 
+                                 debouncer.transferred, debouncer.failed)
+
+        succeeded = True
+
 
     except zdesk.ZendeskError as e:
 
-        # Not handling API rate limit errors as they seem unlikely given we're single-threaded
-        # also not handling authentication errors as they'll likely only be during setup
-        # could be others that need handling
+        # Rate limit errors only get here once the retries are used up. Not handling
+        # authentication errors as they'll likely only be during setup, could be others 
+        # that need handling
 
         logging.critical('Zendesk API error %s: %s', e.error_code, e.msg)
         logging.critical(e.response)
@@ -1176,6 +3560,44 @@ def main():
         logging.critical(e.response)
         sys.exit('Smartling API error %s. Check log for details.' % e.error_code)
 
+    finally:
+        if fingerprints is not None:
+            fingerprints.save()
+            logging.info('Uploads to Smartling: %s done, %s skipped as unchanged', 
+                         fingerprints.uploaded, fingerprints.skipped)
+        if last_modified is not None:
+            last_modified.save()
+            logging.info('Translations skipped as unchanged in Smartling: %s', 
+                         last_modified.skipped)
+        if attachment_cache is not None:
+            attachment_cache.save()
+        if journal is not None:
+            journal.close(succeeded)
+            logging.info('Work units: %s done, %s skipped as done before the interruption',
+                         journal.recorded, journal.skipped)
+            if not succeeded:
+                logging.info('Run with --resume to continue where this run stopped')
+        if run_archive is not None:
+            run_archive.close()
+            logging.info('Debugging copies: %s archived in %s, %s failed', 
+                         run_archive.archived, run_archive.file_name, run_archive.failed)
+        logging.info('Smartling connections: %(created)s created, %(reused)s reused, '
+                     '%(discarded)s discarded', sl_pool.stats())
+        sl_pool.closeAll()
+
+        for scheduler in (zd_scheduler, sl_scheduler):
+            logging.info('%s: %s calls rate limited, concurrency limit %s (lowest %s)', 
+                         scheduler.service, scheduler.rate_limited, int(scheduler.limit), 
+                         int(scheduler.lowest_limit))
+
+        for line in metrics.summary():
+            logging.info(line)
+        if metrics_file:
+            write_metrics(json.dumps(metrics.to_dict(succeeded), indent=4, sort_keys=True), 
+                          metrics_file)
+        if prometheus_file:
+            write_metrics(metrics.to_prometheus(succeeded), prometheus_file)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+""" Reads the run archives smartlingzd.py writes with archive_runs set in [general].
+
+Every run archive holds the debugging copies of one run, which are otherwise written to
+sourcefromzd and translationsfromsl: the items as uploaded to Smartling and the
+translations as downloaded from it. Run it in the directory smartlingzd.py runs in.
+
+Usage examples:
+
+    ./smartlingzd_archive.py
+
+    Lists the archived runs, oldest first.
+
+    ./smartlingzd_archive.py last
+
+    Lists the copies in the archive of the last run, 'last' can also be a file name,
+    or the number of the run as listed.
+
+    ./smartlingzd_archive.py last article_201234567_fr-FR.json
+
+    Prints the copy with the given file name, as it was uploaded or downloaded. If the
+    run archived it more than once, as the daemon may, the last copy is printed.
+
+    ./smartlingzd_archive.py 3 --extract debug
+
+    Writes all copies of the third run to debug/sourcefromzd and
+    debug/translationsfromsl, like they would have been written without the archive.
+"""
+
+
+import os
+import sys
+import io
+import gzip
+import json
+import time
+import zlib
+import argparse
+
+
+# As in smartlingzd.py
+ARCHIVE_DIR = 'archive'
+
+
+def list_archives():
+    """ Return the archive file names, oldest first """
+
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    names = [name for name in os.listdir(ARCHIVE_DIR) if name.endswith('.jsonl.gz')]
+    return [os.path.join(ARCHIVE_DIR, name) for name in sorted(names)]
+
+
+def find_archive(run):
+    """ Return the file name of run: 'last', a number as listed, or a file name """
+
+    archives = list_archives()
+    if run == 'last':
+        if not archives:
+            sys.exit('No archives in %s' % ARCHIVE_DIR)
+        return archives[-1]
+    if run.isdigit():
+        if not 1 <= int(run) <= len(archives):
+            sys.exit('No run %s, there are %s archives in %s' % (run, len(archives),
+                                                                 ARCHIVE_DIR))
+        return archives[int(run) - 1]
+    if not os.path.exists(run) and os.path.exists(os.path.join(ARCHIVE_DIR, run)):
+        return os.path.join(ARCHIVE_DIR, run)
+    return run
+
+
+def read_archive(file_name):
+    """ Yield the header and then the copies of an archive, as dictionaries.
+
+    An archive of a run still going, or killed, can end in the middle of a line,
+    everything before is read.
+    """
+
+    f = gzip.open(file_name, 'rb')
+    try:
+        while True:
+            try:
+                line = f.readline()
+            except (IOError, EOFError, zlib.error):
+                sys.stderr.write('%s ends early, the run is still going or was killed\n'
+                                 % file_name)
+                return
+            if not line:
+                return
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # The line being written when the archive was last flushed
+                return
+    finally:
+        f.close()
+
+
+def show_runs():
+    for number, file_name in enumerate(list_archives(), 1):
+        header = next(read_archive(file_name), None) or {}
+        print '%3d  %-45s %-9s %s  %s' % (number, os.path.basename(file_name),
+                                          header.get('direction', '?'),
+                                          header.get('started', '?'),
+                                          ' '.join(header.get('argv', [])))
+
+
+def show_copies(file_name):
+    entries = read_archive(file_name)
+    header = next(entries, None) or {}
+    print '%s run started %s: %s' % (header.get('direction', '?'), header.get('started', '?'),
+                                     ' '.join(header.get('argv', [])))
+    for entry in entries:
+        print '%s  %-20s %-45s %9d' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])),
+            entry['dir'], entry['name'], len(entry['content']))
+
+
+def content_bytes(entry):
+    content = entry['content']
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return content
+
+
+def print_copy(file_name, name):
+    found = None
+    for entry in read_archive(file_name):
+        if 'content' in entry and name in (entry['name'], entry['dir'] + '/' + entry['name']):
+            found = entry
+    if found is None:
+        sys.exit('No %s in %s' % (name, file_name))
+    sys.stdout.write(content_bytes(found))
+
+
+def extract(file_name, directory):
+    count = 0
+    for entry in read_archive(file_name):
+        if 'content' not in entry:
+            continue
+        entry_dir = os.path.join(directory, entry['dir'])
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+        # Later copies of the same file replace earlier ones, like without the archive
+        with io.open(os.path.join(entry_dir, entry['name']), 'wb') as f:
+            f.write(content_bytes(entry))
+        count += 1
+    print '%s copies written to %s' % (count, directory)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Read the run archives of smartlingzd.py')
+    parser.add_argument('run', nargs='?',
+                        help='\'last\', number of the run as listed, or archive file name')
+    parser.add_argument('name', nargs='?', help='File name of the copy to print')
+    parser.add_argument('-x', '--extract', metavar='DIR',
+                        help='Write all copies of the run to DIR')
+    args = parser.parse_args()
+
+    if args.run is None:
+        show_runs()
+        return
+
+    file_name = find_archive(args.run)
+    if not os.path.exists(file_name):
+        sys.exit('No archive %s' % file_name)
+
+    if args.extract:
+        extract(file_name, args.extract)
+    elif args.name:
+        print_copy(file_name, args.name)
+    else:
+        show_copies(file_name)
+
+
+if __name__ == '__main__':
+    main()